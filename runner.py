@@ -4,13 +4,51 @@ import unittest
 import xmlrunner
 
 from tests import (
-    test_evaluate_fk
+    test_ask_many,
+    test_background_loop,
+    test_batch_embedding,
+    test_batch_jobs,
+    test_circuit_breaker,
+    test_continuation,
+    test_evaluate_fk,
+    test_local_embedding,
+    test_md_chunker,
+    test_model_cascade,
+    test_model_router,
+    test_providers,
+    test_rate_limiter,
+    test_response_cache,
+    test_single_flight,
+    test_streaming,
+    test_structured_output,
+    test_telemetry,
+    test_token_budget,
+    test_transport
 )
 
 
 def makesuite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromModule(test_ask_many))
+    suite.addTest(loader.loadTestsFromModule(test_background_loop))
+    suite.addTest(loader.loadTestsFromModule(test_batch_embedding))
+    suite.addTest(loader.loadTestsFromModule(test_batch_jobs))
+    suite.addTest(loader.loadTestsFromModule(test_circuit_breaker))
+    suite.addTest(loader.loadTestsFromModule(test_continuation))
+    suite.addTest(loader.loadTestsFromModule(test_local_embedding))
+    suite.addTest(loader.loadTestsFromModule(test_md_chunker))
+    suite.addTest(loader.loadTestsFromModule(test_model_cascade))
+    suite.addTest(loader.loadTestsFromModule(test_model_router))
+    suite.addTest(loader.loadTestsFromModule(test_providers))
+    suite.addTest(loader.loadTestsFromModule(test_rate_limiter))
+    suite.addTest(loader.loadTestsFromModule(test_response_cache))
+    suite.addTest(loader.loadTestsFromModule(test_single_flight))
+    suite.addTest(loader.loadTestsFromModule(test_streaming))
+    suite.addTest(loader.loadTestsFromModule(test_structured_output))
+    suite.addTest(loader.loadTestsFromModule(test_telemetry))
+    suite.addTest(loader.loadTestsFromModule(test_token_budget))
+    suite.addTest(loader.loadTestsFromModule(test_transport))
     suite.addTest(loader.loadTestsFromModule(test_evaluate_fk))
 
     return suite
@@ -1,5 +1,8 @@
+import asyncio
+import logging
 import os
 import json
+import pathlib
 import re
 from typing import List
 import markdown
@@ -10,6 +13,7 @@ from datetime import datetime
 
 from src.helpers.np_helper import save_json
 from src.helpers.chat_connector import ChatConnector
+from src.helpers.transport import close_transport
 
 
 class ContentEnhancer:
@@ -25,6 +29,8 @@ class ContentEnhancer:
         os.makedirs(self.output_dir, exist_ok=True)
         self.model = ChatConnector(logger)
         self.model.init_model('gemini')
+        # prompt tokens spent on the origin and linked content of one post
+        self.source_budget = 24000
         # Load JSON data
 
         with open(directory / 'report' / 'linked.json', 'r', encoding='utf-8') as f:
@@ -97,6 +103,14 @@ class ContentEnhancer:
 
     async def enhance_content(self, original_content, filename):
         """Enhance the content with additional information and formatting."""
+        result = self.prepare_content(original_content, filename)
+        result['new_content'] = await self.generate_text_enhancement(
+            result['original_content'], result['linked_content']
+        )
+        return result
+
+    def prepare_content(self, original_content, filename):
+        """Collect everything of the enhanced post except the generated text."""
         self.logger.debug(f'Enhancing content for {filename}')
         result = {}
 
@@ -115,7 +129,6 @@ class ContentEnhancer:
 
         # Extract plain text for summary
         plain_text = soup.get_text()
-        result['new_content'] = await self.generate_text_enhancement(original_content, result['linked_content'])
 
         # Create a summary (first 150 characters if content is long enough)
         result['summary'] = plain_text[:150] + '...' if len(plain_text) > 150 else plain_text
@@ -189,8 +202,8 @@ class ContentEnhancer:
         prompt = self._create_definition_prompt(origin, source_content)
 
         try:
-            definition = await self.model.ask(prompt)
-            return definition
+            result = await self.model.ask(prompt)
+            return result.text
         except Exception as e:
             return f'Definition generation failed: {e}'
 
@@ -204,8 +217,13 @@ class ContentEnhancer:
         Returns:
             Formatted prompt string
         """
-        content_sample = '\n\n'.join(source_content[:5])  # Limit to first 3 sources to avoid token limits
+        template = self._definition_prompt('', '')
+        # the origin goes first, so it is kept whole unless it alone exceeds the budget; the sources share the rest
+        fitted = self.model.fit_sources([origin] + list(source_content), template, limit=self.source_budget)
+        origin = fitted[0] if fitted else ''
+        return self._definition_prompt(origin, '\n\n'.join(fitted[1:]))
 
+    def _definition_prompt(self, origin, content_sample: str) -> str:
         prompt = (
             'Based on the following articles that use the tag "{tag_name}", create a comprehensive definition\n'
             'of what this tag represents in the context of the Madar software system for Enterprise Resource Planning. \n'
@@ -246,10 +264,11 @@ class ContentEnhancer:
         self.logger.info(f'Enhanced content saved to: {output_path}')
         return output_path
 
-    async def process_files(self):
+    async def process_files(self, concurrency=8):
         """Process markdown files in the source directory whose source_url is in the important URLs list."""
         files_processed = 0
         files_skipped = 0
+        prepared = []
 
         # Get all markdown files
         md_files = glob.glob(os.path.join(self.source_dir, '*.md'))
@@ -271,7 +290,25 @@ class ContentEnhancer:
                     files_skipped += 1
                     continue
 
-                enhanced_content = await self.enhance_content(original_content, filename)
+                prepared.append((filename, self.prepare_content(original_content, filename)))
+
+            except Exception as e:
+                self.logger.error(f'Error processing {filename}: {str(e)}')
+
+        prompts = [
+            self._create_definition_prompt(content['original_content'], content['linked_content'])
+            for _, content in prepared
+        ]
+
+        # every file is saved as soon as its answer arrives, an interrupted run keeps what is done
+        def save(answer):
+            nonlocal files_processed
+            filename, enhanced_content = prepared[answer.index]
+            try:
+                if answer.ok:
+                    enhanced_content['new_content'] = answer.text
+                else:
+                    enhanced_content['new_content'] = f'Definition generation failed: {answer.error}'
                 save_json(enhanced_content,self.output_dir / f'{filename}_en.json')
                 self.save_enhanced_content(enhanced_content, filename)
                 files_processed += 1
@@ -279,11 +316,24 @@ class ContentEnhancer:
             except Exception as e:
                 self.logger.error(f'Error processing {filename}: {str(e)}')
 
+        await self.model.ask_many(prompts, concurrency=concurrency, on_item=save)
+
         self.logger.info(
             f'\nProcessing complete! {files_processed} files were enhanced, {files_skipped} files were skipped.'
         )
 
 
+async def main(directory):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    enhancer = ContentEnhancer(logging.getLogger('content_enhancer'), directory)
+    try:
+        await enhancer.process_files()
+    finally:
+        # drain the pooled connections before the loop goes away
+        await close_transport()
+
+
 if __name__ == '__main__':
     # Set up paths
     source_dir = r'c:\git\prompts\scraped\poznaj_madar\blog_posts'
+    asyncio.run(main(pathlib.Path(source_dir).parent))
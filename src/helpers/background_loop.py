@@ -0,0 +1,77 @@
+import asyncio
+import atexit
+import os
+import threading
+
+from src.helpers.transport import close_transport
+
+
+class BackgroundLoop:
+    """Event loop running forever in a daemon thread, the home of every sync wrapper call.
+
+    Coroutines submitted from any thread share the loop, so the pooled clients,
+    rate limiters and in-flight coalescing of that loop survive across calls.
+    """
+
+    def __init__(self, name='llm-loop') -> None:
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            # a forked child inherits the loop object but not its thread
+            if self.loop is None or self.pid != os.getpid() or not self.thread.is_alive():
+                ready = threading.Event()
+                self.loop = asyncio.new_event_loop()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.serve, args=(self.loop, ready), name=self.name, daemon=True)
+                self.thread.start()
+                ready.wait()
+            return self.loop
+
+    def serve(self, loop, ready) -> None:
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def run(self, coro, timeout=None):
+        """Run `coro` on the loop and block the calling thread until it returns or raises."""
+        loop = self.start()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError(f'{self.name}: a sync wrapper was called from inside the background loop')
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # timeout or KeyboardInterrupt in the caller cancels the coroutine too
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        """Close the pooled clients of the loop and stop its thread."""
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            if loop is None or self.pid != os.getpid() or not thread.is_alive():
+                return
+            self.loop = None
+        try:
+            asyncio.run_coroutine_threadsafe(close_transport(), loop).result(10)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(10)
+
+
+_background = BackgroundLoop()
+atexit.register(_background.stop)
+
+
+def run_sync(coro, timeout=None):
+    """Result of `coro` for synchronous callers, computed on the shared background loop."""
+    return _background.run(coro, timeout)
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import httpx
+
+from src.helpers.circuit_breaker import call_deadline, get_breaker
+from src.helpers.transport import get_transport
+
+OPENAI_DONE = {'completed', 'failed', 'expired', 'cancelled'}
+GEMINI_DONE = {'BATCH_STATE_SUCCEEDED', 'BATCH_STATE_FAILED', 'BATCH_STATE_CANCELLED', 'BATCH_STATE_EXPIRED'}
+
+
+class BatchJobException(Exception):
+    def __init__(self, code, message) -> None:
+        self.code = code
+        self.message = message
+        super().__init__(f'Error {code}:{message}')
+
+
+class BatchJob:
+    """Asynchronous provider batch job (OpenAI Batch, Anthropic Message Batches, Gemini batch mode).
+
+    The payloads are built by the connector as for `ask`, without context cache
+    references that may expire before the job runs. The mapping of caller ids to
+    request ids, the uploaded input file and the job id are kept in `state_file` as
+    soon as they are known, so a restarted process picks up where the previous one
+    stopped instead of submitting again.
+    """
+
+    def __init__(self, logger, connector, state_file, base_url=None, poll_interval=60) -> None:
+        self.logger = logger
+        self.connector = connector
+        self.state_file = str(state_file)
+        self.poll_interval = poll_interval
+        parts = urlsplit(connector.api_url)
+        self.base_url = (base_url or f'{parts.scheme}://{parts.netloc}').rstrip('/')
+        self.provider = self.detect_provider()
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+            if self.state.get('provider') != self.provider or self.state.get('model') != connector.model:
+                raise BatchJobException(409, f'{self.state_file} belongs to another provider or model')
+
+    @property
+    def job_id(self):
+        return self.state.get('job_id')
+
+    @property
+    def status(self):
+        return self.state.get('status')
+
+    def detect_provider(self) -> str:
+        if self.connector.google:
+            return 'gemini'
+        if self.connector.claude:
+            return 'anthropic'
+        if 'api.openai.com' in self.connector.api_url:
+            return 'openai'
+        raise BatchJobException(400, f'{self.connector.model} has no batch endpoint')
+
+    def save(self) -> None:
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp, self.state_file)
+
+    def url(self, path: str) -> str:
+        return f'{self.base_url}{path}'
+
+    def headers(self, json_body=True) -> dict:
+        headers = {k: v for k, v in self.connector.headers.items() if k.lower() != 'content-type'}
+        if json_body:
+            headers['content-type'] = 'application/json'
+        return headers
+
+    async def request(self, method, path, **kwargs):
+        """One call of the batch API within the connector's timeouts, guarded by the breaker of its batch API."""
+        url = self.url(path) if path.startswith('/') else path
+        client = get_transport().client(url)
+        breaker = get_breaker(f'{self.base_url}/batches', self.connector.model)
+        if not breaker.allow():
+            raise BatchJobException(503, f'{self.provider} batch API circuit open for {breaker.retry_in():.0f}s')
+        timeouts = self.connector.timeouts
+        deadline = call_deadline(timeouts.total)
+        kwargs.setdefault('headers', self.headers())
+        try:
+            response = await asyncio.wait_for(
+                client.request(method, url, timeout=deadline.timeout(timeouts), **kwargs), deadline.remaining()
+            )
+        except (httpx.TransportError, asyncio.TimeoutError) as e:
+            breaker.failure()
+            code = 503 if isinstance(e, httpx.ConnectError) else 408
+            raise BatchJobException(code, f'{self.provider} batch {method} {path} {type(e).__name__}') from e
+        except BaseException:
+            breaker.abandon()
+            raise
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        if response.status_code != 200:
+            self.logger.error(f'{self.provider} batch {method} {path} code={response.status_code} {response.text}')
+            raise BatchJobException(response.status_code, f'{self.provider} batch {method} {path}')
+        return response
+
+    async def submit(self, prompts: dict) -> str:
+        """Submit {caller_id: prompt} as one batch job and return the provider job id."""
+        if self.job_id:
+            raise BatchJobException(409, f'{self.state_file} already tracks job {self.job_id}')
+        ids = self.state.get('ids')
+        if self.status != 'submitting' or sorted(ids.values()) != sorted(prompts):
+            ids = {f'req-{n}': caller_id for n, caller_id in enumerate(prompts)}
+            # written before the first upload, a rerun after a crash resumes this submission
+            self.state = {
+                'provider': self.provider,
+                'model': self.connector.model,
+                'ids': ids,
+                'status': 'submitting',
+                'submitted': datetime.now().isoformat(),
+            }
+            self.save()
+        # a context cache may expire long before the provider runs the job
+        requests = [
+            (request_id, self.connector.build_payload(prompts[ids[request_id]], context_cache=False))
+            for request_id in ids
+        ]
+        submit = getattr(self, f'submit_{self.provider}')
+        job_id = await submit(requests)
+        self.state['job_id'] = job_id
+        self.state['status'] = 'submitted'
+        self.save()
+        self.logger.info(f'{self.provider} batch {job_id} submitted with {len(ids)} requests')
+        return job_id
+
+    async def submit_openai(self, requests) -> str:
+        endpoint = urlsplit(self.connector.api_url).path
+        lines = [
+            json.dumps({'custom_id': request_id, 'method': 'POST', 'url': endpoint, 'body': body}, ensure_ascii=False)
+            for request_id, body in requests
+        ]
+        file_id = self.state.get('input_file_id')
+        if not file_id:
+            upload = await self.request(
+                'POST',
+                '/v1/files',
+                headers=self.headers(json_body=False),
+                data={'purpose': 'batch'},
+                files={'file': ('batch.jsonl', '\n'.join(lines).encode('utf-8'), 'application/jsonl')},
+            )
+            file_id = upload.json()['id']
+            self.state['input_file_id'] = file_id
+            self.save()
+        batch = await self.request(
+            'POST',
+            '/v1/batches',
+            json={'input_file_id': file_id, 'endpoint': endpoint, 'completion_window': '24h'},
+        )
+        return batch.json()['id']
+
+    async def submit_anthropic(self, requests) -> str:
+        body = {'requests': [{'custom_id': request_id, 'params': params} for request_id, params in requests]}
+        batch = await self.request('POST', '/v1/messages/batches', json=body)
+        return batch.json()['id']
+
+    async def submit_gemini(self, requests) -> str:
+        model = urlsplit(self.connector.api_url).path.split('/models/')[1].split(':')[0]
+        body = {
+            'batch': {
+                'display_name': f'{model}-{datetime.now():%Y%m%d%H%M%S}',
+                'input_config': {
+                    'requests': {
+                        'requests': [
+                            {'request': payload, 'metadata': {'key': request_id}} for request_id, payload in requests
+                        ]
+                    }
+                },
+            }
+        }
+        operation = await self.request('POST', f'/v1beta/models/{model}:batchGenerateContent', json=body)
+        return operation.json()['name']
+
+    async def poll(self) -> bool:
+        """Refresh the job status, True when the provider finished the job."""
+        if not self.job_id:
+            raise BatchJobException(404, 'no batch job submitted')
+        if self.provider == 'openai':
+            job = (await self.request('GET', f'/v1/batches/{self.job_id}')).json()
+            self.state['status'] = job['status']
+            self.state['output_file_id'] = job.get('output_file_id')
+            self.state['error_file_id'] = job.get('error_file_id')
+            done = job['status'] in OPENAI_DONE
+        elif self.provider == 'anthropic':
+            job = (await self.request('GET', f'/v1/messages/batches/{self.job_id}')).json()
+            self.state['status'] = job['processing_status']
+            self.state['results_url'] = job.get('results_url')
+            done = job['processing_status'] == 'ended'
+        else:
+            job = (await self.request('GET', f'/v1beta/{self.job_id}')).json()
+            self.state['status'] = job.get('metadata', {}).get('state', 'BATCH_STATE_RUNNING')
+            done = job.get('done', False) or self.state['status'] in GEMINI_DONE
+            if done:
+                self.state['operation'] = job
+        self.save()
+        return done
+
+    async def wait(self) -> dict:
+        """Poll until the job ends and return its results."""
+        while not await self.poll():
+            self.logger.debug(f'{self.provider} batch {self.job_id} {self.status}')
+            await asyncio.sleep(self.poll_interval)
+        return await self.results()
+
+    async def results(self) -> dict:
+        """Map every caller id to {'text', 'error', 'tokens'}; requests without an answer carry an error."""
+        responses = await getattr(self, f'fetch_{self.provider}')()
+        results = {}
+        for request_id, caller_id in self.state['ids'].items():
+            body, error = responses.get(request_id, (None, f'no result, batch {self.status}'))
+            item = {'text': None, 'error': error, 'tokens': 0}
+            if body is not None:
+                try:
+                    item['text'] = self.connector.get_text(body)
+                    usage = self.connector.get_usage(body)
+                    item['tokens'] = self.connector.get_total_tokens(usage) if usage else 0
+                except Exception as e:
+                    item['error'] = str(e)
+            results[caller_id] = item
+        return results
+
+    def jsonl(self, text):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    async def fetch_openai(self) -> dict:
+        responses = {}
+        for file_id in (self.state.get('output_file_id'), self.state.get('error_file_id')):
+            if not file_id:
+                continue
+            content = await self.request('GET', f'/v1/files/{file_id}/content')
+            for line in self.jsonl(content.text):
+                response = line.get('response') or {}
+                if response.get('status_code') == 200:
+                    responses[line['custom_id']] = (response['body'], None)
+                else:
+                    responses[line['custom_id']] = (None, str(line.get('error') or response.get('body')))
+        return responses
+
+    async def fetch_anthropic(self) -> dict:
+        responses = {}
+        if not self.state.get('results_url'):
+            return responses
+        content = await self.request('GET', self.state['results_url'])
+        for line in self.jsonl(content.text):
+            result = line['result']
+            if result['type'] == 'succeeded':
+                responses[line['custom_id']] = (result['message'], None)
+            else:
+                responses[line['custom_id']] = (None, str(result.get('error') or result['type']))
+        return responses
+
+    async def fetch_gemini(self) -> dict:
+        operation = self.state.get('operation') or {}
+        output = operation.get('response') or operation.get('metadata', {}).get('output') or {}
+        responses = {}
+        for index, line in enumerate(output.get('inlinedResponses', {}).get('inlinedResponses', [])):
+            # responses keep request order when metadata is not echoed back
+            key = line.get('metadata', {}).get('key', f'req-{index}')
+            if 'response' in line:
+                responses[key] = (line['response'], None)
+            else:
+                responses[key] = (None, str(line.get('error')))
+        return responses
@@ -1,13 +1,31 @@
 import asyncio
-import os
-import re
+import copy
+import hashlib
+import inspect
+import random
 import json
-import aiohttp
-from datetime import datetime
+import time
+from urllib.parse import urlsplit
 
 import httpx
 
-from src.helpers.string_helper import find_between
+from src.helpers.background_loop import run_sync
+from src.helpers.batch_jobs import BatchJob
+from src.helpers.circuit_breaker import CHAT_TIMEOUTS, call_deadline, endpoint, get_breaker
+from src.helpers.json_schema import compile_schema, failing_fields, sub_schema
+from src.helpers.providers import ConnectorException, get_spec
+from src.helpers.rate_limiter import RETRY_STATUS, backoff_delay, retry_after
+from src.helpers.response_cache import ResponseCache, shared_cache
+from src.helpers.single_flight import get_flights
+from src.helpers.string_helper import json_resume_point, stitch
+from src.helpers.telemetry import RequestMetrics, observe
+from src.helpers import token_budget
+from src.helpers.transport import get_transport
+
+
+# Gemini prefixes from this size on are stored as cachedContents, smaller ones rely on implicit caching
+GEMINI_CONTEXT_CACHE_MIN_CHARS = 16000
+GEMINI_CONTEXT_CACHE_TTL = 3600
 
 
 class ConnectorInsufficientQuota(Exception):
@@ -17,364 +35,765 @@ class ConnectorInsufficientQuota(Exception):
         super().__init__(f'Error {model} Insufficient Quota {code}:{message}')
 
 
-class ConnectorException(Exception):
-    def __init__(self, code, message) -> None:
-        self.code = code
-        self.message = message
-        super().__init__(f'Error {code}:{message}')
+class ConnectorCircuitOpen(ConnectorException):
+    """The endpoint's circuit breaker is open, the request was not sent."""
+
+    def __init__(self, message) -> None:
+        super().__init__(503, message)
+
+
+class StructuredPrompt:
+    """Prompt split into a static, cacheable prefix and the per-call question.
+
+    Connectors send the prefix first and unchanged so provider prompt caches can
+    reuse it; `str()` gives the plain concatenated prompt.
+    """
+
+    def __init__(self, prefix: str, question: str) -> None:
+        self.prefix = prefix
+        self.question = question
+
+    def __str__(self) -> str:
+        return f'{self.prefix}{self.question}'
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.question)
+
+
+class AskItem:
+    """Outcome of one prompt of ChatConnector.ask_many."""
+
+    def __init__(self, index, prompt, text=None, error=None, tokens=0, duration=0.0, cached_tokens=0) -> None:
+        self.index = index
+        self.prompt = prompt
+        self.text = text
+        self.error = error
+        self.tokens = tokens
+        self.cached_tokens = cached_tokens
+        self.duration = duration
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class AskOptions:
+    """Per-request settings of ChatConnector.ask; None falls back to the model spec."""
+
+    def __init__(
+        self,
+        extract_json=None,
+        thinking=False,
+        cache=True,
+        continuations=0,
+        schema=None,
+        timeout=None,
+        coalesce=True,
+    ) -> None:
+        self.extract_json = extract_json
+        self.thinking = thinking
+        # False skips the response cache for this request
+        self.cache = cache
+        # follow-up requests that continue an answer cut at the output limit, 0 fails with 701
+        self.continuations = continuations
+        # JSON schema enforced through the provider's structured output mode
+        self.schema = schema
+        # seconds the whole request may take including retries, within any `deadline` scope
+        self.timeout = timeout
+        # False sends the request even when an identical one is in flight, e.g. to draw several samples
+        self.coalesce = coalesce
+
+    def replace(self, **changes) -> 'AskOptions':
+        return AskOptions(**{**vars(self), **changes})
+
+
+DEFAULT_OPTIONS = AskOptions()
+
+
+class AskResult:
+    """Answer of one ChatConnector.ask call."""
+
+    def __init__(
+        self, text, raw=None, usage=None, model=None, billed_tokens=0, cached_tokens=0, cache_hit=False, duration=0.0
+    ) -> None:
+        self.text = text
+        self.raw = raw
+        self.usage = usage
+        self.model = model
+        self.billed_tokens = billed_tokens
+        self.cached_tokens = cached_tokens
+        self.cache_hit = cache_hit
+        self.duration = duration
+        # shared the answer of an identical request in flight; the tokens are billed to that request
+        self.coalesced = False
+        # parsed answer of ask_structured
+        self.value = None
+
+    def __str__(self) -> str:
+        return self.text or ''
 
 
 class ChatConnector:
-    def __init__(self, logger, verbose=False) -> None:
+    """Client of one chat model.
+
+    The model is an immutable ModelSpec and every request carries its own
+    AskOptions and AskResult, so one connector can serve many concurrent
+    requests over the shared connection pool. `billed_tokens` and
+    `cached_tokens` are running totals of all requests.
+
+    While the circuit breaker of the model endpoint is open requests fail fast
+    with ConnectorCircuitOpen, or go to the `fallback` model when one is set.
+    """
+
+    def __init__(self, logger, verbose=False, cache=None, fallback=None) -> None:
         self.logger = logger
-        self.response_format = False
+        # opt-in response cache, by default the one named by LLM_CACHE_PATH, False disables it
+        self.cache = cache if cache is not None else shared_cache()
+        self.cache_bypass = False
+        self.max_retries = 6
+        self.timeouts = CHAT_TIMEOUTS
+        self.fallback = fallback
+        self.fallback_chat = None
+        self.context_caches = {}
         self.billed_tokens = 0
+        self.cached_tokens = 0
         self.no_stream = False
-        self.last_response = None
         self.verbose = verbose
-        self.thinking = False
-        self.reset()
-        self.system_role = False
-        self.extract_json = False
-        self.google = False
-        self.client = httpx.AsyncClient()
-        
-        self.initOpenAI4o()
-
-    async def close(self):
-        if self.client:
-            #await self.client.close()
-            self.client = None
-        self.reset()
-
-    def reset(self):
-        self.system_role = False
-        self.extract_json = True
-        self.google = False
-        self.claude = False
-        self.response_format = False
 
+        self.init_model('openai4o')
 
-    def init_model(self, model):
-        if model == 'claude':
-            self.initAntrophic()
-        if model == 'google':
-            self.initGemini15Flash()
-        if model == 'together':
-            self.initTogether('ll')
-        if model == 'gemini':
-            self.initGemini25Flash()
-        if model == 'o1-mini':
-            self.initOpenAIo1()
-        if model == '4o-mini':
-            self.initOpenAI4omini()
-        if model == 'o3-mini':
-            self.initOpenAIo3mini()
-        if model == 'openai':
-            self.initOpenAI4o()
-        if model == 'openai4o':
-            self.initOpenAI4o()
-        if model == 'openai41nano':
-            self.initOpenAI41('gpt-4.1-nano')
-        if model == 'openai41mini':
-            self.initOpenAI41('gpt-4.1-mini')
-        if model == 'openai41':
-            self.initOpenAI41('gpt-4.1')
-        if model == 'phi4':
-            self.initAzurePhi4()
-
-    def initOpenAI4o(self):
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY key is not set. ')
-
-        self.api_url = 'https://api.openai.com/v1/chat/completions'
-        self.headers = {'Authorization': f'Bearer {self.api_key}', 'Content-type': 'application/json'}
-        self.model = 'gpt-4o'
-        self.response_format = True
-    def initOpenAI41(self, model):
-        self.reset()
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY key is not set. ')
-
-        self.api_url = 'https://api.openai.com/v1/responses'
-        self.headers = {'Authorization': f'Bearer {self.api_key}', 'Content-type': 'application/json'}
+    @property
+    def model(self):
+        return self.spec.model
 
-        self.model = model
-        self.response_format = 'json'
-        self.system_role = 'responses'
-        self.extract_json = True
-
-    def initOpenAI4omini(self):
-        self.reset()
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY key is not set. ')
-
-        self.api_url = 'https://api.openai.com/v1/chat/completions'
-        self.headers = {'Authorization': f'Bearer {self.api_key}', 'Content-type': 'application/json'}
-        self.model = 'gpt-4o-mini'
-        self.response_format = True
-
-    def initOpenAIo1(self):
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY key is not set. ')
-
-        self.api_url = 'https://api.openai.com/v1/chat/completions'
-        self.headers = {'Authorization': f'Bearer {self.api_key}', 'Content-type': 'application/json'}
-        self.model = 'o1-mini'
-        self.extract_json = True
-        self.response_format = False
-    
-    def initOpenAIo3mini(self):
-        self.reset()
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY key is not set. ')
-
-        self.api_url = 'https://api.openai.com/v1/chat/completions'
-        self.headers = {'Authorization': f'Bearer {self.api_key}', 'Content-type': 'application/json'}
-        self.model = 'o3-mini'
-        self.extract_json = True
-        self.response_format = False
-
-    def initAntrophic(self, model='claude-3-5-sonnet-20240620'):
-        self.reset()
-        self.system_role = 'external'
-        self.response_format = False
-        self.model = model
-        self.claude = True
-        self.extract_json = True
-        self.api_key = os.getenv('ANTHROPIC_API_KEY')
-        if self.api_key is None:
-            raise ValueError('ANTHROPIC_API_KEY key is not set. ')
-        self.api_url = 'https://api.anthropic.com/v1/messages'
-        self.headers = {
-            'x-api-key': self.api_key,
-            'content-type': 'application/json',
-            'anthropic-version': '2023-06-01',
-            'anthropic-beta': 'prompt-caching-2024-07-31',
-        }
+    @property
+    def api_url(self):
+        return self.spec.api_url
 
-    def initGemini15Flash(self):
-        self.model = 'google'
-        self.response_format = False
-        self.api_key = os.getenv('GOOGLE_API_KEY')
-        self.google = True
-        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={self.api_key}'
-        self.headers = {
-            'content-type': 'application/json',
-        }
+    @property
+    def headers(self):
+        return self.spec.headers
 
-    def initGemini20Flash(self):
-        self.reset()
-        self.model = 'gemini'
-        self.response_format = False
-        self.api_key = os.getenv('GOOGLE_API_KEY')
-        self.google = True
-        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}'
-        self.headers = {
-            'content-type': 'application/json',
-        }
+    @property
+    def api_key(self):
+        return self.spec.api_key
 
-    def initGemini25Flash(self):
-        self.reset()
-        self.model = 'gemini'
-        self.extract_json = True
-        self.api_key = os.getenv('GOOGLE_API_KEY')
-        self.google = True
-        # self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-04-17:generateContent?key={self.api_key}'
-        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={self.api_key}'
-        self.headers = {
-            'content-type': 'application/json',
-        }
-    def initAzurePhi4(self):
-        self.reset()
-        self.model = 'Phi-4'
-        self.extract_json = True
-        self.api_key = os.getenv('GITHUB_API_KEY')
-        self.api_url = 'https://models.inference.ai.azure.com/chat/completions'
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.api_key}',
-        }
+    @property
+    def adapter(self):
+        return self.spec.adapter
 
-    def initTogether(self, model: str):
-        self.reset()
-        self.model = model
-        self.api_key = os.getenv('TOGETHER_API_KEY')
-        self.api_url = 'https://api.together.xyz/v1/chat/completions'
-        self.headers = {
-            'Authorization': f'Bearer {self.api_key}',
-            'content-type': 'application/json',
-            'accept': 'application/json',
-        }
+    @property
+    def google(self):
+        return self.spec.google
 
-    def ask_sync(self, user_content: str) -> str:
-        asyncio.run(self.ask(user_content))
-        return self.last_text
-    async def ask_safe(self, user_content: str) -> str:
-        #self.client = aiohttp.ClientSession()
-        try:
-            return await self.ask(user_content)
-        finally:
-            await self.close()
-        # Save the result to a file or database
-
-    async def ask(self, user_content: str) -> str:
-        messages = [{'role': 'user', 'content': user_content}]
-        json_data = {'messages': messages, 'temperature': 0.01, 'max_tokens': 16380}
-        if self.system_role == 'responses':
-            json_data = {
-                'input': user_content,
-                'temperature': 0.01,
-                'model': self.model,
-            }
-        if self.model:
-            json_data['model'] = self.model
-        if self.no_stream:
+    @property
+    def claude(self):
+        return self.spec.claude
+
+    @property
+    def system_role(self):
+        return self.spec.system_role
+
+    @property
+    def response_format(self):
+        return self.spec.response_format
+
+    @property
+    def extract_json(self):
+        return self.spec.extract_json
+
+    @property
+    def client(self):
+        return get_transport().client(self.api_url)
+
+    async def preconnect(self):
+        await get_transport().preconnect([self.api_url])
+
+    def init_model(self, model):
+        """Switch to a model registered in providers.MODELS."""
+        self.spec = get_spec(model)
+
+    def ask_sync(self, user_content: str, options=None) -> AskResult:
+        """Blocking `ask` for sync callers; runs on the shared background loop to reuse its connections."""
+        return run_sync(self.ask(user_content, options))
+
+    async def ask_safe(self, user_content: str, options=None) -> AskResult:
+        # the pooled client is shared with other connectors, entry points close it with close_transport
+        return await self.ask(user_content, options)
+
+    def wants_json(self, options) -> bool:
+        options = options or DEFAULT_OPTIONS
+        return self.extract_json if options.extract_json is None else options.extract_json
+
+    def build_payload(self, user_content, context_cache=True, options=None) -> dict:
+        options = options or DEFAULT_OPTIONS
+        prefix, question = self.split_prompt(user_content)
+        cached_content = None
+        if prefix and context_cache and self.google:
+            cached = self.context_caches.get(self.context_cache_key(prefix))
+            cached_content = cached[0] if cached else None
+        schema = options.schema
+        if schema and not self.adapter.structured_output:
+            instruction = 'Answer with a single JSON object matching this JSON schema:'
+            question = f'{question}\n\n{instruction}\n{json.dumps(schema)}'
+        json_data = self.adapter.build_payload(
+            self.spec, prefix, question, self.wants_json(options), options.thinking, cached_content, schema
+        )
+        if self.no_stream and not self.google:
             json_data['stream'] = False
-        if self.extract_json:
-            if self.response_format == 'json':
-                json_data['text'] = {'format': {'type': 'json_object'}}
-            elif self.response_format:
-                json_data['response_format'] = {'type': 'json_object'}
-        if self.system_role == 'external':
-            json_data['messages'] = [{'role': 'user', 'content': user_content}]
-            # json_data['system'] = self.system_text
-        if (self.model == 'o1-mini') or (self.model == 'o3-mini'):
-            del json_data['temperature']
-            del json_data['max_tokens']
-        if self.model == 'o3-mini':
-            del json_data['temperature']
-            del json_data['max_tokens']
-        if self.model == 'Phi-4':
-            json_data = {
-                'messages': messages,
-                'temperature': 1.0,
-                # 'topK': 0,
-                'top_p': 1.0,
-                'max_tokens': 8192,
-                'model': 'Phi-4',
-                'repetition_penalty': 1,
-            }
-        if self.google:
-            json_data = {
-                'contents': [{'parts': [{'text': user_content}]}],
-                'generationConfig': {
-                    'temperature': 0,
-                    'topK': 40,
-                    'topP': 0.95,
-                    'maxOutputTokens': 8192,
-                    'responseMimeType': 'text/plain',
-                },
-            }
-            if not self.thinking:
-                json_data['generationConfig']['thinkingConfig'] = {'thinkingBudget': 0}
-        # print(json_data)
-        start = datetime.now()
-
-        response = await self.client.post(self.api_url, json=json_data, headers=self.headers, timeout=180)
-        _duration = (datetime.now() - start).total_seconds()
-        # self.logger.debug(
-        #    f'{self.model} ask len={len(user_content)} response code={response.status_code} len={len(response.text)}  duration: {_duration}'
-        # )
-        if response.status_code == 529:
-            return f'{"error":"529","message":"{response.text}"}'
-        if response.status_code == 429:
-            self.logger.error(f'{self.model} ask error code={response.status_code} {response.text}')
-            raise ConnectorInsufficientQuota(self.model, 429, 'Too many requests')
+        return json_data
+
+    def split_prompt(self, user_content):
+        if isinstance(user_content, StructuredPrompt):
+            return user_content.prefix, user_content.question
+        return '', user_content
+
+    def context_cache_key(self, prefix: str):
+        return self.api_url, hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+    async def prepare_context_cache(self, user_content) -> None:
+        """Store a big Gemini prefix as cachedContents so later requests only send the question."""
+        prefix, _ = self.split_prompt(user_content)
+        # cachedContents belong to the project of one key, a pool of keys relies on implicit caching
+        if not self.google or len(prefix) < GEMINI_CONTEXT_CACHE_MIN_CHARS or len(self.spec.keys) > 1:
+            return
+        key = self.context_cache_key(prefix)
+        cached = self.context_caches.get(key)
+        if cached and cached[1] > time.time() + 60:
+            return
+        base = self.api_url.split('/models/')[0]
+        body = {
+            'model': f'models/{self.api_url.split("/models/")[1].split(":")[0]}',
+            'systemInstruction': {'parts': [{'text': prefix}]},
+            'ttl': f'{GEMINI_CONTEXT_CACHE_TTL}s',
+        }
+        try:
+            response = await self.client.post(f'{base}/cachedContents', json=body, headers=self.headers)
+        except Exception as e:
+            self.logger.warning(f'{self.model} context cache failed: {e}')
+            return
+        if response.status_code != 200:
+            self.logger.warning(f'{self.model} context cache code={response.status_code} {response.text}')
+            return
+        self.context_caches[key] = (response.json()['name'], time.time() + GEMINI_CONTEXT_CACHE_TTL)
+
+    def cache_key(self, json_data, options=None):
+        if not self.cache or self.cache_bypass or not (options or DEFAULT_OPTIONS).cache:
+            return None
+        return self.cache.make_key(self.model, self.api_url, json_data)
+
+    def cached_result(self, key, options=None, metrics=None):
+        """Serve a stored response; cache hits are not billed."""
+        _json = self.cache.get(key) if key else None
+        if _json is None:
+            return None
+        if metrics:
+            metrics.cache_hit = True
+        self.logger.debug('%s cache hit %s', self.model, key[:12])
+        return AskResult(
+            self.get_text(_json, options), raw=_json, usage=self.get_usage(_json), model=self.model, cache_hit=True
+        )
+
+    def new_metrics(self, url) -> RequestMetrics:
+        return RequestMetrics('chat', self.model, urlsplit(url).path)
+
+    async def send(self, url, json_data, estimated_tokens, stream=False, metrics=None, deadline=None):
+        """POST through the rate limiter of the freest key of the pool, retrying 429/5xx with backoff.
+
+        A 429 takes its key out of rotation for the cooldown and retries at once on
+        another key when one is free. Attempts use the connect/read/write timeouts
+        of `self.timeouts`, all of them end by `deadline` (default: the total timeout).
+        5xx answers and timeouts count against the endpoint circuit breaker.
+        A streamed response is returned open and must be closed by the caller;
+        `settle` books its billed tokens on the key used.
+        """
+        pool = self.spec.keys
+        client = self.client
+        breaker = get_breaker(url, self.model)
+        deadline = deadline or call_deadline(self.timeouts.total)
+        metrics = metrics or self.new_metrics(url)
+        for attempt in range(self.max_retries + 1):
+            # fail fast before spending rate limit budget, and wait for that budget no longer than the deadline
+            if deadline.expired:
+                raise ConnectorException(408, f'{self.model} deadline exceeded after {attempt} attempts')
+            if not breaker.allow():
+                raise ConnectorCircuitOpen(f'{self.model} {endpoint(url)} circuit open for {breaker.retry_in():.0f}s')
+            try:
+                key = await pool.acquire(estimated_tokens, deadline.remaining())
+            except asyncio.TimeoutError as e:
+                breaker.abandon()
+                raise ConnectorException(408, f'{self.model} rate limit leaves no time before the deadline') from e
+            except BaseException:
+                breaker.abandon()
+                raise
+            limiter = pool.limiter(key)
+            request = client.build_request(
+                'POST', url, json=json_data, headers=pool.headers(key), timeout=deadline.timeout(self.timeouts)
+            )
+            metrics.request_bytes = len(request.content)
+            metrics.retries = attempt
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(client.send(request, stream=True), deadline.remaining())
+                metrics.time_to_headers = time.perf_counter() - start
+                if not stream:
+                    await asyncio.wait_for(response.aread(), deadline.remaining())
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                breaker.failure()
+                error = f'{type(e).__name__} {e}'.strip()
+                if attempt == self.max_retries or deadline.expired:
+                    code = 503 if isinstance(e, httpx.ConnectError) else 408
+                    raise ConnectorException(code, f'{self.model} {error}') from e
+                delay = min(backoff_delay(attempt), deadline.remaining())
+                self.logger.warning(f'{self.model} {error}, retry {attempt + 1} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.abandon()
+                raise
+            metrics.status = response.status_code
+            limiter.observe(response.headers)
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                break
+            delay = retry_after(response.headers)
+            delay = backoff_delay(attempt) if delay is None else delay + random.uniform(0, 1)
+            await response.aclose()
+            if response.status_code == 429:
+                pool.cooldown(key, delay)
+                if pool.available():
+                    self.logger.info(f'{self.model} status 429, switching key for {delay:.1f}s cooldown')
+                    continue
+            if delay >= deadline.remaining():
+                raise ConnectorException(408, f'{self.model} status {response.status_code}, no time left to retry')
+            self.logger.warning(f'{self.model} status {response.status_code}, retry {attempt + 1} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+        if not stream or response.status_code != 200:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            metrics.response_bytes = len(response.content)
         if response.status_code != 200:
             self.logger.error(f'{self.model} ask error code={response.status_code} {response.text}')
+            if response.status_code == 429:
+                raise ConnectorInsufficientQuota(self.model, 429, 'Too many requests')
+            if response.status_code == 529:
+                raise ConnectorException(529, f'{self.model} overloaded')
+            raise ConnectorException(response.status_code, f'{self.model} ask len={len(str(json_data))}')
+        response.extensions['rate_limiter'] = limiter
+        return response
+
+    def settle(self, response, billed_tokens, estimated_tokens) -> None:
+        """Correct the token budget of the key that served `response` by the billed tokens."""
+        response.extensions['rate_limiter'].record(billed_tokens, estimated_tokens)
+
+    def record_usage(self, result: AskResult, metrics) -> None:
+        """Fill the tokens of `result` and `metrics` from `result.usage` and add them to the totals."""
+        usage = result.usage
+        result.billed_tokens = self.get_total_tokens(usage) if usage else 0
+        result.cached_tokens = self.get_cached_tokens(usage)
+        tokens_in, tokens_out = self.get_token_split(usage)
+        metrics.tokens_in += tokens_in
+        metrics.tokens_out += tokens_out
+        metrics.cached_tokens += result.cached_tokens
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+
+    @property
+    def token_family(self) -> str:
+        return token_budget.token_family(self.api_url)
+
+    @property
+    def context_window(self) -> int:
+        return token_budget.MODEL_LIMITS.get(self.model, token_budget.DEFAULT_LIMITS)[0]
+
+    @property
+    def max_output_tokens(self) -> int:
+        return self.spec.max_output_tokens
+
+    def prompt_budget(self) -> int:
+        """Prompt tokens that still leave room for a full-length answer."""
+        return self.context_window - self.max_output_tokens
+
+    def estimate_tokens(self, user_content) -> int:
+        return token_budget.estimate_tokens(str(user_content), self.token_family)
+
+    def fit_sources(self, sources, template='', limit=None) -> list:
+        """Trim, truncate or drop `sources` so `template` plus sources fit the prompt budget (and `limit`)."""
+        budget = self.prompt_budget() - self.estimate_tokens(template)
+        if limit:
+            budget = min(budget, limit)
+        return token_budget.fit_sources(sources, budget, self.token_family)
+
+    def check_budget(self, user_content) -> int:
+        estimate = self.estimate_tokens(user_content)
+        if estimate > self.prompt_budget():
             raise ConnectorException(
-                response.status_code, f'{self.model} ask len={len(user_content)} duration: {_duration}'
+                413, f'{self.model} prompt of ~{estimate} tokens exceeds the budget of {self.prompt_budget()}'
             )
+        return estimate
+
+    def fallback_connector(self) -> 'ChatConnector':
+        if self.fallback_chat is None:
+            self.fallback_chat = ChatConnector(self.logger, self.verbose, cache=self.cache)
+            self.fallback_chat.init_model(self.fallback)
+        return self.fallback_chat
+
+    def flight_key(self, payload, options=None) -> str:
+        """Hash of everything that shapes the answer of `ask` to `payload`, its time limit included."""
+        options = options or DEFAULT_OPTIONS
+        shape = {
+            'payload': payload,
+            'json': self.wants_json(options),
+            'continuations': options.continuations,
+            'timeout': options.timeout,
+        }
+        return ResponseCache.make_key(self.model, self.api_url, shape)
+
+    async def ask(self, user_content, options=None) -> AskResult:
+        """Answer `user_content`; concurrent identical requests share one call.
+
+        A coalesced result carries no billed tokens, they are counted once on the
+        request that was sent.
+        """
+        if not (options or DEFAULT_OPTIONS).coalesce:
+            return await self.ask_once(user_content, options)
+        payload = self.build_payload(user_content, context_cache=False, options=options)
+        key = self.flight_key(payload, options)
+        # the flight runs within the deadline of the caller that started it, a joining caller keeps its own
+        deadline = call_deadline((options or DEFAULT_OPTIONS).timeout, self.timeouts.total)
+        try:
+            result, shared = await asyncio.wait_for(
+                get_flights().do(key, lambda: self.ask_once(user_content, options, payload)), deadline.remaining()
+            )
+        except asyncio.TimeoutError:
+            raise ConnectorException(408, f'{self.model} deadline exceeded') from None
+        # every caller gets its own copy to annotate
+        result = copy.copy(result)
+        if not shared:
+            return result
+        self.logger.debug('%s coalesced with a request in flight %s', self.model, key[:12])
+        result.billed_tokens = 0
+        result.cached_tokens = 0
+        result.duration = 0.0
+        result.coalesced = True
+        return result
+
+    async def ask_once(self, user_content, options=None, payload=None) -> AskResult:
+        """Answer `user_content`, from the fallback model while the circuit of this one is open.
+
+        `payload` is the request already built for it without a context cache, when the caller has one.
+        """
+        try:
+            return await self._ask(user_content, options, payload)
+        except ConnectorCircuitOpen as e:
+            if not self.fallback:
+                raise
+            self.logger.warning(f'{e}, failing over to {self.fallback}')
+        result = await self.fallback_connector().ask(user_content, options)
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+        return result
+
+    async def _ask(self, user_content, options=None, payload=None) -> AskResult:
+        deadline = call_deadline((options or DEFAULT_OPTIONS).timeout, self.timeouts.total)
+        with observe(self.new_metrics(self.api_url)) as metrics:
+            if payload is None:
+                payload = self.build_payload(user_content, context_cache=False, options=options)
+            key = self.cache_key(payload, options)
+            cached = self.cached_result(key, options, metrics)
+            if cached is not None:
+                return cached
+            # an oversized prompt fails before anything is sent, a context cache upload included
+            estimate = self.check_budget(user_content)
+            await self.prepare_context_cache(user_content)
+            # only a Gemini prefix stored as cachedContents changes the request
+            json_data = self.build_payload(user_content, options=options) if self.google else payload
+            response = await self.send(self.api_url, json_data, estimate, metrics=metrics, deadline=deadline)
+
+            _json = response.json()
+            self.logger.debug('%s', _json)
+            result = AskResult(None, raw=_json, usage=self.get_usage(_json), model=self.model)
+            self.record_usage(result, metrics)
+            self.settle(response, result.billed_tokens, estimate)
+            if (options or DEFAULT_OPTIONS).continuations and self.adapter.is_truncated(_json):
+                _json = await self.continue_answer(json_data, _json, estimate, options, result, metrics, deadline)
+            result.duration = time.perf_counter() - metrics.started
+            self.logger.debug(
+                '%s duration: %.2f billed: %s cached: %s',
+                self.model,
+                result.duration,
+                result.billed_tokens,
+                result.cached_tokens,
+            )
+            result.text = self.get_text(_json, options)
+            if key:
+                self.cache.put(key, _json)
+            return result
 
-        _json = response.json()
-        self.last_response = _json
-        self.logger.debug(str(_json))
-        self.billed_tokens = self.get_total_tokens(self.get_usage(_json))
-        self.logger.debug(
-            f' {self.model} duration: {_duration} billed: {self.billed_tokens} usage{self.get_usage(_json)}'
+    async def continue_answer(self, json_data, completion, estimate, options, result, metrics, deadline=None) -> dict:
+        """Continue a truncated answer with up to `options.continuations` follow-up requests.
+
+        JSON answers resume after their last complete element. Returns a response in
+        the provider's shape holding the stitched text; follow-ups add to `result` tokens.
+        """
+        text = self.adapter.partial_text(completion)
+        for attempt in range(options.continuations):
+            if self.wants_json(options):
+                text = text[: json_resume_point(text)]
+            self.logger.info('%s answer truncated at %s chars, continuation %s', self.model, len(text), attempt + 1)
+            follow_up = self.adapter.continue_payload(json_data, text)
+            tokens = estimate + self.estimate_tokens(text)
+            response = await self.send(self.api_url, follow_up, tokens, metrics=metrics, deadline=deadline)
+            completion = response.json()
+            step = AskResult(None, usage=self.get_usage(completion))
+            self.record_usage(step, metrics)
+            self.settle(response, step.billed_tokens, tokens)
+            result.billed_tokens += step.billed_tokens
+            result.cached_tokens += step.cached_tokens
+            # the Anthropic prefill resumes after the stripped partial
+            head = text.rstrip() if self.claude else text
+            text = stitch(head, self.adapter.partial_text(completion))
+            if not self.adapter.is_truncated(completion):
+                state = {'text': [text], 'usage': result.usage, 'finish': self.adapter.stop_reason, 'response': None}
+                result.raw = self.adapter.assemble_stream_response(state)
+                return result.raw
+        raise ConnectorException(
+            701, f'{self.model} answer still truncated after {options.continuations} continuations'
         )
-        self.last_text = self.get_text(_json)
-        return self.last_text
-    async def ask_json(self, user_content: str) -> dict:
-        self.extract_json = True
-        s = await self.ask(user_content)
-        return json.loads(s)
-
-    async def ask_text(self, user_content: str) -> dict:
-        self.client = aiohttp.ClientSession()
+
+    async def ask_many(self, prompts, concurrency=8, options=None, on_item=None) -> list:
+        """Ask every prompt with at most `concurrency` requests in flight.
+
+        Returns one AskItem per prompt in input order; a failing prompt carries its
+        exception instead of aborting the batch. `on_item(item)`, a function or a
+        coroutine function, gets every item as soon as it is answered, so callers can
+        save results while the rest is still in flight.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def ask_one(index, prompt):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    result = await self.ask(prompt, options)
+                    return AskItem(
+                        index,
+                        prompt,
+                        text=result.text,
+                        tokens=result.billed_tokens,
+                        cached_tokens=result.cached_tokens,
+                        duration=time.perf_counter() - start,
+                    )
+                except Exception as e:
+                    self.logger.error(f'{self.model} ask_many item {index} failed: {e}')
+                    return AskItem(index, prompt, error=e, duration=time.perf_counter() - start)
+
+        async def run(index, prompt):
+            item = await ask_one(index, prompt)
+            if on_item:
+                try:
+                    outcome = on_item(item)
+                    if inspect.isawaitable(outcome):
+                        await outcome
+                except Exception as e:
+                    self.logger.error(f'{self.model} ask_many item {index} handler failed: {e}')
+            return item
+
+        return await asyncio.gather(*(run(index, prompt) for index, prompt in enumerate(prompts)))
+
+    async def ask_batch(self, prompts: dict, state_file, base_url=None, poll_interval=60) -> dict:
+        """Answer {caller_id: prompt} through the provider's offline batch endpoint.
+
+        Submits the job unless `state_file` already tracks one, then polls until it
+        ends; calling again after a restart resumes polling. Returns {caller_id: AskItem}.
+        """
+        job = BatchJob(self.logger, self, state_file, base_url=base_url, poll_interval=poll_interval)
+        if not job.job_id:
+            await job.submit(prompts)
+        results = await job.wait()
+        items = {}
+        for index, caller_id in enumerate(prompts):
+            result = results.get(caller_id, {'text': None, 'error': 'missing in batch', 'tokens': 0})
+            items[caller_id] = AskItem(
+                index, prompts[caller_id], text=result['text'], error=result['error'], tokens=result['tokens']
+            )
+        self.billed_tokens += sum(item.tokens for item in items.values())
+        return items
+
+    async def ask_json(self, user_content: str, schema=None, options=None, repairs=1) -> dict:
+        if schema is None:
+            result = await self.ask(user_content, (options or DEFAULT_OPTIONS).replace(extract_json=True))
+            return json.loads(result.text)
+        result = await self.ask_structured(user_content, schema, options, repairs)
+        return result.value
+
+    async def ask_structured(self, user_content, schema, options=None, repairs=1) -> AskResult:
+        """Ask for an answer matching the JSON `schema`, in `result.value`.
+
+        The provider enforces the schema where it can; the answer is validated
+        locally and up to `repairs` follow-ups re-ask only for the missing or
+        invalid top-level fields. Raises 422 when the answer stays invalid.
+        """
+        options = (options or DEFAULT_OPTIONS).replace(extract_json=True, schema=schema)
+        validate = compile_schema(schema)
+        result = await self.ask(user_content, options)
+        value, errors = self.parse_structured(result.text, validate)
+        prefix, question = self.split_prompt(user_content)
+        for _ in range(repairs):
+            fields = failing_fields(errors) if isinstance(value, dict) else []
+            if not errors or not fields:
+                break
+            self.logger.info('%s re-asking for fields %s', self.model, fields)
+            problems = '; '.join(f'{"/".join(map(str, path))}: {message}' for path, message in errors)
+            current = {name: value[name] for name in fields if name in value}
+            repair = StructuredPrompt(
+                prefix,
+                f'{question}\n\nYour previous answer had problems in these fields: {problems}. '
+                f'Their previous values: {json.dumps(current, ensure_ascii=False)}. '
+                f'Answer again with only the fields {", ".join(fields)}.',
+            )
+            fix = await self.ask(repair, options.replace(schema=sub_schema(schema, fields)))
+            result.billed_tokens += fix.billed_tokens
+            result.cached_tokens += fix.cached_tokens
+            fixed, _ = self.parse_structured(fix.text, None)
+            if isinstance(fixed, dict):
+                value.update({name: fixed[name] for name in fields if name in fixed})
+            errors = validate(value)
+        if errors:
+            problems = '; '.join(f'{"/".join(map(str, path))}: {message}' for path, message in errors[:10])
+            raise ConnectorException(422, f'{self.model} answer does not match the schema: {problems}')
+        result.value = value
+        result.text = json.dumps(value, ensure_ascii=False)
+        return result
+
+    def parse_structured(self, text, validate):
         try:
-            self.extract_json = False
-            s = await self.ask(user_content)
-            return s
-        finally:
-            await self.close()
+            value = json.loads(text)
+        except (TypeError, ValueError) as e:
+            return None, [((), f'not JSON: {e}')]
+        return value, validate(value) if validate else []
+
+    async def ask_text(self, user_content: str) -> str:
+        result = await self.ask(user_content, AskOptions(extract_json=False))
+        return result.text
+
+    def stream_url(self) -> str:
+        return self.adapter.stream_url(self.spec)
+
+    def build_stream_payload(self, user_content: str, options=None) -> dict:
+        return self.adapter.stream_payload(self.build_payload(user_content, options=options))
+
+    async def ask_stream(self, user_content: str, options=None, result=None):
+        """Yield text deltas as the provider produces them.
+
+        When the stream ends the AskResult passed as `result` holds the full text and a
+        response assembled in the provider's non-streaming shape, as returned by `ask`.
+        """
+        result = result if result is not None else AskResult(None)
+        result.model = self.model
+        if self.fallback and get_breaker(self.stream_url(), self.model).is_open:
+            self.logger.warning(f'{self.model} circuit open, streaming from {self.fallback}')
+            async for delta in self.fallback_connector().ask_stream(user_content, options, result):
+                yield delta
+            self.billed_tokens += result.billed_tokens
+            self.cached_tokens += result.cached_tokens
+            return
+        deadline = call_deadline((options or DEFAULT_OPTIONS).timeout, self.timeouts.total)
+        with observe(self.new_metrics(self.stream_url())) as metrics:
+            key = self.cache_key(self.build_payload(user_content, context_cache=False, options=options), options)
+            cached = self.cached_result(key, options, metrics)
+            if cached is not None:
+                result.text, result.raw, result.usage, result.cache_hit = cached.text, cached.raw, cached.usage, True
+                yield cached.text
+                return
+            estimate = self.check_budget(user_content)
+            await self.prepare_context_cache(user_content)
+            json_data = self.build_stream_payload(user_content, options)
+            state = {'text': [], 'usage': None, 'finish': None, 'response': None}
+            response = await self.send(
+                self.stream_url(), json_data, estimate, stream=True, metrics=metrics, deadline=deadline
+            )
+            try:
+                async for event in self.sse_events(response):
+                    if deadline.expired:
+                        raise ConnectorException(408, f'{self.model} stream deadline exceeded')
+                    delta = self.parse_stream_event(event, state)
+                    if delta:
+                        state['text'].append(delta)
+                        yield delta
+            finally:
+                await response.aclose()
+                metrics.response_bytes = response.num_bytes_downloaded
+
+            result.text = ''.join(state['text'])
+            result.raw = state['response'] or self.assemble_stream_response(state)
+            result.usage = self.get_usage(result.raw)
+            self.record_usage(result, metrics)
+            self.settle(response, result.billed_tokens, estimate)
+            # like ask, only an answer get_text accepts is cached, a truncated or cut off one would fail every repeat
+            try:
+                self.get_text(result.raw, options)
+            except Exception as e:
+                self.logger.warning(f'{self.model} ask_stream answer not cached, finish {state["finish"]}: {e}')
+            else:
+                if key:
+                    self.cache.put(key, result.raw)
+            result.duration = time.perf_counter() - metrics.started
+            self.logger.debug(
+                '%s stream duration: %.2f billed: %s usage %s',
+                self.model,
+                result.duration,
+                result.billed_tokens,
+                result.usage,
+            )
+
+    async def sse_events(self, response):
+        """Parse a server-sent events body into decoded JSON payloads."""
+        data = []
+        async for line in response.aiter_lines():
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+                continue
+            if line or not data:
+                continue
+            payload = '\n'.join(data)
+            data = []
+            if payload != '[DONE]':
+                yield json.loads(payload)
+        if data and data != ['[DONE]']:
+            yield json.loads('\n'.join(data))
+
+    def parse_stream_event(self, event, state) -> str:
+        return self.adapter.parse_stream_event(event, state)
+
+    def assemble_stream_response(self, state) -> dict:
+        return self.adapter.assemble_stream_response(state)
 
     def get_usage(self, completion):
-        if completion.get('usage'):
-            return completion['usage']
-        if completion.get('usageMetadata'):
-            return completion['usageMetadata']
-        return None
-
-    def get_text(self, completion):
-        if completion.get('candidates'):  # google
-            if completion['candidates'][0]['finishReason'] == 'MAX_TOKENS':
-                raise ConnectorException(701, 'The generated exceed max content')
-            if completion['candidates'][0]['finishReason'] == 'OTHER':
-                raise ConnectorException(701, 'The generated stopped for other reason')
-            jj = str(completion['candidates'][0]['content']['parts'][0]['text'])
-            j = find_between(jj, '```json', '```')
-            if not j:
-                j = jj
-            j = j.strip()
-            if not j:
-                return ''
-            if j[0] == '[':
-                j = j[1:-1]
-
-            result = re.sub(r'(?<!\\)\\(?!["\\/bfnrt]|u[0-9a-fA-F]{4})', r'', j)
-            return result
+        return self.adapter.usage(completion)
 
-        if completion.get('content'):  # Anthropic
-            if completion.get('stop_reason') == 'max_token':
-                raise ConnectorException(701, 'The geneerated exceed max content')
+    def get_token_split(self, usage):
+        """(input, output) tokens of a provider usage block."""
+        if not usage:
+            return 0, 0
+        return self.adapter.token_split(usage)
 
-            j = str(completion['content'][0]['text'])
-            result = find_between(j, '```json', '```')
-            return result
-        if completion.get('output'):  # openai responses
-            output = completion['output'][0]
-            if output['status'] != 'completed':
-                raise ConnectorException(701, f'The generated content is {output["status"]}')
-            text = output['content'][0]['text']
-            if self.extract_json:
-                extracted = find_between(text, '```json', '```')
-                if not extracted:
-                    extracted = text
-            return extracted
-
-        if completion.get('message'):
-            return str(completion['message']['content'])
-        text = completion['choices'][0]  # OpenAi
-        if text['finish_reason'] == 'content_filter':
-            raise ConnectorException(701, 'The generated content is filtered')
-        if text['finish_reason'] == 'length':
-            raise ConnectorException(701, 'The generated content is too long')
-        text = text['message']['content']
-        if self.extract_json:
-            text2 = find_between(text, '```json', '```')
-            if text2:
-                text = text2
-        return text
+    def get_cached_tokens(self, usage) -> int:
+        """Prompt tokens served from the provider's prompt cache."""
+        if not usage:
+            return 0
+        return self.adapter.cached_tokens(usage)
+
+    def get_text(self, completion, options=None):
+        if options is not None and options.schema:
+            return self.adapter.structured_text(completion)
+        return self.adapter.parse_text(completion, self.wants_json(options))
 
     def get_total_tokens(self, usage):
-        us = usage.get('input_tokens', None)
-        if us:
-            return us + usage.get('output_tokens', 0)
-        return usage.get('totalTokenCount', usage.get('total_tokens', 0))
+        return self.adapter.total_tokens(usage)
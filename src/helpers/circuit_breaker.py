@@ -0,0 +1,177 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+import httpx
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# consecutive failures that open a circuit and seconds it stays open before a probe
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+
+
+class Timeouts:
+    """Connect, read and write timeouts of one attempt and the total time of a call including retries."""
+
+    def __init__(self, connect=10.0, read=180.0, write=30.0, total=300.0) -> None:
+        self.connect = connect
+        self.read = read
+        self.write = write
+        self.total = total
+
+
+CHAT_TIMEOUTS = Timeouts(connect=10.0, read=180.0, write=30.0, total=300.0)
+EMBEDDING_TIMEOUTS = Timeouts(connect=5.0, read=30.0, write=10.0, total=60.0)
+
+
+class Deadline:
+    """Point in time a call and everything it calls must finish by."""
+
+    def __init__(self, seconds) -> None:
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.expires <= time.monotonic()
+
+    def timeout(self, timeouts: Timeouts) -> httpx.Timeout:
+        """httpx timeout of one attempt, every phase capped by the time left."""
+        left = self.remaining()
+        return httpx.Timeout(
+            connect=min(timeouts.connect, left),
+            read=min(timeouts.read, left),
+            write=min(timeouts.write, left),
+            pool=left,
+        )
+
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+def current_deadline():
+    """Deadline set by the innermost `deadline` scope, None outside of any."""
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(seconds):
+    """Bound every call made inside the block, e.g. `with deadline(20): await chat.ask(prompt)`.
+
+    Nested scopes can only shorten the deadline in force.
+    """
+    outer = _deadline.get()
+    scope = Deadline(seconds)
+    if outer is not None and outer.expires < scope.expires:
+        scope = outer
+    token = _deadline.set(scope)
+    try:
+        yield scope
+    finally:
+        _deadline.reset(token)
+
+
+def call_deadline(*seconds) -> Deadline:
+    """Earliest of the deadline in scope and each of `seconds` (None skipped) from now."""
+    found = current_deadline()
+    for value in seconds:
+        if value is None:
+            continue
+        candidate = Deadline(value)
+        if found is None or candidate.expires < found.expires:
+            found = candidate
+    return found
+
+
+class CircuitBreaker:
+    """Failure state of one endpoint.
+
+    Closed lets every request through and counts consecutive failures. At
+    `threshold` failures the circuit opens and requests fail fast; after
+    `reset_timeout` seconds one probe request is let through (half-open), its
+    success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def retry_in(self) -> float:
+        """Seconds until an open circuit lets a probe through."""
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == OPEN and self.retry_in() <= 0:
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        return self.state == CLOSED
+
+    def success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def abandon(self) -> None:
+        """Forget a request that ended without an outcome, e.g. cancelled, so another one can probe."""
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        """True while requests fail fast: open and not yet due for a probe, or a probe is in flight."""
+        if self.state == OPEN:
+            return self.retry_in() > 0
+        return self.state == HALF_OPEN and self.probing
+
+
+_breakers = {}
+
+
+def endpoint(url) -> str:
+    """Scheme, host and path of `url` without the query."""
+    return url.split('?', 1)[0]
+
+
+def get_breaker(url, model=None) -> CircuitBreaker:
+    """Breaker of `model` at `url`; models sharing one API path fail independently."""
+    key = (endpoint(url), model)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = CircuitBreaker()
+        _breakers[key] = breaker
+    return breaker
+
+
+def configure_breaker(url, model=None, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT) -> CircuitBreaker:
+    """Replace the breaker of `model` at `url`."""
+    breaker = CircuitBreaker(threshold, reset_timeout)
+    _breakers[(endpoint(url), model)] = breaker
+    return breaker
+
+
+def reset_breakers() -> None:
+    """Close every circuit, e.g. between tests."""
+    _breakers.clear()
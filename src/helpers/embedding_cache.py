@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+CACHE_PATH_ENV = 'EMBEDDING_CACHE_PATH'
+
+# rows per SELECT ... IN (...) query, below the SQLite variable limit
+LOOKUP_CHUNK = 500
+
+TRAILING_SPACE = re.compile(r'[ \t]+\n')
+
+
+def normalize_text(text: str) -> str:
+    """Text as the cache sees it: NFC, \\n line ends, no trailing spaces, stripped."""
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n').replace('\r', '\n')
+    return TRAILING_SPACE.sub('\n', text).strip()
+
+
+class EmbeddingCache:
+    """On-disk store of embeddings keyed by model, task type and a hash of the normalized text.
+
+    Vectors are kept as float32 blobs in SQLite; the least recently used ones are
+    evicted once the stored vectors exceed `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024) -> None:
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, created REAL NOT NULL, '
+            'accessed REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings(accessed)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    @staticmethod
+    def make_key(model, task_type, text) -> str:
+        digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+        return f'{model}:{task_type or ""}:{digest}'
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        """{key: float32 vector} of the stored `keys`; the others count as misses."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[start : start + LOOKUP_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                rows = self.db.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({marks})', chunk)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self.db.executemany('UPDATE embeddings SET accessed=? WHERE key=?', [(now, key) for key in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key, vector) -> None:
+        self.put_many({key: vector})
+
+    def put_many(self, vectors: dict) -> None:
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, key.split(':', 1)[0], blob, now, now))
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                for row in rows:
+                    old = self.db.execute('SELECT LENGTH(vector) FROM embeddings WHERE key=?', (row[0],)).fetchone()
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO embeddings(key, model, vector, created, accessed) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        row,
+                    )
+                    self.total_bytes += len(row[2]) - (old[0] if old else 0)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                self.total_bytes = self.db.execute(
+                    'SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings'
+                ).fetchone()[0]
+                raise
+            self.db.execute('COMMIT')
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        rows = self.db.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY accessed').fetchall()
+        target = self.max_bytes * 0.9
+        removed = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            removed.append((key,))
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM embeddings WHERE key=?', removed)
+        self.evictions += len(removed)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': self.total_bytes,
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM embeddings')
+            self.total_bytes = 0
+
+    def close(self) -> None:
+        self.db.close()
+
+
+_shared = {}
+
+
+def shared_embedding_cache(path=None, **kwargs):
+    """Return one cache per path; without a path the opt-in EMBEDDING_CACHE_PATH env var is used."""
+    path = path or os.getenv(CACHE_PATH_ENV)
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    if path not in _shared:
+        _shared[path] = EmbeddingCache(path, **kwargs)
+    return _shared[path]
@@ -1,8 +1,24 @@
 import asyncio
+import hashlib
 import os
-from datetime import datetime
+import random
+import time
+from urllib.parse import urlsplit
 
 import httpx
+import numpy as np
+
+from src.helpers.background_loop import run_sync
+from src.helpers.circuit_breaker import EMBEDDING_TIMEOUTS, call_deadline, endpoint, get_breaker
+from src.helpers.embedding_cache import EmbeddingCache, shared_embedding_cache
+from src.helpers.key_pool import KeyPool, load_keys
+from src.helpers.md_chunker import chunk_markdown
+from src.helpers.np_helper import as_vector, pool_vectors
+from src.helpers.rate_limiter import RETRY_STATUS, backoff_delay, retry_after
+from src.helpers.single_flight import get_flights
+from src.helpers.telemetry import RequestMetrics, observe
+from src.helpers import token_budget
+from src.helpers.transport import get_transport
 
 
 class EmbeddingConnectorException(Exception):
@@ -12,16 +28,59 @@ class EmbeddingConnectorException(Exception):
         super().__init__(f'Error {code}:{message}')
 
 
+def pack_batches(sizes, max_items, max_tokens) -> list:
+    """Split item indices, in order, into batches of at most `max_items` items and `max_tokens` tokens.
+
+    An item bigger than `max_tokens` goes alone into its own batch.
+    """
+    batches, batch, tokens = [], [], 0
+    for index, size in enumerate(sizes):
+        if batch and (len(batch) >= max_items or tokens + size > max_tokens):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(index)
+        tokens += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class DocumentEmbedding:
+    """Pooled vector of a document together with its chunks, which keep their own vectors."""
+
+    def __init__(self, embedding, chunks) -> None:
+        self.embedding = embedding
+        self.chunks = chunks
+
+
 class EmbeddingConnector:
-    def __init__(self, logger) -> None:
+    def __init__(self, logger, cache=None) -> None:
         self.logger = logger
+        # opt-in embedding cache, by default the one named by EMBEDDING_CACHE_PATH, False disables it
+        self.cache = cache if cache is not None else shared_embedding_cache()
         self.last_response = None
-        self.client = httpx.AsyncClient()
-        
+        self.timeouts = EMBEDDING_TIMEOUTS
+        self.max_retries = 6
+        # batch requests in flight of batch_embed
+        self.concurrency = 4
+        # item index -> exception of the last batch_embed call
+        self.batch_errors = {}
+        # in-process model of init_local, None for the remote APIs
+        self.local = None
+
         # Default to Gemini embedding model
         self.init_gemini4()
 
+    @property
+    def client(self):
+        return get_transport().client(self.api_url)
+
+    async def preconnect(self):
+        await get_transport().preconnect([self.api_url])
+
     def init_model(self, model):
+        self.local = None
+        self.concurrency = 4
         if model == 'gemini' or model is None:
             self.init_gemini()
         elif model == 'google':
@@ -30,67 +89,238 @@ class EmbeddingConnector:
             self.init_openai()
         elif model == 'azure':
             self.init_azure()
+        elif model == 'local':
+            self.init_local()
         else:
             self.init_gemini()  # Default to Gemini if model type is unknown
 
+    def init_keys(self, env, headers):
+        """Key pool of the provider; every key of `env` gets its own rate limiter."""
+        keys = load_keys(env)
+        if not keys:
+            raise ValueError(f'{env} is not set.')
+        self.keys = KeyPool(self.api_url, keys, headers, scope='embedding')
+        self.api_key = keys[0]
+        self.headers = self.keys.headers(self.api_key)
+
     def init_gemini(self):
         self.model = 'gemini-embedding-exp-03-07'
-        self.api_key = os.getenv('GOOGLE_API_KEY')
-        if self.api_key is None:
-            raise ValueError('GOOGLE_API_KEY is not set.')
-        
-        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/{self.model}:embedContent?key={self.api_key}'
-        self.headers = {
+        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/{self.model}:embedContent'
+        self.init_keys('GOOGLE_API_KEY', lambda key: {
             'content-type': 'application/json',
-        }
+            'x-goog-api-key': key,
+        })
         self.task_type = 'SEMANTIC_SIMILARITY'
+        self.batch_url = self.api_url.replace(':embedContent', ':batchEmbedContents')
+        self.batch_size, self.batch_tokens = 100, 60000
+        self.max_input_tokens = 8192
+
     def init_gemini4(self):
-        self.model= 'text-embedding-004'
-        self.api_key = os.getenv('GOOGLE_API_KEY')
-        if self.api_key is None:
-            raise ValueError('GOOGLE_API_KEY is not set.')
-        
-        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/{self.model}:embedContent?key={self.api_key}'
-        self.headers = {
+        self.model = 'text-embedding-004'
+        self.api_url = f'https://generativelanguage.googleapis.com/v1beta/models/{self.model}:embedContent'
+        self.init_keys('GOOGLE_API_KEY', lambda key: {
             'content-type': 'application/json',
-        }
+            'x-goog-api-key': key,
+        })
         self.task_type = ''
+        self.batch_url = self.api_url.replace(':embedContent', ':batchEmbedContents')
+        self.batch_size, self.batch_tokens = 100, 60000
+        self.max_input_tokens = 2048
 
     def init_openai(self):
         self.model = 'text-embedding-3-small'
-        self.api_key = os.getenv('OPENAI_API_KEY')
-        if self.api_key is None:
-            raise ValueError('OPENAI_API_KEY is not set.')
-        
         self.api_url = 'https://api.openai.com/v1/embeddings'
-        self.headers = {
-            'Authorization': f'Bearer {self.api_key}',
+        self.init_keys('OPENAI_API_KEY', lambda key: {
+            'Authorization': f'Bearer {key}',
             'Content-type': 'application/json'
-        }
+        })
         self.task_type = None
+        self.batch_url = self.api_url
+        # the API takes up to 2048 inputs and 300k tokens per request
+        self.batch_size, self.batch_tokens = 1024, 200000
+        self.max_input_tokens = 8191
 
     def init_azure(self):
         self.model = 'text-embedding-ada-002'
-        self.api_key = os.getenv('AZURE_OPENAI_KEY')
         self.endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
-        if self.api_key is None or self.endpoint is None:
-            raise ValueError('AZURE_OPENAI_KEY or AZURE_OPENAI_ENDPOINT is not set.')
-        
+        if self.endpoint is None:
+            raise ValueError('AZURE_OPENAI_ENDPOINT is not set.')
         self.api_url = f'{self.endpoint}/openai/deployments/{self.model}/embeddings?api-version=2023-05-15'
-        self.headers = {
-            'api-key': self.api_key,
+        self.init_keys('AZURE_OPENAI_KEY', lambda key: {
+            'api-key': key,
             'Content-Type': 'application/json'
-        }
+        })
         self.task_type = None
+        self.batch_url = self.api_url
+        # api-version 2023-05-15 takes at most 16 inputs per request
+        self.batch_size, self.batch_tokens = 16, 100000
+        self.max_input_tokens = 8191
+
+    def init_local(self, workers=None):
+        """Offline model on CPU, loaded from LOCAL_EMBEDDING_MODEL or fitted by the first batch_embed."""
+        # scikit-learn and joblib are only needed by the local backend
+        from src.helpers.local_embedding import load_local_model
+
+        self.local = load_local_model(workers=workers)
+        self.model = self.local.name
+        self.api_url = 'local://embeddings'
+        self.batch_url = self.api_url
+        self.keys = None
+        self.api_key = None
+        self.headers = {}
+        self.task_type = None
+        # a batch is one block of the thread pool, every worker gets one in flight
+        self.batch_size, self.batch_tokens = 256, 10**9
+        self.max_input_tokens = 8192
+        self.concurrency = self.local.workers
+
+    async def fit_local(self, texts: list) -> None:
+        """Fit the local model on `texts` and save it to LOCAL_EMBEDDING_MODEL when that is set."""
+        from src.helpers.local_embedding import MODEL_PATH_ENV
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(self.local.executor, self.local.fit, texts)
+        except ValueError as e:
+            raise EmbeddingConnectorException(400, f'{self.model} {e}') from e
+        self.model = self.local.name
+        path = os.getenv(MODEL_PATH_ENV)
+        if path:
+            await loop.run_in_executor(self.local.executor, self.local.save, path)
+        self.logger.info(f'{self.model} fitted on {len(texts)} texts in {time.perf_counter() - start:.2f}s')
+
+    async def embed_local(self, texts: list) -> list:
+        if not self.local.fitted:
+            raise EmbeddingConnectorException(409, f'{self.model} is not fitted, batch_embed a corpus first')
+        vectors = await asyncio.get_running_loop().run_in_executor(self.local.executor, self.local.transform, texts)
+        return list(vectors)
 
     def embed_sync(self, text: str) -> str:
-        """Synchronous wrapper for the async embedding method"""
-        return asyncio.run(self.embed(text))
+        """Synchronous wrapper for the async embedding method, run on the shared background loop"""
+        return run_sync(self.embed(text))
 
-    async def embed(self, text: str) -> str:
-        """Compute an embedding for the input text"""
-        start = datetime.now()
-        
+    def flight_key(self, text: str, timeout=None) -> str:
+        """Hash of what shapes the embedding of `text`, its time limit included."""
+        shape = f'{self.api_url}\n{self.model}\n{self.task_type}\n{timeout}\n{text}'
+        return hashlib.sha256(shape.encode('utf-8')).hexdigest()
+
+    def cache_key(self, text: str):
+        return EmbeddingCache.make_key(self.model, self.task_type, text) if self.cache else None
+
+    async def embed(self, text: str, timeout=None) -> np.ndarray:
+        """Compute the float32 embedding of the input text within `timeout` seconds and any `deadline` scope.
+
+        Cached texts are served without a request, concurrent requests for the same text share one call
+        and its vector, which is read-only for that reason.
+        """
+        key = self.cache_key(text)
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        # the flight runs within the deadline of the caller that started it, a joining caller keeps its own
+        deadline = call_deadline(timeout, self.timeouts.total)
+        try:
+            embedding, shared = await asyncio.wait_for(
+                get_flights().do(self.flight_key(text, timeout), lambda: self.embed_once(text, timeout)),
+                deadline.remaining(),
+            )
+        except asyncio.TimeoutError:
+            raise EmbeddingConnectorException(408, f'{self.model} deadline exceeded') from None
+        if key and embedding is not None and not shared:
+            self.cache.put(key, embedding)
+        return embedding
+
+    async def embed_once(self, text: str, timeout=None):
+        with observe(RequestMetrics('embed', self.model, urlsplit(self.api_url).path)) as metrics:
+            if self.local:
+                embedding = (await self.embed_local([text]))[0]
+            else:
+                embedding = await self._embed(text, metrics, call_deadline(timeout, self.timeouts.total))
+            if embedding is not None:
+                embedding.flags.writeable = False
+            return embedding
+
+    async def send(self, json_data, metrics: RequestMetrics, deadline, url=None, estimated_tokens=0):
+        """POST `json_data` within the RPM/TPM budget of the freest key, retrying 429/5xx and timeouts with backoff.
+
+        A 429 cools its key down and moves to the next free key at once. Embedding
+        models are not interchangeable, so an open circuit fails fast instead of
+        falling back to another model.
+        """
+        url = url or self.api_url
+        breaker = get_breaker(url, self.model)
+        for attempt in range(self.max_retries + 1):
+            # fail fast before spending rate limit budget, and wait for that budget no longer than the deadline
+            if deadline.expired:
+                raise EmbeddingConnectorException(408, f'{self.model} deadline exceeded')
+            if not breaker.allow():
+                raise EmbeddingConnectorException(
+                    503, f'{self.model} {endpoint(url)} circuit open for {breaker.retry_in():.0f}s'
+                )
+            try:
+                key = await self.keys.acquire(estimated_tokens, deadline.remaining())
+            except asyncio.TimeoutError as e:
+                breaker.abandon()
+                raise EmbeddingConnectorException(
+                    408, f'{self.model} rate limit leaves no time before the deadline'
+                ) from e
+            except BaseException:
+                breaker.abandon()
+                raise
+            limiter = self.keys.limiter(key)
+            headers = self.keys.headers(key)
+            request = self.client.build_request(
+                'POST', url, json=json_data, headers=headers, timeout=deadline.timeout(self.timeouts)
+            )
+            metrics.request_bytes = len(request.content)
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(self.client.send(request, stream=True), deadline.remaining())
+                metrics.time_to_headers = time.perf_counter() - start
+                try:
+                    await asyncio.wait_for(response.aread(), deadline.remaining())
+                finally:
+                    await response.aclose()
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                breaker.failure()
+                error = f'{type(e).__name__} {e}'.strip()
+                if attempt == self.max_retries or deadline.expired:
+                    code = 503 if isinstance(e, httpx.ConnectError) else 408
+                    raise EmbeddingConnectorException(code, f'{self.model} {error}') from e
+                delay = min(backoff_delay(attempt), deadline.remaining())
+                metrics.retries += 1
+                self.logger.warning(f'{self.model} {error}, retry {attempt + 1} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.abandon()
+                raise
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            limiter.observe(response.headers)
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                break
+            delay = retry_after(response.headers)
+            delay = backoff_delay(attempt) if delay is None else delay + random.uniform(0, 1)
+            metrics.retries += 1
+            if response.status_code == 429:
+                self.keys.cooldown(key, delay)
+                if self.keys.available():
+                    continue
+            if delay >= deadline.remaining():
+                raise EmbeddingConnectorException(
+                    408, f'{self.model} status {response.status_code}, no time left to retry'
+                )
+            self.logger.warning(f'{self.model} status {response.status_code}, retry {attempt + 1} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+        response.extensions['rate_limiter'] = limiter
+        return response
+
+    def embed_payload(self, text: str) -> dict:
         json_data = {}
         if 'gemini' in self.model:
             json_data = {
@@ -117,16 +347,23 @@ class EmbeddingConnector:
             json_data = {
                 "input": text
             }
-        
-        response = await self.client.post(
-            self.api_url, 
-            json=json_data, 
-            headers=self.headers, 
-            timeout=60
-        )
-        
-        duration = (datetime.now() - start).total_seconds()
-        
+        return json_data
+
+    def batch_payload(self, texts: list) -> dict:
+        if self.batch_url != self.api_url:  # Gemini batchEmbedContents
+            return {'requests': [self.embed_payload(text) for text in texts]}
+        json_data = self.embed_payload('')
+        json_data['input'] = list(texts)
+        return json_data
+
+    async def _embed(self, text: str, metrics: RequestMetrics, deadline):
+        json_data = self.embed_payload(text)
+        tokens = token_budget.estimate_tokens(text, token_budget.token_family(self.api_url))
+        response = await self.send(json_data, metrics, deadline, estimated_tokens=tokens)
+        metrics.status = response.status_code
+        metrics.response_bytes = len(response.content)
+        duration = time.perf_counter() - metrics.started
+
         if response.status_code != 200:
             self.logger.error(f'{self.model} embedding error code={response.status_code} {response.text}')
             raise EmbeddingConnectorException(
@@ -136,6 +373,10 @@ class EmbeddingConnector:
         
         json_response = response.json()
         self.last_response = json_response
+        usage = json_response.get('usage') or {}
+        metrics.tokens_in = usage.get('prompt_tokens', 0)
+        if metrics.tokens_in:
+            response.extensions['rate_limiter'].record(metrics.tokens_in, tokens)
         
         # Extract embedding based on API response structure
         embedding = self.extract_embedding(json_response)
@@ -143,30 +384,172 @@ class EmbeddingConnector:
         # Log embedding computation details
         embedding_length = len(embedding) if embedding is not None else 0
         
-        self.logger.debug(
-            f'{self.model} embedding dims={embedding_length},  duration={duration:.2f}s'
-        )
+        self.logger.debug('%s embedding dims=%s,  duration=%.2fs', self.model, embedding_length, duration)
         
         return embedding
 
-    def batch_embed_sync(self, texts: list) -> list:
-        """Synchronous wrapper for batch embedding"""
-        return asyncio.run(self.batch_embed(texts))
+    def batch_embed_sync(self, texts: list, concurrency=None, progress=None) -> list:
+        """Synchronous wrapper for batch embedding, run on the shared background loop"""
+        return run_sync(self.batch_embed(texts, concurrency, progress))
+
+    async def batch_embed(self, texts: list, concurrency=None, progress=None) -> list:
+        """Float32 embeddings of `texts` in input order, sent as provider batches, `concurrency` of them in flight.
+
+        Texts are deduplicated and packed by `batch_size` and `batch_tokens`; every batch
+        waits for the RPM/TPM budget of a key and 429/5xx answers are retried. A failing
+        item gets None and its exception in `batch_errors`, the rest of its batch is kept.
+        `progress(done, total)` is called with the distinct texts finished so far.
+        An unfitted local model is fitted on `texts` first. The vectors are read-only rows
+        of one matrix.
+        """
+        self.batch_errors = {}
+        unique = list(dict.fromkeys(texts))
+        vectors = {}
+        family = token_budget.token_family(self.api_url)
+        for text in unique:
+            if not text or not text.strip():
+                vectors[text] = EmbeddingConnectorException(400, f'{self.model} empty text')
+        if self.local and not self.local.fitted:
+            await self.fit_local([text for text in unique if text not in vectors])
+        keys = {text: self.cache_key(text) for text in unique if text not in vectors} if self.cache else {}
+        if keys:
+            stored = self.cache.get_many(keys.values())
+            vectors.update((text, stored[key]) for text, key in keys.items() if key in stored)
+        pending = [text for text in unique if text not in vectors]
+        sizes = [token_budget.estimate_tokens(text, family) for text in pending]
+        packed = pack_batches(sizes, self.batch_size, self.batch_tokens)
+        batches = [([pending[i] for i in batch], sum(sizes[i] for i in batch)) for batch in packed]
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+        done = [len(unique) - len(pending)]
+        if progress:
+            progress(done[0], len(unique))
 
-    async def batch_embed(self, texts: list) -> list:
-        """Process multiple texts and return their embeddings"""
+        async def run(batch, tokens):
+            async with semaphore:
+                await self.embed_batch(batch, vectors, tokens)
+            done[0] += len(batch)
+            if progress:
+                progress(done[0], len(unique))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(batch, tokens) for batch, tokens in batches))
+        if keys:
+            fresh = {keys[text]: vectors[text] for text in pending if not isinstance(vectors[text], Exception)}
+            self.cache.put_many(fresh)
+        embedded = [text for text in unique if not isinstance(vectors[text], Exception)]
+        matrix = np.array([vectors[text] for text in embedded], dtype=np.float32)
+        # equal texts share a row
+        matrix.flags.writeable = False
+        rows = dict(zip(embedded, matrix))
         embeddings = []
-        for text in texts:
-            embedding = await self.embed(text)
-            embeddings.append(embedding)
+        for index, text in enumerate(texts):
+            if text not in rows:
+                self.batch_errors[index] = vectors[text]
+            embeddings.append(rows.get(text))
+        self.logger.debug(
+            '%s batch_embed texts=%s cached=%s requests=%s failed=%s duration=%.2fs',
+            self.model,
+            len(texts),
+            len(unique) - len(pending),
+            len(batches),
+            len(self.batch_errors),
+            time.perf_counter() - start,
+        )
         return embeddings
 
+    @property
+    def chunk_tokens(self) -> int:
+        """Token budget of one document chunk, below `max_input_tokens` as estimates are approximate."""
+        return int(self.max_input_tokens * 0.9)
+
+    async def embed_documents(self, texts: list, concurrency=None, progress=None) -> list:
+        """One DocumentEmbedding per markdown text, None for a text none of whose chunks could be embedded.
+
+        Texts longer than `chunk_tokens` are split on headings and paragraphs; the chunks of
+        all texts go through a single `batch_embed`, so a short text costs the same as before.
+        `batch_errors` is keyed by the index of the text.
+        """
+        family = token_budget.token_family(self.api_url)
+        documents = [chunk_markdown(text or '', self.chunk_tokens, family) for text in texts]
+        flat = [chunk.text for chunks in documents for chunk in chunks]
+        self.logger.debug(f'{self.model} embed_documents texts={len(texts)} chunks={len(flat)}')
+        embeddings = await self.batch_embed(flat, concurrency, progress)
+        chunk_errors = self.batch_errors
+        self.batch_errors = {}
+        results = []
+        position = 0
+        for index, chunks in enumerate(documents):
+            for offset, chunk in enumerate(chunks):
+                chunk.embedding = embeddings[position + offset]
+            embedded = [chunk for chunk in chunks if chunk.embedding is not None]
+            if embedded:
+                vector = pool_vectors([chunk.embedding for chunk in embedded], [chunk.tokens for chunk in embedded])
+                results.append(DocumentEmbedding(vector, embedded))
+            else:
+                failed = [chunk_errors[i] for i in range(position, position + len(chunks)) if i in chunk_errors]
+                empty = EmbeddingConnectorException(400, f'{self.model} empty text')
+                self.batch_errors[index] = failed[0] if failed else empty
+                results.append(None)
+            position += len(chunks)
+        return results
+
+    async def embed_batch(self, texts: list, vectors: dict, tokens=0) -> None:
+        """Embed one provider batch into `vectors`; a rejected batch is split to isolate the failing items."""
+        try:
+            embeddings = await self.send_batch(texts, tokens)
+        except EmbeddingConnectorException as e:
+            # 4xx other than 429 point at an input, anything else fails the whole batch
+            if len(texts) > 1 and 400 <= e.code < 500 and e.code not in (408, 429):
+                self.logger.warning(f'{self.model} batch of {len(texts)} rejected ({e.code}), splitting')
+                half = len(texts) // 2
+                await self.embed_batch(texts[:half], vectors, tokens // 2)
+                await self.embed_batch(texts[half:], vectors, tokens - tokens // 2)
+                return
+            for text in texts:
+                vectors[text] = e
+            return
+        vectors.update(zip(texts, embeddings))
+
+    async def send_batch(self, texts: list, tokens=0) -> list:
+        """One batch request of about `tokens` tokens; embeddings in the order of `texts`."""
+        with observe(RequestMetrics('embed_batch', self.model, urlsplit(self.batch_url).path)) as metrics:
+            if self.local:
+                return await self.embed_local(texts)
+            deadline = call_deadline(self.timeouts.total)
+            json_data = self.batch_payload(texts)
+            response = await self.send(json_data, metrics, deadline, url=self.batch_url, estimated_tokens=tokens)
+            metrics.status = response.status_code
+            metrics.response_bytes = len(response.content)
+            if response.status_code != 200:
+                self.logger.error(f'{self.model} batch embedding error code={response.status_code} {response.text}')
+                raise EmbeddingConnectorException(response.status_code, f'{self.model} batch of {len(texts)}')
+            json_response = response.json()
+            metrics.tokens_in = (json_response.get('usage') or {}).get('prompt_tokens', 0)
+            if metrics.tokens_in:
+                response.extensions['rate_limiter'].record(metrics.tokens_in, tokens)
+            embeddings = self.extract_embeddings(json_response)
+            if len(embeddings) != len(texts):
+                raise EmbeddingConnectorException(
+                    502, f'{self.model} batch of {len(texts)} answered {len(embeddings)} embeddings'
+                )
+            return embeddings
+
+    def extract_embeddings(self, response) -> list:
+        """Float32 embeddings of a batch response in input order"""
+        if 'embeddings' in response:  # Gemini batchEmbedContents
+            return list(np.array([item['values'] for item in response['embeddings']], dtype=np.float32))
+        if 'data' in response:  # OpenAI, items carry their input index
+            items = sorted(response['data'], key=lambda item: item['index'])
+            return list(np.array([item['embedding'] for item in items], dtype=np.float32))
+        self.logger.error(f'Unknown batch embedding response format: {str(response)[:200]}')
+        return []
+
     def extract_embedding(self, response):
-        """Extract embeddings from API response based on provider format"""
+        """Extract the float32 embedding from API response based on provider format"""
         if 'embedding' in response:  # Gemini format
-            return response['embedding']['values']
+            return as_vector(response['embedding']['values'])
         elif 'data' in response:  # OpenAI format
-            return response['data'][0]['embedding']
+            return as_vector(response['data'][0]['embedding'])
         
         self.logger.error(f"Unknown embedding response format: {response}")
         return None
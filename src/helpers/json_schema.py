@@ -0,0 +1,154 @@
+import json
+import re
+
+# JSON schema keywords checked locally: type, enum, const, properties, required,
+# additionalProperties, items, min/maxItems, minimum/maximum, min/maxLength, pattern, anyOf
+
+TYPES = {
+    'object': lambda v: isinstance(v, dict),
+    'array': lambda v: isinstance(v, list),
+    'string': lambda v: isinstance(v, str),
+    'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    'integer': lambda v: (isinstance(v, int) and not isinstance(v, bool)) or (isinstance(v, float) and v.is_integer()),
+    'boolean': lambda v: isinstance(v, bool),
+    'null': lambda v: v is None,
+}
+
+
+def compile_node(schema):
+    """Turn one schema node into a check(value, path, errors) closure."""
+    checks = []
+    kind = schema.get('type')
+    if kind:
+        kinds = [kind] if isinstance(kind, str) else list(kind)
+        tests = [TYPES[k] for k in kinds]
+
+        def check_type(value, path, errors):
+            if not any(test(value) for test in tests):
+                errors.append((path, f'expected {"/".join(kinds)}'))
+                return False
+            return True
+
+        checks.append(check_type)
+    if 'enum' in schema:
+        allowed = schema['enum']
+        checks.append(lambda v, p, e: v in allowed or e.append((p, f'not one of {allowed}')))
+    if 'const' in schema:
+        const = schema['const']
+        checks.append(lambda v, p, e: v == const or e.append((p, f'expected {const!r}')))
+    if 'minimum' in schema:
+        low = schema['minimum']
+        checks.append(lambda v, p, e: not TYPES['number'](v) or v >= low or e.append((p, f'below {low}')))
+    if 'maximum' in schema:
+        high = schema['maximum']
+        checks.append(lambda v, p, e: not TYPES['number'](v) or v <= high or e.append((p, f'above {high}')))
+    if 'minLength' in schema:
+        size = schema['minLength']
+        checks.append(lambda v, p, e: not isinstance(v, str) or len(v) >= size or e.append((p, 'too short')))
+    if 'maxLength' in schema:
+        size = schema['maxLength']
+        checks.append(lambda v, p, e: not isinstance(v, str) or len(v) <= size or e.append((p, 'too long')))
+    if 'pattern' in schema:
+        pattern = re.compile(schema['pattern'])
+        message = f'not matching {pattern.pattern}'
+        checks.append(lambda v, p, e: not isinstance(v, str) or pattern.search(v) or e.append((p, message)))
+
+    properties = {name: compile_node(node) for name, node in schema.get('properties', {}).items()}
+    required = schema.get('required', [])
+    additional = schema.get('additionalProperties', True)
+    extra = compile_node(additional) if isinstance(additional, dict) else None
+    if properties or required or additional is not True:
+
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                return
+            for name in required:
+                if name not in value:
+                    errors.append((path + (name,), 'missing'))
+            for name, item in value.items():
+                if name in properties:
+                    properties[name](item, path + (name,), errors)
+                elif additional is False:
+                    errors.append((path + (name,), 'not allowed'))
+                elif extra:
+                    extra(item, path + (name,), errors)
+
+        checks.append(check_object)
+
+    items = compile_node(schema['items']) if isinstance(schema.get('items'), dict) else None
+    min_items, max_items = schema.get('minItems'), schema.get('maxItems')
+    if items or min_items is not None or max_items is not None:
+
+        def check_array(value, path, errors):
+            if not isinstance(value, list):
+                return
+            if min_items is not None and len(value) < min_items:
+                errors.append((path, f'fewer than {min_items} items'))
+            if max_items is not None and len(value) > max_items:
+                errors.append((path, f'more than {max_items} items'))
+            if items:
+                for index, item in enumerate(value):
+                    items(item, path + (index,), errors)
+
+        checks.append(check_array)
+
+    if 'anyOf' in schema:
+        options = [compile_node(node) for node in schema['anyOf']]
+
+        def check_any(value, path, errors):
+            for option in options:
+                found = []
+                option(value, path, found)
+                if not found:
+                    return
+            errors.append((path, 'matches no anyOf option'))
+
+        checks.append(check_any)
+
+    def check(value, path, errors):
+        for step in checks:
+            # a wrong type makes the remaining keywords meaningless
+            if step(value, path, errors) is False:
+                return
+
+    return check
+
+
+_compiled = {}
+
+
+def compile_schema(schema):
+    """Validator of `schema` returning a list of (path, message) errors; compiled once per schema."""
+    key = json.dumps(schema, sort_keys=True)
+    validator = _compiled.get(key)
+    if validator is None:
+        check = compile_node(schema)
+
+        def validator(value):
+            errors = []
+            check(value, (), errors)
+            return errors
+
+        _compiled[key] = validator
+    return validator
+
+
+def failing_fields(errors) -> list:
+    """Top-level properties touched by `errors`, in order; empty when the root itself is wrong."""
+    fields = []
+    for path, _ in errors:
+        if not path:
+            return []
+        if path[0] not in fields:
+            fields.append(path[0])
+    return fields
+
+
+def sub_schema(schema, fields) -> dict:
+    """Object schema restricted to `fields` of `schema`."""
+    properties = schema.get('properties', {})
+    return {
+        'type': 'object',
+        'properties': {name: properties[name] for name in fields if name in properties},
+        'required': [name for name in schema.get('required', []) if name in fields],
+    }
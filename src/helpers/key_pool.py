@@ -0,0 +1,68 @@
+import os
+
+from src.helpers.rate_limiter import get_limiter
+
+
+def load_keys(env: str) -> list:
+    """API keys named by `env`.
+
+    The variable may hold several comma-separated keys and `<env>_FILE` may name
+    a file with one key per line; duplicates are dropped, the order is kept.
+    """
+    keys = [key.strip() for key in (os.getenv(env) or '').split(',') if key.strip()]
+    path = os.getenv(f'{env}_FILE')
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            keys += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(keys))
+
+
+class KeyPool:
+    """API keys of one provider, each with its own rate limiter.
+
+    `acquire` picks the key that can send soonest, going round-robin among
+    equally free keys, so load spreads over the pool and a key cooling down
+    after a 429 is skipped while another one is free.
+    """
+
+    def __init__(self, url, keys, headers, scope='chat') -> None:
+        # a provider without a key still gets one (None) slot
+        self.keys = list(keys) or [None]
+        self.limiters = {key: get_limiter(url, key, scope) for key in self.keys}
+        self.header_sets = {key: headers(key) for key in self.keys}
+        self.next = 0
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def headers(self, key) -> dict:
+        return self.header_sets[key]
+
+    def limiter(self, key):
+        return self.limiters[key]
+
+    def pick(self, estimated_tokens=0):
+        count = len(self.keys)
+        best, best_wait = None, None
+        for offset in range(count):
+            key = self.keys[(self.next + offset) % count]
+            wait = self.limiters[key].wait_time(estimated_tokens)
+            if best is None or wait < best_wait:
+                best, best_wait = key, wait
+            if wait <= 0:
+                break
+        self.next = (self.keys.index(best) + 1) % count
+        return best
+
+    async def acquire(self, estimated_tokens=0, timeout=None):
+        """Key to send the next request with, after its rate limiter admitted the request within `timeout`."""
+        key = self.pick(estimated_tokens)
+        await self.limiters[key].acquire(estimated_tokens, timeout)
+        return key
+
+    def cooldown(self, key, seconds) -> None:
+        """Take `key` out of rotation for `seconds`."""
+        self.limiters[key].backoff(seconds)
+
+    def available(self) -> int:
+        return sum(1 for key in self.keys if not self.limiters[key].blocked)
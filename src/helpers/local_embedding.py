@@ -0,0 +1,94 @@
+import hashlib
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+MODEL_PATH_ENV = 'LOCAL_EMBEDDING_MODEL'
+
+# texts the model is fitted on at most, a larger corpus is sampled
+FIT_SAMPLE = 20000
+# most frequent hashed columns kept for the SVD, which bounds its memory and fitting time
+MAX_COLUMNS = 2**17
+
+
+class LocalEmbeddingModel:
+    """Embeddings computed in process on CPU: hashed word and bigram counts, TF-IDF weighted, reduced by SVD.
+
+    The model has to be fitted on a corpus first; its vectors are only comparable with
+    vectors of the same fit, which `name` tells apart. `transform` of separate blocks
+    can run on the thread pool in parallel, the sparse and dense products release the GIL.
+    """
+
+    def __init__(self, dimensions=256, n_features=2**20, workers=None) -> None:
+        self.dimensions = dimensions
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features, ngram_range=(1, 2), alternate_sign=False, norm=None, dtype=np.float32
+        )
+        self.tfidf = TfidfTransformer(sublinear_tf=True)
+        self.svd = None
+        # frequent hashed columns seen in at least two fitted texts, the only ones the SVD is computed on
+        self.columns = None
+        self.fingerprint = None
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='local-embedding')
+
+    @property
+    def fitted(self) -> bool:
+        return self.svd is not None
+
+    @property
+    def name(self) -> str:
+        return f'local-tfidf-svd-{self.fingerprint}' if self.fitted else 'local-tfidf-svd'
+
+    def fit(self, texts: list):
+        """Fit the IDF weights and the SVD projection on `texts`, the corpus to embed or a sample of it."""
+        if len(texts) > FIT_SAMPLE:
+            texts = random.Random(0).sample(list(texts), FIT_SAMPLE)
+        counts = self.vectorizer.transform(texts)
+        frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        columns = np.argsort(frequency, kind='stable')[::-1][:MAX_COLUMNS]
+        self.columns = np.sort(columns[frequency[columns] >= 2])
+        weighted = self.tfidf.fit_transform(counts[:, self.columns])
+        # SVD yields at most one dimension less than the number of texts
+        components = min(self.dimensions, weighted.shape[0] - 1)
+        if components < 1:
+            raise ValueError('fitting the local embedding model needs at least 2 texts')
+        self.svd = TruncatedSVD(components, algorithm='randomized', n_iter=2, random_state=0).fit(weighted)
+        self.svd.components_ = self.svd.components_.astype(np.float32)
+        self.fingerprint = hashlib.sha256(self.svd.components_.tobytes()).hexdigest()[:12]
+        return self
+
+    def transform(self, texts: list) -> np.ndarray:
+        """Unit length float32 vectors of `texts`, one row per text."""
+        if not self.fitted:
+            raise ValueError('local embedding model is not fitted')
+        vectors = self.svd.transform(self.tfidf.transform(self.vectorizer.transform(texts)[:, self.columns]))
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def save(self, path) -> None:
+        state = {'dimensions': self.dimensions, 'vectorizer': self.vectorizer, 'tfidf': self.tfidf,
+                 'columns': self.columns, 'svd': self.svd, 'fingerprint': self.fingerprint}
+        joblib.dump(state, path)
+
+    @classmethod
+    def load(cls, path, workers=None):
+        state = joblib.load(path)
+        model = cls(state['dimensions'], workers=workers)
+        model.vectorizer, model.tfidf = state['vectorizer'], state['tfidf']
+        model.columns, model.svd, model.fingerprint = state['columns'], state['svd'], state['fingerprint']
+        return model
+
+
+def load_local_model(path=None, workers=None) -> LocalEmbeddingModel:
+    """Model saved at `path` or LOCAL_EMBEDDING_MODEL, an unfitted one when no file exists yet."""
+    path = path or os.getenv(MODEL_PATH_ENV)
+    if path and os.path.exists(path):
+        return LocalEmbeddingModel.load(path, workers=workers)
+    return LocalEmbeddingModel(workers=workers)
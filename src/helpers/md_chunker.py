@@ -0,0 +1,92 @@
+import re
+
+from src.helpers.token_budget import estimate_tokens
+
+HEADING = re.compile(r'#{1,6}\s')
+
+# ever finer spans a piece too long for a chunk is split into: paragraphs, lines, sentences, words
+LEVELS = (
+    re.compile(r'[^\n](?:[^\n]|\n(?![ \t]*\n))*'),
+    re.compile(r'[^\n]+'),
+    re.compile(r'[^.!?\n]+[.!?]*\s*'),
+    re.compile(r'\S+\s*'),
+)
+
+# tokens kept free in every chunk for the heading repeated on top of a continued section
+HEADING_RESERVE = 48
+
+
+class Chunk:
+    """Part of a markdown body: `text` is what gets embedded, `start`/`end` locate it in the body."""
+
+    def __init__(self, text, start, end, tokens, heading='') -> None:
+        self.text = text
+        self.start = start
+        self.end = end
+        self.tokens = tokens
+        self.heading = heading
+        self.embedding = None
+
+    def as_dict(self) -> dict:
+        return {'start': self.start, 'end': self.end, 'heading': self.heading, 'embedding': self.embedding}
+
+
+def pieces(body, start, end, limit, family, level=0):
+    """(start, end, tokens) spans of body[start:end] at `level`, each of at most `limit` tokens."""
+    for match in LEVELS[level].finditer(body, start, end):
+        text = match.group()
+        if not text.strip():
+            continue
+        tokens = estimate_tokens(text, family)
+        if tokens <= limit:
+            yield match.start(), match.end(), tokens
+        elif level < len(LEVELS) - 1:
+            yield from pieces(body, match.start(), match.end(), limit, family, level + 1)
+        else:
+            # a single word longer than a chunk, e.g. an inline data URI, is cut by characters
+            step = max(1, len(text) * limit // tokens)
+            for offset in range(0, len(text), step):
+                part = text[offset : offset + step]
+                yield match.start() + offset, match.start() + offset + len(part), estimate_tokens(part, family)
+
+
+def chunk_markdown(body: str, max_tokens: int, family: str = 'other') -> list:
+    """Split `body` into chunks of at most `max_tokens`, preferring heading, then paragraph boundaries.
+
+    A body that fits is a single chunk holding the body unchanged. A section cut into
+    several chunks repeats its heading on top of each continuation.
+    """
+    if not body.strip():
+        return []
+    total = estimate_tokens(body, family)
+    if total <= max_tokens:
+        return [Chunk(body, 0, len(body), total)]
+    reserve = min(HEADING_RESERVE, max_tokens // 4)
+    chunks = []
+    heading = ''
+    current = None
+
+    def flush():
+        start, end, tokens, prefix, section = current
+        text = body[start:end].strip()
+        chunks.append(Chunk(f'{prefix}\n\n{text}' if prefix else text, start, end, tokens, section))
+
+    for start, end, tokens in pieces(body, 0, len(body), max_tokens - reserve, family):
+        text = body[start:end]
+        opens_section = HEADING.match(text) is not None
+        if current and (current[2] + tokens > max_tokens or (opens_section and current[2] >= max_tokens // 2)):
+            flush()
+            current = None
+        if opens_section:
+            heading = text.split('\n', 1)[0].strip()
+        if current is None:
+            prefix = heading if heading and not opens_section else ''
+            if estimate_tokens(prefix, family) > reserve:
+                prefix = ''
+            current = [start, end, tokens + estimate_tokens(prefix, family), prefix, heading]
+        else:
+            current[1] = end
+            current[2] += tokens
+    if current:
+        flush()
+    return chunks
@@ -0,0 +1,144 @@
+import json
+import time
+
+from src.helpers.chat_connector import ChatConnector
+from src.helpers.json_schema import compile_schema
+
+
+def json_validator(text) -> bool:
+    """Accept a non-empty JSON object or list."""
+    try:
+        value = json.loads(text)
+    except (TypeError, ValueError):
+        return False
+    return isinstance(value, (dict, list)) and len(value) > 0
+
+
+def keys_validator(*keys):
+    """Accept a JSON object holding every key of `keys`."""
+
+    def validate(text) -> bool:
+        try:
+            value = json.loads(text)
+        except (TypeError, ValueError):
+            return False
+        return isinstance(value, dict) and all(key in value for key in keys)
+
+    return validate
+
+
+def schema_validator(schema):
+    """Accept JSON matching `schema`."""
+    validate = compile_schema(schema)
+
+    def check(text) -> bool:
+        try:
+            return not validate(json.loads(text))
+        except (TypeError, ValueError):
+            return False
+
+    return check
+
+
+class StageStats:
+    """Outcomes of one cascade stage."""
+
+    def __init__(self) -> None:
+        self.attempts = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.accepted / self.attempts if self.attempts else 0.0
+
+    def summary(self) -> dict:
+        return {
+            'attempts': self.attempts,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'hit_rate': self.hit_rate,
+            'tokens': self.tokens,
+            'avg_seconds': self.seconds / self.attempts if self.attempts else 0.0,
+        }
+
+
+class ModelCascade:
+    """Ask the cheapest model first and escalate while the answer fails validation.
+
+    `models` go from the smallest to the biggest. A stage answer is accepted when
+    `validator(text)` is truthy; rejected answers and errors move to the next
+    stage. The last stage answer is returned even when it fails validation, so a
+    cascade never answers worse than its biggest model alone.
+    """
+
+    def __init__(self, logger, models, validator=json_validator, options=None, connector=None) -> None:
+        self.logger = logger
+        self.models = list(models)
+        self.validator = validator
+        self.options = options
+        # connector(model) shares connectors with the caller, by default the cascade owns them
+        self.connector = connector or self.own_connector
+        self.connectors = {}
+        self.stats = {model: StageStats() for model in self.models}
+        self.billed_tokens = 0
+        self.last_model = None
+
+    def own_connector(self, model) -> ChatConnector:
+        chat = self.connectors.get(model)
+        if chat is None:
+            chat = ChatConnector(self.logger)
+            chat.init_model(model)
+            self.connectors[model] = chat
+        return chat
+
+    def accepts(self, validator, text) -> bool:
+        try:
+            return bool(validator(text))
+        except Exception as e:
+            self.logger.debug(f'cascade validator failed: {e}')
+            return False
+
+    async def ask(self, prompt, validator=None, options=None):
+        """AskResult of the first stage whose answer passes `validator` (default: the cascade's).
+
+        The result's `billed_tokens` cover every stage tried.
+        """
+        validator = validator or self.validator
+        options = options or self.options
+        last = len(self.models) - 1
+        spent = 0
+        for index, model in enumerate(self.models):
+            stats = self.stats[model]
+            stats.attempts += 1
+            start = time.perf_counter()
+            try:
+                result = await self.connector(model).ask(prompt, options)
+            except Exception as e:
+                stats.errors += 1
+                stats.seconds += time.perf_counter() - start
+                if index == last:
+                    raise
+                self.logger.warning(f'cascade {model} failed, escalating: {e}')
+                continue
+            stats.seconds += time.perf_counter() - start
+            stats.tokens += result.billed_tokens
+            self.billed_tokens += result.billed_tokens
+            spent += result.billed_tokens
+            result.billed_tokens = spent
+            self.last_model = model
+            if self.accepts(validator, result.text):
+                stats.accepted += 1
+                return result
+            stats.rejected += 1
+            if index == last:
+                self.logger.warning(f'cascade {model} answer failed validation, no bigger model left')
+                return result
+            self.logger.debug(f'cascade {model} answer rejected, escalating')
+
+    def summary(self) -> dict:
+        return {model: self.stats[model].summary() for model in self.models}
@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import deque
+
+from src.helpers.chat_connector import ChatConnector
+
+
+class LatencyStats:
+    """Rolling latency and error window of one model."""
+
+    def __init__(self, window=100) -> None:
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    def record(self, duration, ok=True) -> None:
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(duration)
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def p50(self):
+        return self.percentile(0.5)
+
+    @property
+    def p95(self):
+        return self.percentile(0.95)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def summary(self) -> dict:
+        return {'p50': self.p50, 'p95': self.p95, 'error_rate': self.error_rate, 'samples': len(self.outcomes)}
+
+
+class ModelRouter:
+    """Route each prompt to the fastest healthy model among `models`.
+
+    Models are ordered by rolling p50 latency; models above `max_error_rate` are
+    skipped while a healthier one exists and models without samples follow the
+    measured ones in their configured order. With `hedge` a duplicate goes to the
+    runner-up once the primary runs past its p95, the slower request is cancelled
+    and both are billed.
+    """
+
+    def __init__(
+        self, logger, models, hedge=False, max_error_rate=0.3, hedge_delay=20.0, options=None, connector=None
+    ) -> None:
+        self.logger = logger
+        self.models = list(models)
+        self.hedge = hedge
+        self.max_error_rate = max_error_rate
+        # used before a model has its own p95
+        self.hedge_delay = hedge_delay
+        self.options = options
+        # connector(model) shares connectors with the caller, by default the router owns them
+        self.connector = connector or self.own_connector
+        self.connectors = {}
+        self.stats = {model: LatencyStats() for model in self.models}
+        self.billed_tokens = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.last_model = None
+
+    def own_connector(self, model) -> ChatConnector:
+        chat = self.connectors.get(model)
+        if chat is None:
+            chat = ChatConnector(self.logger)
+            chat.init_model(model)
+            self.connectors[model] = chat
+        return chat
+
+    def rank(self) -> list:
+        healthy = [m for m in self.models if self.stats[m].error_rate <= self.max_error_rate]
+        candidates = healthy or self.models
+        measured = [m for m in candidates if self.stats[m].p50 is not None]
+        unmeasured = [m for m in candidates if self.stats[m].p50 is None]
+        return sorted(measured, key=lambda m: self.stats[m].p50) + unmeasured
+
+    async def ask_model(self, model, prompt):
+        chat = self.connector(model)
+        start = time.perf_counter()
+        try:
+            result = await chat.ask(prompt, self.options)
+        except asyncio.CancelledError:
+            # a lost race says nothing about the latency or health of the model, but the provider may still bill it
+            self.billed_tokens += chat.estimate_tokens(prompt)
+            raise
+        except Exception:
+            self.stats[model].record(time.perf_counter() - start, ok=False)
+            raise
+        self.stats[model].record(time.perf_counter() - start)
+        self.billed_tokens += result.billed_tokens
+        return model, result.text
+
+    async def ask(self, prompt) -> str:
+        order = self.rank()
+        error = None
+        while order:
+            model = order.pop(0)
+            try:
+                if self.hedge and order:
+                    self.last_model, text = await self.ask_hedged(model, order.pop(0), prompt)
+                else:
+                    self.last_model, text = await self.ask_model(model, prompt)
+                return text
+            except Exception as e:
+                self.logger.warning(f'router {model} failed: {e}')
+                error = e
+        raise error
+
+    async def ask_hedged(self, primary, secondary, prompt):
+        first = asyncio.create_task(self.ask_model(primary, prompt))
+        done, _ = await asyncio.wait({first}, timeout=self.stats[primary].p95 or self.hedge_delay)
+        if done:
+            if first.exception() is None:
+                return first.result()
+            self.logger.warning(f'router {primary} failed: {first.exception()}')
+            return await self.ask_model(secondary, prompt)
+
+        self.hedges += 1
+        self.logger.debug(f'router hedging {primary} with {secondary}')
+        second = asyncio.create_task(self.ask_model(secondary, prompt))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # both failed, report the primary error
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def summary(self) -> dict:
+        return {model: self.stats[model].summary() for model in self.models}
@@ -18,6 +18,18 @@ def save_json(dictionary, output_file):
         json.dump(dictionary, f, cls=NumpyEncoder)
 
 
+def as_vector(vector: Union[np.ndarray, List[float]]) -> np.ndarray:
+    """Contiguous float32 array of a vector, without a copy when it already is one."""
+    return np.ascontiguousarray(vector, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale every row of a matrix to unit length in place, zero rows stay zero."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, 1)
+    return matrix
+
+
 def normalize_vector(vector: Union[np.ndarray, List[float]]) -> np.ndarray:
     """Normalize a vector to unit length."""
     norm = np.linalg.norm(vector)
@@ -26,6 +38,14 @@ def normalize_vector(vector: Union[np.ndarray, List[float]]) -> np.ndarray:
     return vector
 
 
+def pool_vectors(vectors: List, weights: List = None) -> np.ndarray:
+    """Weighted mean of chunk vectors scaled to unit length; a single vector is returned unchanged."""
+    if len(vectors) == 1:
+        return as_vector(vectors[0])
+    pooled = np.average(np.asarray(vectors, dtype=np.float32), axis=0, weights=weights)
+    return as_vector(normalize_vector(pooled))
+
+
 def cosine_similarity(vec1: Union[np.ndarray, List[float]], vec2: Union[np.ndarray, List[float]]) -> float:
     """
     Calculate cosine similarity between two vectors.
@@ -56,13 +76,53 @@ def find_similarities(source_vector: Union[np.ndarray, List[float]], target_vect
     Returns:
         List of tuples (key, similarity_score) sorted by similarity (highest first)
     """
-    similarities = []
-    source_vector = np.array(source_vector)
-    
-    for key, vector in target_vectors_dict.items():
-        similarity = cosine_similarity(source_vector, np.array(vector))
-        similarities.append((key, similarity))
-    
-    # Sort by similarity (highest first)
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    return similarities
+    matrix = EmbeddingMatrix({key: {'embedding': vector} for key, vector in target_vectors_dict.items()})
+    return matrix.most_similar(source_vector, len(matrix))
+
+
+class EmbeddingMatrix:
+    """Embeddings of a corpus stacked into one contiguous float32 matrix with rows of unit length.
+
+    Records without an embedding are left out; `records` themselves are not changed.
+    """
+
+    def __init__(self, records: dict, field: str = 'embedding') -> None:
+        self.ids = [key for key, record in records.items() if record.get(field) is not None and len(record[field])]
+        self.index = {key: row for row, key in enumerate(self.ids)}
+        if self.ids:
+            self.matrix = normalize_rows(np.array([records[key][field] for key in self.ids], dtype=np.float32))
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def similarities(self, vector) -> np.ndarray:
+        """Cosine similarity of `vector` to every row, in the order of `ids`."""
+        if not len(self):
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix @ normalize_vector(as_vector(vector))
+
+    def most_similar(self, vector, n: int, exclude=None) -> List[tuple]:
+        """Up to `n` (key, similarity) pairs closest to `vector`, highest first, without the key `exclude`."""
+        scores = self.similarities(vector)
+        return self.top(scores, n, self.index.get(exclude))
+
+    def top(self, scores: np.ndarray, n: int, skip=None) -> List[tuple]:
+        """The `n` best (key, score) pairs of `scores`, one per row, leaving out row `skip`."""
+        if skip is not None:
+            scores = scores.copy()
+            scores[skip] = -np.inf
+        n = min(n, len(scores) - (skip is not None))
+        if n <= 0:
+            return []
+        rows = np.argpartition(-scores, n - 1)[:n]
+        rows = rows[np.argsort(-scores[rows], kind='stable')]
+        return [(self.ids[row], float(scores[row])) for row in rows]
+
+    def pairwise_top(self, n: int, block: int = 1024):
+        """(key, [(key, similarity), ...]) of the `n` closest other rows of every row, computed in row blocks."""
+        for start in range(0, len(self.ids), block):
+            scores = self.matrix[start : start + block] @ self.matrix.T
+            for offset, row_scores in enumerate(scores):
+                yield self.ids[start + offset], self.top(row_scores, n, start + offset)
@@ -0,0 +1,729 @@
+import json
+import re
+import time
+
+from src.helpers import token_budget
+from src.helpers.key_pool import KeyPool, load_keys
+from src.helpers.string_helper import find_between
+
+
+class ConnectorException(Exception):
+    def __init__(self, code, message) -> None:
+        self.code = code
+        self.message = message
+        super().__init__(f'Error {code}:{message}')
+
+
+# follow-up turn of a continuation, the partial answer precedes it as the model's own turn
+CONTINUE_PROMPT = (
+    'Continue exactly where your previous answer stopped. '
+    'Do not repeat anything already written and do not add an introduction or a code fence.'
+)
+
+
+# HTTP status of each Anthropic error type, an error event of a stream carries only the type
+ANTHROPIC_ERROR_STATUS = {
+    'invalid_request_error': 400,
+    'authentication_error': 401,
+    'permission_error': 403,
+    'not_found_error': 404,
+    'request_too_large': 413,
+    'rate_limit_error': 429,
+    'api_error': 500,
+    'overloaded_error': 529,
+}
+
+
+# keywords of the OpenAPI subset accepted as a Gemini responseSchema
+GEMINI_SCHEMA_KEYS = {
+    'type',
+    'format',
+    'description',
+    'nullable',
+    'enum',
+    'properties',
+    'required',
+    'items',
+    'minItems',
+    'maxItems',
+    'minimum',
+    'maximum',
+    'anyOf',
+}
+
+
+def schema_name(schema) -> str:
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', schema.get('title', 'answer'))[:64]
+
+
+def gemini_schema(schema):
+    """Convert a JSON schema to the Gemini responseSchema dialect."""
+    if not isinstance(schema, dict):
+        return schema
+    converted = {}
+    for key, value in schema.items():
+        if key not in GEMINI_SCHEMA_KEYS:
+            continue
+        if key == 'type' and isinstance(value, list):
+            kinds = [kind for kind in value if kind != 'null']
+            value = kinds[0] if kinds else 'string'
+            if 'null' in schema['type']:
+                converted['nullable'] = True
+        if key == 'properties':
+            value = {name: gemini_schema(node) for name, node in value.items()}
+        elif key == 'items':
+            value = gemini_schema(value)
+        elif key == 'anyOf':
+            value = [gemini_schema(node) for node in value]
+        converted[key] = value
+    return converted
+
+
+def fenced_json(text: str) -> str:
+    """Body of a ```json fence, or the text itself when there is none."""
+    return find_between(text, '```json', '```') or text
+
+
+class ProviderAdapter:
+    """Wire format of one provider API.
+
+    Adapters are stateless and shared by every model of the provider: `template`
+    is built once per model, `build_payload` adds the per-call parts to a copy.
+    """
+
+    google = False
+    claude = False
+    system_role = False
+    path = ''
+    # finish reason of a complete answer
+    stop_reason = None
+    # the API enforces a JSON schema on the answer
+    structured_output = True
+
+    def template(self, spec) -> dict:
+        return {}
+
+    def build_payload(
+        self, spec, prefix, question, extract_json, thinking=False, cached_content=None, schema=None
+    ) -> dict:
+        raise NotImplementedError
+
+    def stream_url(self, spec) -> str:
+        return spec.api_url
+
+    def stream_payload(self, payload) -> dict:
+        payload['stream'] = True
+        return payload
+
+    def parse_text(self, completion, extract_json) -> str:
+        raise NotImplementedError
+
+    def structured_text(self, completion) -> str:
+        """JSON text of an answer to a payload built with a schema."""
+        return self.parse_text(completion, True)
+
+    def is_truncated(self, completion) -> bool:
+        """The answer stopped at the output token limit."""
+        return False
+
+    def partial_text(self, completion) -> str:
+        """Raw text of a truncated answer."""
+        raise NotImplementedError
+
+    def continue_payload(self, payload, partial) -> dict:
+        """Follow-up of `payload` asking the model to continue its `partial` answer."""
+        raise NotImplementedError
+
+    def usage(self, completion):
+        return completion.get('usage') or None
+
+    def total_tokens(self, usage) -> int:
+        return usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+
+    def token_split(self, usage):
+        """(input, output) tokens of a usage block."""
+        return usage.get('input_tokens') or 0, usage.get('output_tokens') or 0
+
+    def cached_tokens(self, usage) -> int:
+        """Prompt tokens served from the provider's prompt cache."""
+        details = usage.get('input_tokens_details') or {}
+        return details.get('cached_tokens', 0) or 0
+
+    def parse_stream_event(self, event, state) -> str:
+        """Update the stream state from one event and return its text delta."""
+        raise NotImplementedError
+
+    def assemble_stream_response(self, state) -> dict:
+        """Response in the non-streaming shape built from the stream state."""
+        raise NotImplementedError
+
+
+class OpenAIChatAdapter(ProviderAdapter):
+    """OpenAI chat completions and the compatible Azure, GitHub and Together endpoints."""
+
+    path = '/chat/completions'
+    stop_reason = 'stop'
+
+    def __init__(self, prefix_role='system', sampling=True, defaults=None, structured_output=True) -> None:
+        # o1-mini rejects the system role, a leading user turn caches the same way
+        self.prefix_role = prefix_role
+        # reasoning models reject temperature and max_tokens
+        self.sampling = sampling
+        self.defaults = defaults
+        self.structured_output = structured_output
+
+    def template(self, spec) -> dict:
+        if self.defaults is not None:
+            return dict(self.defaults, model=spec.model)
+        if not self.sampling:
+            return {'model': spec.model}
+        return {'temperature': 0.01, 'max_tokens': min(16380, spec.max_output_tokens), 'model': spec.model}
+
+    def build_payload(
+        self, spec, prefix, question, extract_json, thinking=False, cached_content=None, schema=None
+    ) -> dict:
+        payload = dict(spec.template)
+        messages = [{'role': 'user', 'content': question}]
+        if prefix:
+            messages.insert(0, {'role': self.prefix_role, 'content': prefix})
+        payload['messages'] = messages
+        if schema and self.structured_output:
+            payload['response_format'] = {
+                'type': 'json_schema',
+                'json_schema': {'name': schema_name(schema), 'schema': schema, 'strict': False},
+            }
+        elif extract_json and spec.response_format:
+            payload['response_format'] = {'type': 'json_object'}
+        return payload
+
+    def stream_payload(self, payload) -> dict:
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}
+        return payload
+
+    def parse_text(self, completion, extract_json) -> str:
+        if completion.get('message'):
+            return str(completion['message']['content'])
+        choice = completion['choices'][0]
+        if choice['finish_reason'] == 'content_filter':
+            raise ConnectorException(701, 'The generated content is filtered')
+        if choice['finish_reason'] == 'length':
+            raise ConnectorException(701, 'The generated content is too long')
+        text = choice['message']['content']
+        return fenced_json(text) if extract_json else text
+
+    def is_truncated(self, completion) -> bool:
+        return bool(completion.get('choices')) and completion['choices'][0].get('finish_reason') == 'length'
+
+    def partial_text(self, completion) -> str:
+        return completion['choices'][0]['message'].get('content') or ''
+
+    def continue_payload(self, payload, partial) -> dict:
+        payload = dict(payload)
+        # json mode would force a complete object instead of the fragment
+        payload.pop('response_format', None)
+        payload['messages'] = payload['messages'] + [
+            {'role': 'assistant', 'content': partial},
+            {'role': 'user', 'content': CONTINUE_PROMPT},
+        ]
+        return payload
+
+    def total_tokens(self, usage) -> int:
+        return usage.get('total_tokens', 0)
+
+    def token_split(self, usage):
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+
+    def cached_tokens(self, usage) -> int:
+        details = usage.get('prompt_tokens_details') or {}
+        return details.get('cached_tokens', 0) or 0
+
+    def parse_stream_event(self, event, state) -> str:
+        if event.get('usage'):
+            state['usage'] = event['usage']
+        choice = (event.get('choices') or [{}])[0]
+        if choice.get('finish_reason'):
+            state['finish'] = choice['finish_reason']
+        return choice.get('delta', {}).get('content') or ''
+
+    def assemble_stream_response(self, state) -> dict:
+        text = ''.join(state['text'])
+        return {
+            'choices': [{'message': {'role': 'assistant', 'content': text}, 'finish_reason': state['finish']}],
+            'usage': state['usage'],
+        }
+
+
+class OpenAIResponsesAdapter(ProviderAdapter):
+    """OpenAI responses API."""
+
+    system_role = 'responses'
+    path = '/responses'
+    stop_reason = 'completed'
+
+    def template(self, spec) -> dict:
+        return {'temperature': 0.01, 'model': spec.model}
+
+    def build_payload(
+        self, spec, prefix, question, extract_json, thinking=False, cached_content=None, schema=None
+    ) -> dict:
+        payload = dict(spec.template)
+        payload['input'] = question
+        if prefix:
+            payload['instructions'] = prefix
+        if schema:
+            payload['text'] = {
+                'format': {'type': 'json_schema', 'name': schema_name(schema), 'schema': schema, 'strict': False}
+            }
+        elif extract_json and spec.response_format:
+            payload['text'] = {'format': {'type': 'json_object'}}
+        return payload
+
+    def parse_text(self, completion, extract_json) -> str:
+        output = completion['output'][0]
+        if output['status'] != 'completed':
+            raise ConnectorException(701, f'The generated content is {output["status"]}')
+        text = output['content'][0]['text']
+        return fenced_json(text) if extract_json else text
+
+    def is_truncated(self, completion) -> bool:
+        details = completion.get('incomplete_details') or {}
+        return completion.get('status') == 'incomplete' and details.get('reason') == 'max_output_tokens'
+
+    def partial_text(self, completion) -> str:
+        texts = []
+        for item in completion.get('output', []):
+            for content in item.get('content') or []:
+                if content.get('type', 'output_text') == 'output_text':
+                    texts.append(content.get('text', ''))
+        return ''.join(texts)
+
+    def continue_payload(self, payload, partial) -> dict:
+        payload = dict(payload)
+        payload.pop('text', None)
+        payload['input'] = [
+            {'role': 'user', 'content': payload['input']},
+            {'role': 'assistant', 'content': partial},
+            {'role': 'user', 'content': CONTINUE_PROMPT},
+        ]
+        return payload
+
+    def parse_stream_event(self, event, state) -> str:
+        kind = event.get('type', '')
+        if kind == 'response.output_text.delta':
+            return event.get('delta', '')
+        if kind in ('response.completed', 'response.incomplete'):
+            state['response'] = event['response']
+            state['finish'] = event['response'].get('status')
+        return ''
+
+    def assemble_stream_response(self, state) -> dict:
+        status = 'completed' if state['finish'] in (None, 'completed') else 'incomplete'
+        return {
+            'output': [{'status': status, 'content': [{'type': 'output_text', 'text': ''.join(state['text'])}]}],
+            'status': state['finish'],
+            'usage': state['usage'],
+        }
+
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic messages API, the static prefix is a cached system block."""
+
+    claude = True
+    system_role = 'external'
+    path = '/messages'
+    stop_reason = 'end_turn'
+
+    def template(self, spec) -> dict:
+        return {'temperature': 0.01, 'max_tokens': min(16380, spec.max_output_tokens), 'model': spec.model}
+
+    def build_payload(
+        self, spec, prefix, question, extract_json, thinking=False, cached_content=None, schema=None
+    ) -> dict:
+        payload = dict(spec.template)
+        payload['messages'] = [{'role': 'user', 'content': question}]
+        if prefix:
+            payload['system'] = [{'type': 'text', 'text': prefix, 'cache_control': {'type': 'ephemeral'}}]
+        if schema:
+            # a forced tool call is the structured output of the messages API
+            name = schema_name(schema)
+            payload['tools'] = [{'name': name, 'description': 'Record the answer.', 'input_schema': schema}]
+            payload['tool_choice'] = {'type': 'tool', 'name': name}
+        return payload
+
+    def parse_text(self, completion, extract_json) -> str:
+        if completion.get('stop_reason') in ('max_token', 'max_tokens'):
+            raise ConnectorException(701, 'The generated exceed max content')
+        text = str(completion['content'][0]['text'])
+        return fenced_json(text) if extract_json else text
+
+    def structured_text(self, completion) -> str:
+        if self.is_truncated(completion):
+            raise ConnectorException(701, 'The generated exceed max content')
+        for block in completion.get('content', []):
+            if block['type'] == 'tool_use':
+                return json.dumps(block['input'], ensure_ascii=False)
+        return self.parse_text(completion, True)
+
+    def is_truncated(self, completion) -> bool:
+        return completion.get('stop_reason') in ('max_token', 'max_tokens')
+
+    def partial_text(self, completion) -> str:
+        return ''.join(block.get('text', '') for block in completion.get('content', []) if block['type'] == 'text')
+
+    def continue_payload(self, payload, partial) -> dict:
+        # a trailing assistant turn is a prefill, the model resumes it directly; it must not end in whitespace
+        payload = dict(payload)
+        payload['messages'] = payload['messages'] + [{'role': 'assistant', 'content': partial.rstrip()}]
+        return payload
+
+    def cached_tokens(self, usage) -> int:
+        return usage.get('cache_read_input_tokens') or 0
+
+    def parse_stream_event(self, event, state) -> str:
+        kind = event.get('type', '')
+        if kind == 'message_start':
+            state['usage'] = dict(event['message'].get('usage', {}))
+        elif kind == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+            return event['delta']['text']
+        elif kind == 'message_delta':
+            state['finish'] = event['delta'].get('stop_reason')
+            state['usage'] = {**(state['usage'] or {}), **event.get('usage', {})}
+        elif kind == 'error':
+            kind, message = event['error'].get('type'), event['error'].get('message')
+            raise ConnectorException(ANTHROPIC_ERROR_STATUS.get(kind, 500), f'{kind} {message}')
+        return ''
+
+    def assemble_stream_response(self, state) -> dict:
+        return {
+            'content': [{'type': 'text', 'text': ''.join(state['text'])}],
+            'stop_reason': state['finish'],
+            'usage': state['usage'],
+        }
+
+
+class GeminiAdapter(ProviderAdapter):
+    """Google generateContent API."""
+
+    google = True
+    path = '/models/{api_model}:generateContent'
+    stop_reason = 'STOP'
+
+    def template(self, spec) -> dict:
+        return {
+            'generationConfig': {
+                'temperature': 0,
+                'topK': 40,
+                'topP': 0.95,
+                'maxOutputTokens': 8192,
+                'responseMimeType': 'text/plain',
+                'thinkingConfig': {'thinkingBudget': 0},
+            },
+        }
+
+    def build_payload(
+        self, spec, prefix, question, extract_json, thinking=False, cached_content=None, schema=None
+    ) -> dict:
+        payload = {'contents': [{'role': 'user', 'parts': [{'text': question}]}], **spec.template}
+        if thinking:
+            config = dict(payload['generationConfig'])
+            del config['thinkingConfig']
+            payload['generationConfig'] = config
+        if schema:
+            config = dict(payload['generationConfig'])
+            config['responseMimeType'] = 'application/json'
+            config['responseSchema'] = gemini_schema(schema)
+            payload['generationConfig'] = config
+        if cached_content:
+            payload['cachedContent'] = cached_content
+        elif prefix:
+            payload['systemInstruction'] = {'parts': [{'text': prefix}]}
+        return payload
+
+    def stream_url(self, spec) -> str:
+        return spec.api_url.replace(':generateContent', ':streamGenerateContent?alt=sse')
+
+    def stream_payload(self, payload) -> dict:
+        return payload
+
+    def parse_text(self, completion, extract_json) -> str:
+        candidate = completion['candidates'][0]
+        if candidate['finishReason'] == 'MAX_TOKENS':
+            raise ConnectorException(701, 'The generated exceed max content')
+        if candidate['finishReason'] == 'OTHER':
+            raise ConnectorException(701, 'The generated stopped for other reason')
+        text = fenced_json(str(candidate['content']['parts'][0]['text'])).strip()
+        if not text:
+            return ''
+        if text[0] == '[':
+            text = text[1:-1]
+        return re.sub(r'(?<!\\)\\(?!["\\/bfnrt]|u[0-9a-fA-F]{4})', r'', text)
+
+    def structured_text(self, completion) -> str:
+        # the answer is plain JSON, the fence and bracket clean-up of parse_text would break it
+        if completion['candidates'][0]['finishReason'] in ('MAX_TOKENS', 'OTHER'):
+            self.parse_text(completion, True)
+        return self.partial_text(completion)
+
+    def is_truncated(self, completion) -> bool:
+        return bool(completion.get('candidates')) and completion['candidates'][0].get('finishReason') == 'MAX_TOKENS'
+
+    def partial_text(self, completion) -> str:
+        parts = completion['candidates'][0].get('content', {}).get('parts', [])
+        return ''.join(part.get('text', '') for part in parts if not part.get('thought'))
+
+    def continue_payload(self, payload, partial) -> dict:
+        payload = dict(payload)
+        payload['contents'] = payload['contents'] + [
+            {'role': 'model', 'parts': [{'text': partial}]},
+            {'role': 'user', 'parts': [{'text': CONTINUE_PROMPT}]},
+        ]
+        return payload
+
+    def usage(self, completion):
+        return completion.get('usageMetadata') or None
+
+    def total_tokens(self, usage) -> int:
+        return usage.get('totalTokenCount', 0)
+
+    def token_split(self, usage):
+        return usage.get('promptTokenCount', 0), usage.get('candidatesTokenCount', 0)
+
+    def cached_tokens(self, usage) -> int:
+        return usage.get('cachedContentTokenCount', 0)
+
+    def parse_stream_event(self, event, state) -> str:
+        if event.get('usageMetadata'):
+            state['usage'] = event['usageMetadata']
+        candidate = (event.get('candidates') or [{}])[0]
+        if candidate.get('finishReason'):
+            state['finish'] = candidate['finishReason']
+        parts = candidate.get('content', {}).get('parts', [])
+        return ''.join(part.get('text', '') for part in parts if not part.get('thought'))
+
+    def assemble_stream_response(self, state) -> dict:
+        return {
+            'candidates': [{'content': {'parts': [{'text': ''.join(state['text'])}]}, 'finishReason': state['finish']}],
+            'usageMetadata': state['usage'],
+        }
+
+
+OPENAI_CHAT = OpenAIChatAdapter()
+OPENAI_O1 = OpenAIChatAdapter(prefix_role='user', sampling=False, structured_output=False)
+OPENAI_REASONING = OpenAIChatAdapter(sampling=False)
+OPENAI_RESPONSES = OpenAIResponsesAdapter()
+AZURE_PHI = OpenAIChatAdapter(
+    defaults={'temperature': 1.0, 'top_p': 1.0, 'max_tokens': 8192, 'repetition_penalty': 1},
+    structured_output=False,
+)
+ANTHROPIC = AnthropicAdapter()
+GEMINI = GeminiAdapter()
+
+
+def bearer_headers(api_key) -> dict:
+    return {'Authorization': f'Bearer {api_key}', 'Content-type': 'application/json'}
+
+
+def anthropic_headers(api_key) -> dict:
+    return {
+        'x-api-key': api_key,
+        'content-type': 'application/json',
+        'anthropic-version': '2023-06-01',
+        'anthropic-beta': 'prompt-caching-2024-07-31',
+    }
+
+
+def gemini_headers(api_key) -> dict:
+    # a header instead of the key= query keeps one url for every key of a pool
+    headers = {'content-type': 'application/json'}
+    if api_key:
+        headers['x-goog-api-key'] = api_key
+    return headers
+
+
+def together_headers(api_key) -> dict:
+    return {'Authorization': f'Bearer {api_key}', 'content-type': 'application/json', 'accept': 'application/json'}
+
+
+class Provider:
+    """Base url and credentials of one API vendor."""
+
+    def __init__(self, base_url, key_env, headers, required=True) -> None:
+        self.base_url = base_url
+        self.key_env = key_env
+        self.headers = headers
+        # a missing key fails at init_model instead of on the first request
+        self.required = required
+
+
+PROVIDERS = {
+    'openai': Provider('https://api.openai.com/v1', 'OPENAI_API_KEY', bearer_headers),
+    'anthropic': Provider('https://api.anthropic.com/v1', 'ANTHROPIC_API_KEY', anthropic_headers),
+    'gemini': Provider(
+        'https://generativelanguage.googleapis.com/v1beta', 'GOOGLE_API_KEY', gemini_headers, required=False
+    ),
+    'github': Provider('https://models.inference.ai.azure.com', 'GITHUB_API_KEY', bearer_headers, required=False),
+    'together': Provider('https://api.together.xyz/v1', 'TOGETHER_API_KEY', together_headers, required=False),
+}
+
+
+class ModelEntry:
+    """Registry row: a connector model name mapped to its provider and adapter."""
+
+    def __init__(self, provider, adapter, model, api_model=None, response_format=False, extract_json=True) -> None:
+        self.provider = provider
+        self.adapter = adapter
+        # model as sent in payloads and reported in logs, metrics and cache keys
+        self.model = model
+        # model as named in the endpoint url
+        self.api_model = api_model or model
+        self.response_format = response_format
+        self.extract_json = extract_json
+
+
+MODELS = {
+    'openai': ModelEntry('openai', OPENAI_CHAT, 'gpt-4o', response_format=True),
+    'openai4o': ModelEntry('openai', OPENAI_CHAT, 'gpt-4o', response_format=True),
+    '4o-mini': ModelEntry('openai', OPENAI_CHAT, 'gpt-4o-mini', response_format=True),
+    'o1-mini': ModelEntry('openai', OPENAI_O1, 'o1-mini'),
+    'o3-mini': ModelEntry('openai', OPENAI_REASONING, 'o3-mini'),
+    'openai41': ModelEntry('openai', OPENAI_RESPONSES, 'gpt-4.1', response_format='json'),
+    'openai41mini': ModelEntry('openai', OPENAI_RESPONSES, 'gpt-4.1-mini', response_format='json'),
+    'openai41nano': ModelEntry('openai', OPENAI_RESPONSES, 'gpt-4.1-nano', response_format='json'),
+    'claude': ModelEntry('anthropic', ANTHROPIC, 'claude-3-5-sonnet-20240620'),
+    'google': ModelEntry('gemini', GEMINI, 'google', api_model='gemini-1.5-flash-latest'),
+    'gemini': ModelEntry('gemini', GEMINI, 'gemini', api_model='gemini-2.5-flash'),
+    'gemini20': ModelEntry('gemini', GEMINI, 'gemini', api_model='gemini-2.0-flash'),
+    'phi4': ModelEntry('github', AZURE_PHI, 'Phi-4'),
+    'together': ModelEntry('together', OPENAI_CHAT, 'll'),
+}
+
+
+class ModelSpec:
+    """Immutable description of a model endpoint, shared by every request of a connector."""
+
+    __slots__ = (
+        'name',
+        'model',
+        'api_url',
+        'headers',
+        'api_key',
+        'keys',
+        'adapter',
+        'response_format',
+        'extract_json',
+        'max_output_tokens',
+        'template',
+    )
+
+    def __init__(
+        self,
+        name,
+        model,
+        api_url,
+        headers,
+        adapter,
+        api_key=None,
+        keys=None,
+        response_format=False,
+        extract_json=True,
+        max_output_tokens=None,
+        template=None,
+    ) -> None:
+        values = locals()
+        for slot in self.__slots__:
+            object.__setattr__(self, slot, values[slot])
+        if max_output_tokens is None:
+            limits = token_budget.MODEL_LIMITS.get(model, token_budget.DEFAULT_LIMITS)
+            object.__setattr__(self, 'max_output_tokens', limits[1])
+        if template is None:
+            object.__setattr__(self, 'template', adapter.template(self))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'ModelSpec is immutable, use replace() to change {name}')
+
+    def replace(self, **changes) -> 'ModelSpec':
+        values = {slot: getattr(self, slot) for slot in self.__slots__}
+        values.update(changes)
+        if 'template' not in changes:
+            values['template'] = None
+        return ModelSpec(**values)
+
+    @property
+    def google(self) -> bool:
+        return self.adapter.google
+
+    @property
+    def claude(self) -> bool:
+        return self.adapter.claude
+
+    @property
+    def system_role(self):
+        return self.adapter.system_role
+
+
+_pools = {}
+_specs = {}
+
+
+def key_pool(provider: str) -> KeyPool:
+    """Keys of `provider`, read from the environment once per process."""
+    if provider not in _pools:
+        entry = PROVIDERS[provider]
+        keys = load_keys(entry.key_env)
+        if not keys and entry.required:
+            raise ValueError(f'{entry.key_env} key is not set. ')
+        _pools[provider] = KeyPool(entry.base_url, keys, entry.headers)
+    return _pools[provider]
+
+
+def get_spec(name: str) -> ModelSpec:
+    """ModelSpec of a registered model name, built on first use."""
+    spec = _specs.get(name)
+    if spec is not None:
+        return spec
+    entry = MODELS.get(name)
+    if entry is None:
+        raise ValueError(f'Unknown chat model {name}, registered: {", ".join(MODELS)}')
+    provider = PROVIDERS[entry.provider]
+    keys = key_pool(entry.provider)
+    # the first key stands for the pool where a single key is needed, e.g. batch jobs
+    api_key = keys.keys[0]
+    spec = ModelSpec(
+        name,
+        entry.model,
+        provider.base_url + entry.adapter.path.format(api_model=entry.api_model),
+        keys.headers(api_key),
+        entry.adapter,
+        api_key=api_key,
+        keys=keys,
+        response_format=entry.response_format,
+        extract_json=entry.extract_json,
+    )
+    _specs[name] = spec
+    return spec
+
+
+def register_model(name: str, entry: ModelEntry) -> None:
+    MODELS[name] = entry
+    _specs.pop(name, None)
+
+
+def benchmark(name: str, iterations: int = 10000) -> dict:
+    """Microseconds per payload build and per response parse of a registered model."""
+    spec = get_spec(name)
+    adapter = spec.adapter
+    question = 'Podaj kwotę VAT z faktury. ' * 20
+    start = time.perf_counter()
+    for _ in range(iterations):
+        adapter.build_payload(spec, 'Instrukcje. ', question, True)
+    payload_us = (time.perf_counter() - start) / iterations * 1e6
+
+    state = {'text': ['```json{"vat": 23}```'], 'usage': {}, 'finish': adapter.stop_reason, 'response': None}
+    completion = adapter.assemble_stream_response(state)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        adapter.parse_text(completion, True)
+        adapter.usage(completion)
+    parse_us = (time.perf_counter() - start) / iterations * 1e6
+    return {'model': name, 'payload_us': payload_us, 'parse_us': parse_us}
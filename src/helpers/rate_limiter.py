@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+# default (requests per minute, tokens per minute) per provider host, tightened by the headers providers send
+PROVIDER_LIMITS = {
+    'api.openai.com': (500, 200000),
+    'api.anthropic.com': (50, 40000),
+    'generativelanguage.googleapis.com': (1000, 1000000),
+    'models.inference.ai.azure.com': (15, 150000),
+    'api.together.xyz': (60, 100000),
+}
+DEFAULT_LIMITS = (60, 100000)
+
+# embedding endpoints have budgets of their own, one request may carry a whole batch
+EMBEDDING_LIMITS = {
+    'api.openai.com': (3000, 1000000),
+    'generativelanguage.googleapis.com': (1500, 1000000),
+}
+DEFAULT_EMBEDDING_LIMITS = (300, 300000)
+SCOPE_LIMITS = {
+    'chat': (PROVIDER_LIMITS, DEFAULT_LIMITS),
+    'embedding': (EMBEDDING_LIMITS, DEFAULT_EMBEDDING_LIMITS),
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504, 529}
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+class TokenBucket:
+    """Budget refilled continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute) -> None:
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount) -> float:
+        self.refill()
+        amount = min(amount, self.per_minute)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60.0 / self.per_minute
+
+    def take(self, amount) -> None:
+        # may go negative when real usage is higher than the estimate
+        self.available -= amount
+
+    def resize(self, per_minute) -> None:
+        self.refill()
+        self.available = min(self.available, per_minute)
+        self.per_minute = per_minute
+
+
+class RateLimiter:
+    """Request and token per-minute scheduler of one provider.
+
+    `acquire` waits until both buckets can serve the request, `record` settles the
+    estimate against billed tokens and `backoff` pauses the provider after a 429.
+    """
+
+    def __init__(self, rpm, tpm) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.throttled = 0
+
+    def wait_time(self, estimated_tokens=0) -> float:
+        """Seconds until a request of `estimated_tokens` may be sent."""
+        return max(
+            self.blocked_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(estimated_tokens),
+        )
+
+    @property
+    def blocked(self) -> bool:
+        return self.blocked_until > time.monotonic()
+
+    async def acquire(self, estimated_tokens=0, timeout=None) -> None:
+        """Wait for the budget of one request; asyncio.TimeoutError when it is not free within `timeout` seconds."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.wait_time(estimated_tokens)
+            if wait <= 0:
+                self.requests.take(1)
+                self.tokens.take(estimated_tokens)
+                return
+            if end is not None and time.monotonic() + wait > end:
+                raise asyncio.TimeoutError(f'rate limit frees up in {wait:.1f}s, after the timeout')
+            await asyncio.sleep(wait)
+
+    def record(self, billed_tokens, estimated_tokens=0) -> None:
+        self.tokens.take(billed_tokens - estimated_tokens)
+
+    def backoff(self, seconds) -> None:
+        self.throttled += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def observe(self, headers) -> None:
+        """Adopt the limits the provider reports for this key."""
+        rpm = headers.get('x-ratelimit-limit-requests') or headers.get('anthropic-ratelimit-requests-limit')
+        tpm = headers.get('x-ratelimit-limit-tokens') or headers.get('anthropic-ratelimit-tokens-limit')
+        if rpm and rpm.isdigit() and int(rpm) != self.requests.per_minute:
+            self.requests.resize(int(rpm))
+        if tpm and tpm.isdigit() and int(tpm) != self.tokens.per_minute:
+            self.tokens.resize(int(tpm))
+
+
+def retry_after(headers):
+    """Seconds to wait according to Retry-After / retry-after-ms, None when absent."""
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+_limiters = {}
+
+
+def limiter_key(url, api_key=None, scope='chat'):
+    # limits apply per key, the registry holds a fingerprint instead of the key itself
+    fingerprint = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16] if api_key else ''
+    return urlsplit(url).hostname or '', fingerprint, scope
+
+
+def get_limiter(url, api_key=None, scope='chat') -> RateLimiter:
+    """Limiter of `api_key` at the provider serving `url`; `scope` 'embedding' has the embedding budgets."""
+    key = limiter_key(url, api_key, scope)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limits, default = SCOPE_LIMITS[scope]
+        limiter = RateLimiter(*limits.get(key[0], default))
+        _limiters[key] = limiter
+    return limiter
+
+
+def configure_limiter(url, rpm, tpm, api_key=None, scope='chat') -> RateLimiter:
+    """Override the budget of the provider serving `url`, e.g. for a higher usage tier."""
+    limiter = RateLimiter(rpm, tpm)
+    _limiters[limiter_key(url, api_key, scope)] = limiter
+    return limiter
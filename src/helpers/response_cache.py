@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CACHE_PATH_ENV = 'LLM_CACHE_PATH'
+
+
+class ResponseCache:
+    """On-disk store of raw LLM responses keyed by a hash of model, endpoint and request body.
+
+    Entries older than `ttl` seconds are ignored, the least recently used ones are
+    evicted once the stored responses exceed `max_bytes`.
+    """
+
+    def __init__(self, path, ttl=None, max_bytes=256 * 1024 * 1024) -> None:
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, '
+            'size INTEGER NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(model, url, payload) -> str:
+        """Hash of the request; api keys in the url query do not take part in the key."""
+        url = re.sub(r'([?&])key=[^&]*&?', r'\1', url).rstrip('?&')
+        body = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(f'{model}\n{url}\n{body}'.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT response, created FROM responses WHERE key=?', (key,)).fetchone()
+            now = time.time()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE responses SET accessed=? WHERE key=?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, response) -> None:
+        body = json.dumps(response, ensure_ascii=False)
+        size = len(body.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key=?', (key,)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses(key, response, created, accessed, size) VALUES (?, ?, ?, ?, ?)',
+                (key, body, now, now, size),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        rows = self.db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        target = self.max_bytes * 0.9
+        removed = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            removed.append((key,))
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM responses WHERE key=?', removed)
+        self.evictions += len(removed)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'bytes': self.total_bytes,
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM responses')
+            self.total_bytes = 0
+
+    def close(self) -> None:
+        self.db.close()
+
+
+_shared = {}
+
+
+def shared_cache(path=None, **kwargs):
+    """Return one cache per path; without a path the opt-in LLM_CACHE_PATH env var is used."""
+    path = path or os.getenv(CACHE_PATH_ENV)
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    if path not in _shared:
+        _shared[path] = ResponseCache(path, **kwargs)
+    return _shared[path]
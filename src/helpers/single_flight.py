@@ -0,0 +1,63 @@
+import asyncio
+import weakref
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight task.
+
+    The first caller of a key starts the task, callers arriving while it runs
+    await the same task and get its result or exception. The key is forgotten
+    as soon as the task ends, so nothing is cached beyond the flight. A flight
+    whose callers were all cancelled is cancelled too.
+    """
+
+    def __init__(self) -> None:
+        self.flights = {}
+        # callers still awaiting each running task
+        self.waiters = {}
+        self.started = 0
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self.flights)
+
+    def forget(self, key, task) -> None:
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        # retrieve the outcome so a flight whose callers were all cancelled does not warn
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, factory):
+        """(result of `factory()`, True when it came from a flight another caller started)."""
+        task = self.flights.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(factory())
+            self.flights[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # a cancelled caller leaves the flight running for the others
+            return await asyncio.shield(task), shared
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                task.cancel()
+
+
+_flights = weakref.WeakKeyDictionary()
+
+
+def get_flights() -> SingleFlight:
+    """Return the single-flight group bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    flights = _flights.get(loop)
+    if flights is None:
+        flights = SingleFlight()
+        _flights[loop] = flights
+    return flights
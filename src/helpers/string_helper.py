@@ -107,3 +107,48 @@ def url_frendly( tag_name: str) -> str:
         result = result.strip('-')
 
         return result
+
+
+def json_resume_point(text):
+    """Length of the prefix of truncated JSON `text` that ends after its last complete element.
+
+    The prefix keeps the separating comma, so a continuation starts with the next
+    element. Returns len(text) when no element is complete or the text is not JSON.
+    """
+    start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+    if start < 0:
+        return len(text)
+    depth = 0
+    in_string = False
+    escape = False
+    point = -1
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{[':
+            depth += 1
+        elif c in '}]':
+            depth -= 1
+            if depth >= 1:
+                point = i + 1
+        elif c == ',' and depth >= 1:
+            point = i + 1
+    return point if point > 0 else len(text)
+
+
+def stitch(head, tail, min_overlap=20):
+    """Join a continuation to the text it continues, dropping a leading fence and a repeated overlap."""
+    if tail.lstrip().startswith('```json'):
+        tail = tail.lstrip()[7:].lstrip('\n')
+    for size in range(min(len(head), len(tail), 400), min_overlap - 1, -1):
+        if head.endswith(tail[:size]):
+            return head + tail[size:]
+    return head + tail
@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper bounds in seconds of the request duration histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 180)
+
+
+class RequestMetrics:
+    """Measurements of one LLM or embedding call."""
+
+    def __init__(self, kind, model, endpoint) -> None:
+        self.kind = kind
+        self.model = model
+        self.endpoint = endpoint
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.time_to_headers = 0.0
+        self.total_time = 0.0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.cached_tokens = 0
+        self.cache_hit = False
+        self.retries = 0
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+
+    def finish(self, status) -> None:
+        self.status = status
+        self.total_time = time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            'timestamp': self.timestamp,
+            'kind': self.kind,
+            'model': self.model,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'time_to_headers': self.time_to_headers,
+            'total_time': self.total_time,
+            'tokens_in': self.tokens_in,
+            'tokens_out': self.tokens_out,
+            'cached_tokens': self.cached_tokens,
+            'cache_hit': self.cache_hit,
+            'retries': self.retries,
+        }
+
+
+class MetricsSink:
+    """In-process fan-out of RequestMetrics to the registered exporters."""
+
+    def __init__(self) -> None:
+        self.exporters = []
+
+    def subscribe(self, exporter):
+        self.exporters.append(exporter)
+        return exporter
+
+    def unsubscribe(self, exporter) -> None:
+        self.exporters.remove(exporter)
+
+    def emit(self, metrics: RequestMetrics) -> None:
+        for exporter in self.exporters:
+            exporter(metrics)
+
+
+class PrometheusExporter:
+    """Aggregates metrics and renders them in the Prometheus text exposition format."""
+
+    def __init__(self, prefix='llm') -> None:
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.seconds = defaultdict(float)
+
+    def __call__(self, metrics: RequestMetrics) -> None:
+        labels = (metrics.kind, metrics.model, metrics.endpoint, str(metrics.status))
+        with self.lock:
+            self.counters[('requests_total', labels)] += 1
+            self.seconds[labels] += metrics.total_time
+            self.counters[('time_to_headers_seconds_total', labels)] += metrics.time_to_headers
+            self.counters[('request_bytes_total', labels)] += metrics.request_bytes
+            self.counters[('response_bytes_total', labels)] += metrics.response_bytes
+            self.counters[('input_tokens_total', labels)] += metrics.tokens_in
+            self.counters[('output_tokens_total', labels)] += metrics.tokens_out
+            self.counters[('cached_tokens_total', labels)] += metrics.cached_tokens
+            self.counters[('cache_hits_total', labels)] += int(metrics.cache_hit)
+            self.counters[('retries_total', labels)] += metrics.retries
+            buckets = self.buckets[labels]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if metrics.total_time <= bound:
+                    buckets[index] += 1
+
+    def label_text(self, labels, extra='') -> str:
+        kind, model, endpoint, status = labels
+        text = f'kind="{kind}",model="{model}",endpoint="{endpoint}",status="{status}"'
+        return '{' + text + extra + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {self.prefix}_{name} counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{self.prefix}_{name}{self.label_text(labels)} {value:g}')
+            name = f'{self.prefix}_request_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            for labels, buckets in sorted(self.buckets.items()):
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    le = ',le="%s"' % bound
+                    lines.append(f'{name}_bucket{self.label_text(labels, le)} {count}')
+                total = self.counters[('requests_total', labels)]
+                le = ',le="+Inf"'
+                lines.append(f'{name}_bucket{self.label_text(labels, le)} {total:g}')
+                lines.append(f'{name}_sum{self.label_text(labels)} {self.seconds[labels]:g}')
+                lines.append(f'{name}_count{self.label_text(labels)} {total:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class JsonlExporter:
+    """Appends one JSON line per call to `path`."""
+
+    def __init__(self, path) -> None:
+        self.path = str(path)
+        self.lock = threading.Lock()
+
+    def __call__(self, metrics: RequestMetrics) -> None:
+        line = json.dumps(metrics.as_dict(), ensure_ascii=False)
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+_sink = MetricsSink()
+
+
+def get_sink() -> MetricsSink:
+    return _sink
+
+
+@contextmanager
+def observe(metrics: RequestMetrics):
+    """Finish `metrics` with the outcome of the block and emit it to the sink."""
+    try:
+        yield metrics
+        metrics.finish(metrics.status or 200)
+    except BaseException as e:
+        metrics.finish(getattr(e, 'code', None) or type(e).__name__)
+        raise
+    finally:
+        _sink.emit(metrics)
@@ -0,0 +1,102 @@
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# (context window, max output tokens) by connector model name
+MODEL_LIMITS = {
+    'gpt-4o': (128000, 16384),
+    'gpt-4o-mini': (128000, 16384),
+    'gpt-4.1': (1047576, 32768),
+    'gpt-4.1-mini': (1047576, 32768),
+    'gpt-4.1-nano': (1047576, 32768),
+    'o1-mini': (128000, 65536),
+    'o3-mini': (200000, 100000),
+    'claude-3-5-sonnet-20240620': (200000, 8192),
+    'gemini': (1048576, 8192),
+    'google': (1048576, 8192),
+    'Phi-4': (16384, 8192),
+    # the Together model behind the 'together' registry entry
+    'll': (131072, 16380),
+}
+# models missing above keep the max_tokens their payload template always had
+DEFAULT_LIMITS = (131072, 16380)
+
+# average characters per token of a word piece; Polish text splits finer than English
+CHARS_PER_TOKEN = {
+    'openai': 3.6,
+    'anthropic': 3.2,
+    'gemini': 3.8,
+}
+DEFAULT_CHARS_PER_TOKEN = 3.2
+
+PIECES = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+
+def token_family(api_url: str) -> str:
+    if 'openai' in api_url:
+        return 'openai'
+    if 'anthropic' in api_url:
+        return 'anthropic'
+    if 'googleapis' in api_url:
+        return 'gemini'
+    return 'other'
+
+
+_encodings = {}
+
+
+def estimate_tokens(text: str, family: str = 'other') -> int:
+    """Fast local token count; exact for OpenAI when tiktoken is installed, a slight overestimate otherwise."""
+    if not text:
+        return 0
+    if family == 'openai' and tiktoken is not None:
+        if 'o200k' not in _encodings:
+            _encodings['o200k'] = tiktoken.get_encoding('o200k_base')
+        return len(_encodings['o200k'].encode(text, disallowed_special=()))
+    chars = CHARS_PER_TOKEN.get(family, DEFAULT_CHARS_PER_TOKEN)
+    tokens = 0
+    for piece in PIECES.findall(text):
+        tokens += math.ceil(len(piece) / chars) if len(piece) > 1 else 1
+    return tokens + text.count('\n') // 2
+
+
+def truncate_to_tokens(text: str, tokens: int, family: str = 'other') -> str:
+    """Cut `text` to at most `tokens`, preferring a paragraph or line boundary."""
+    if tokens <= 0:
+        return ''
+    if estimate_tokens(text, family) <= tokens:
+        return text
+    chars = int(tokens * CHARS_PER_TOKEN.get(family, DEFAULT_CHARS_PER_TOKEN))
+    cut = text[:chars]
+    while cut and estimate_tokens(cut, family) > tokens:
+        cut = cut[: int(len(cut) * 0.9)]
+    boundary = max(cut.rfind('\n\n'), cut.rfind('\n'))
+    if boundary > len(cut) // 2:
+        cut = cut[:boundary]
+    return cut.rstrip()
+
+
+def fit_sources(sources, budget: int, family: str = 'other', separator: str = '\n\n', min_tokens: int = 200) -> list:
+    """Keep sources in order while they fit into `budget` tokens.
+
+    The first source that does not fit is truncated when at least `min_tokens`
+    remain, everything after it is dropped.
+    """
+    fitted = []
+    remaining = budget
+    separator_tokens = estimate_tokens(separator, family)
+    for source in sources:
+        size = estimate_tokens(source, family) + (separator_tokens if fitted else 0)
+        if size <= remaining:
+            fitted.append(source)
+            remaining -= size
+            continue
+        if remaining >= min_tokens:
+            fitted.append(truncate_to_tokens(source, remaining - separator_tokens, family))
+        break
+    return fitted
@@ -0,0 +1,102 @@
+import asyncio
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# max open connections per provider host, anything else gets DEFAULT_CONNECTIONS
+PROVIDER_CONNECTIONS = {
+    'api.openai.com': 64,
+    'api.anthropic.com': 32,
+    'generativelanguage.googleapis.com': 64,
+    'models.inference.ai.azure.com': 16,
+    'api.together.xyz': 16,
+}
+DEFAULT_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 120
+
+
+class TransportRegistry:
+    """Pooled httpx clients, one per provider host, shared by every connector on an event loop."""
+
+    def __init__(self, connections=None, http2=None, transport=None) -> None:
+        self.clients = {}
+        self.transport = transport
+        self.connections = dict(PROVIDER_CONNECTIONS)
+        if connections:
+            self.connections.update(connections)
+        self.http2 = HTTP2_AVAILABLE if http2 is None else http2
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def host(self, url: str) -> str:
+        return urlsplit(url).hostname or ''
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """Return the keep-alive client for the provider serving `url`."""
+        host = self.host(url)
+        client = self.clients.get(host)
+        if client is None or client.is_closed:
+            size = self.connections.get(host, DEFAULT_CONNECTIONS)
+            limits = httpx.Limits(
+                max_connections=size, max_keepalive_connections=size, keepalive_expiry=KEEPALIVE_EXPIRY
+            )
+            client = httpx.AsyncClient(http2=self.http2, limits=limits, transport=self.transport)
+            self.clients[host] = client
+        return client
+
+    async def preconnect(self, urls) -> None:
+        """Open TCP+TLS connections ahead of the first real request."""
+
+        async def touch(url):
+            parts = urlsplit(url)
+            try:
+                await self.client(url).head(f'{parts.scheme}://{parts.netloc}/', timeout=10)
+            except httpx.HTTPError:
+                pass
+
+        await asyncio.gather(*(touch(url) for url in urls))
+
+    async def aclose(self) -> None:
+        clients = list(self.clients.values())
+        self.clients = {}
+        for client in clients:
+            await client.aclose()
+
+
+_registries = weakref.WeakKeyDictionary()
+
+
+def get_transport() -> TransportRegistry:
+    """Return the transport registry bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    registry = _registries.get(loop)
+    if registry is None:
+        registry = TransportRegistry()
+        _registries[loop] = registry
+    return registry
+
+
+def install_transport(registry: TransportRegistry) -> TransportRegistry:
+    """Bind a custom registry (connection limits, test transport) to the running event loop."""
+    _registries[asyncio.get_running_loop()] = registry
+    return registry
+
+
+async def close_transport() -> None:
+    """Close every pooled client of the running event loop."""
+    registry = _registries.pop(asyncio.get_running_loop(), None)
+    if registry:
+        await registry.aclose()
@@ -1,9 +1,18 @@
-import asyncio
 import pathlib
 
-from src.helpers.chat_connector import ChatConnector
+from src.helpers.chat_connector import AskOptions, AskResult, ChatConnector, StructuredPrompt
+from src.helpers.model_cascade import ModelCascade, keys_validator
+from src.helpers.model_router import ModelRouter
 
 PROMPT_DIR = pathlib.Path(__file__).parent.parent
+# extraction models from the cheapest, the last one is the former fixed model
+CASCADE_MODELS = ['openai41nano', '4o-mini', 'openai41']
+# JSON mode makes any small model answer some JSON, a stage is accepted only with every part system_chat.md asks for
+ANSWER_KEYS = ('genre', 'needed', 'period', 'text', 'value', 'cite')
+# the kadry steps list has no shape a small model can be checked against, it goes to the biggest model alone
+DIRECT_VARIANTS = {'kadry'}
+# free text answers go to the fastest of two providers, a slow one is hedged with the other
+ROUTER_MODELS = ['openai41', 'claude']
 
 
 class ChatPrompt:
@@ -11,32 +20,92 @@ class ChatPrompt:
         self.model = 'openai41'
         self.logger = logger
         self.billed_tokens = 0
+        self.cached_tokens = 0
         self.full_prompt = ''
         self.path = PROMPT_DIR / 'prompt'
+        self.connectors = {}
+        # long extractions resume a truncated answer instead of asking again
+        self.options = AskOptions(continuations=2)
+        self.cascade = ModelCascade(
+            logger, CASCADE_MODELS, keys_validator(*ANSWER_KEYS), self.options, connector=self.connector
+        )
+        self.router = ModelRouter(logger, ROUTER_MODELS, hedge=True, options=self.options, connector=self.connector)
+
+    def connector(self, model) -> ChatConnector:
+        # connectors are cheap, the http pool behind them is shared per event loop
+        chat = self.connectors.get(model)
+        if chat is None:
+            chat = ChatConnector(self.logger)
+            chat.init_model(model)
+            self.connectors[model] = chat
+        return chat
 
     async def completion(self, prompt, model):
-        self.full_prompt = prompt
-        chat = ChatConnector(self.logger)
-        chat.init_model(model)
-        await asyncio.sleep(0.1)
-        response = await chat.ask(prompt)
-        self.billed_tokens += chat.billed_tokens
-        return response
+        self.full_prompt = str(prompt)
+        chat = self.connector(model)
+        result = await chat.ask(prompt, self.options)
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+        return result.text
+
+    async def cascade_completion(self, prompt, validator=None):
+        """Answer from the cheapest model of the cascade whose output passes `validator`."""
+        self.full_prompt = str(prompt)
+        result = await self.cascade.ask(prompt, validator)
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+        self.logger.debug(f'Cascade answered by {result.model}')
+        return result.text
+
+    async def routed_completion(self, prompt):
+        """Answer from the model the router ranks best, hedged with the runner-up when it is slow."""
+        self.full_prompt = str(prompt)
+        billed = self.router.billed_tokens
+        text = await self.router.ask(prompt)
+        self.billed_tokens += self.router.billed_tokens - billed
+        self.logger.debug(f'Router answered by {self.router.last_model}')
+        return text
+
+    async def extract_structured(self, variant, text, schema):
+        """Extraction answer as a dict matching the JSON `schema`, invalid fields are re-asked."""
+        prompt = self.prompt(variant, text)
+        self.full_prompt = str(prompt)
+        result = await self.connector(self.model).ask_structured(prompt, schema, self.options)
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+        return result.value
+
+    async def completion_stream(self, prompt, model):
+        self.full_prompt = str(prompt)
+        chat = self.connector(model)
+        result = AskResult(None)
+        async for delta in chat.ask_stream(prompt, result=result):
+            yield delta
+        self.billed_tokens += result.billed_tokens
+        self.cached_tokens += result.cached_tokens
+
+    async def extract_stream(self, variant, text):
+        self.logger.debug(f'Stream  {self.model}  {variant}')
+        async for delta in self.completion_stream(self.prompt(variant, text), self.model):
+            yield delta
 
     async def explain(self, text, result):
         with open(self.path / 'explain.md', 'r') as file:
             explain_prompt = file.read()
-        res = await self.completion(f'{explain_prompt} {text} {result}  ', self.model)
+        res = await self.routed_completion(StructuredPrompt(f'{explain_prompt} ', f'{text} {result}  '))
         return res
 
     async def extract_fk(self, text):
         # self.logger.debug(f'Completion  {model}  invoice')
-        result = await self.completion(self.prompt('instrukcja_rejestry_vat.md', text), self.model)
+        result = await self.cascade_completion(self.prompt('instrukcja_rejestry_vat.md', text))
         return result
 
     async def extract(self, variant, text):
-        self.logger.debug(f'Completion  {self.model}  {variant}')
-        result = await self.completion(self.prompt(variant, text), self.model)
+        if variant in DIRECT_VARIANTS:
+            self.logger.debug(f'Completion  {CASCADE_MODELS[-1]}  {variant}')
+            return await self.completion(self.prompt(variant, text), CASCADE_MODELS[-1])
+        self.logger.debug(f'Completion  {CASCADE_MODELS[0]}  {variant}')
+        result = await self.cascade_completion(self.prompt(variant, text))
         return result
 
     def file(self, name):
@@ -69,7 +138,6 @@ class ChatPrompt:
             return f'\f# **Instrukcje**\n {instrukcja_rejestry} \f# **Raporty**\n{reports} '
 
     def prompt(self, variant, question):
-        if variant == 'kadry':
-            return f'{self.file("primary_chat.md")} {self.reports(variant)}\f# **Pytania** \n{question}'
-
-        return f'{self.file("system_chat.md")} {self.reports(variant)}\f# **Pytania** \n{question}'
+        # instructions and reports form a static prefix the providers can cache between questions
+        system = self.file('primary_chat.md' if variant == 'kadry' else 'system_chat.md')
+        return StructuredPrompt(f'{system} {self.reports(variant)}\f# **Pytania** \n', question)
@@ -5,13 +5,15 @@ from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
 from collections import defaultdict
 
-from src.helpers.np_helper import  cosine_similarity
+from src.helpers.np_helper import EmbeddingMatrix
 
 
 class ContentClustering:
     def __init__(self, logger):
 
         self.logger = logger        
+        self.embeddings = {}
+        self.corpus = EmbeddingMatrix({})
 
 
     def load_embeddings_from_json(self, input_file):
@@ -19,6 +21,8 @@ class ContentClustering:
         try:
             with open(input_file, 'r', encoding='utf-8') as f:
                 self.embeddings = json.load(f)
+            # one float32 matrix of the normalized vectors of the corpus, the records keep their own
+            self.corpus = EmbeddingMatrix(self.embeddings)
             return True
         except Exception as e:
             self.logger.error(f'Error loading embeddings: {str(e)}')
@@ -38,14 +42,11 @@ class ContentClustering:
             self.logger.error('No embeddings available for clustering')
             raise ValueError('No embeddings available for clustering')
 
-        # Extract file names and embeddings
-        filenames = list(self.embeddings.keys())
-        embeddings_array = np.array([self.embeddings[filename]['embedding'] for filename in filenames])
-
         # Perform K-means clustering
+        filenames = self.corpus.ids
         self.logger.info(f'Performing K-means clustering with {n_clusters} clusters')
         kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
-        cluster_labels = kmeans.fit_predict(embeddings_array)
+        cluster_labels = kmeans.fit_predict(self.corpus.matrix)
 
         # Organize results by cluster
         clusters = defaultdict(list)
@@ -66,9 +67,7 @@ class ContentClustering:
             self.logger.warning('No embeddings available for visualization')
             return
 
-        # Extract embeddings for visualization
-        filenames = list(self.embeddings.keys())
-        embeddings_array = np.array([self.embeddings[filename]['embedding'] for filename in filenames])
+        filenames = self.corpus.ids
 
         # Map filenames to cluster ids
         cluster_map = {}
@@ -82,7 +81,7 @@ class ContentClustering:
         # Reduce dimensions for visualization using t-SNE
         self.logger.info('Reducing dimensions with t-SNE for visualization')
         tsne = TSNE(n_components=2, random_state=42)
-        reduced_embeddings = tsne.fit_transform(embeddings_array)
+        reduced_embeddings = tsne.fit_transform(self.corpus.matrix)
 
         # Plot the clusters
         plt.figure(figsize=(12, 8))
@@ -119,34 +118,12 @@ class ContentClustering:
 
         self.logger.info(f'Finding top {top_n} similar document(s) for each embedding')
 
-        # Extract file names and embeddings
-        filenames = list(self.embeddings.keys())
         similar_docs = {}
 
-        for file1 in filenames:
-            # Get the embedding for the current file
-            embedding1 = np.array(self.embeddings[file1]['embedding'])
-
-            # Calculate similarities with all other documents
-            similarities = []
-            for file2 in filenames:
-                if file1 == file2:  # Skip self-comparison
-                    continue
-
-                # Get the embedding for the comparison file
-                embedding2 = np.array(self.embeddings[file2]['embedding'])
-
-                # Calculate cosine similarity
-                similarity = cosine_similarity(embedding1, embedding2)
-                url = self.embeddings[file2]['source_url']
-                similarities.append((file2, similarity, url))
-
-            # Sort by similarity (highest first)
-            similarities.sort(key=lambda x: x[1], reverse=True)
-
-            # Store top N similar documents
-            top_similar = similarities[:top_n]
-            similar_docs[file1] = {'twins': [(doc, sim, url) for doc, sim, url in top_similar]}
+        # cosine similarities of a block of rows against the whole corpus matrix, self-comparison skipped
+        for file1, top_similar in self.corpus.pairwise_top(top_n):
+            twins = [(doc, sim, self.embeddings[doc]['source_url']) for doc, sim in top_similar]
+            similar_docs[file1] = {'twins': twins}
 
         return similar_docs
 
@@ -1,20 +1,22 @@
+import asyncio
 import os
 import argparse
 import yaml
 
 from src.helpers.string_helper import clean_url
 from src.helpers.chat_connector import ChatConnector
+from src.helpers.embedding_cache import CACHE_PATH_ENV
 from src.helpers.embedding_connector import EmbeddingConnector
 from src.helpers.np_helper import  save_json
+from src.helpers.transport import close_transport
 
 
 class MarkdownEmbeddingGenerator:
     """Class to generate embeddings for markdown files in a directory."""
 
-    def __init__(self, logger):
+    def __init__(self, logger, model_type='google'):
         # Set up logger
         self.logger = logger
-        model_type = 'google'
         model_chat = 'gemini'
         self.embeddings = {}
 
@@ -79,10 +81,8 @@ class MarkdownEmbeddingGenerator:
     def extract_source_url(self, content: str) -> str:
         return self.extract_frontmatter_field(content, 'source_url', '')
 
-    async def summarize(self, content: str) -> str:
-        """Summarize the content using the chat model."""
-        self.logger.debug('Summarizing content')
-        prompt = (
+    def _summary_prompt(self, content: str) -> str:
+        return (
             'Your task is helping me to create better manual to program Madar.\n'
             'Given the content below, please summarize it in a concise and clear manner.\n'
             'Make sure to include all important information.\n'
@@ -97,8 +97,18 @@ class MarkdownEmbeddingGenerator:
             'Please summarize the following content:\n\n'
             f'{content}'
         )
-        response = await self.chat.ask(prompt)
-        return response
+
+    async def summarize(self, content: str) -> str:
+        """Summarize the content using the chat model."""
+        self.logger.debug('Summarizing content')
+        result = await self.chat.ask(self._summary_prompt(content))
+        return result.text
+
+    async def summarize_many(self, contents: list, concurrency: int = 8) -> list:
+        """Summarize several contents in parallel, failed items give an empty summary."""
+        self.logger.debug(f'Summarizing {len(contents)} contents')
+        answers = await self.chat.ask_many([self._summary_prompt(c) for c in contents], concurrency=concurrency)
+        return [answer.text if answer.ok else '' for answer in answers]
 
     def process_links(self, directory_path):
         file_count = 0
@@ -154,6 +164,7 @@ class MarkdownEmbeddingGenerator:
 
         self.logger.debug(f'Traversing directory: {directory_path}')
         embeddings_data = {}
+        bodies = []
 
         # Walk through the directory
         for root, _, files in os.walk(directory_path):
@@ -171,28 +182,43 @@ class MarkdownEmbeddingGenerator:
                         related_links = self.extract_links(content)
                         tags = self.extract_tags(content)
                         source = clean_url(self.extract_source_url(content))
-                        embedding = await self.connector.embed(body_content)
                         # summary = await self.summarize(body_content)
 
-                        # Store relative path and embedding
+                        # Store relative path, the embedding is computed for all files at once
                         rel_path = os.path.relpath(file_path, directory_path)
                         embeddings_data[rel_path] = {
                             'id': rel_path,
-                            'embedding': embedding,
+                            'embedding': None,
                             'related_links': related_links,
                             'tags': tags,
                             #'summary': summary,
                             'source_url': source,
                         }
-
-                        file_count += 1
+                        bodies.append(body_content)
                     except Exception as e:
                         self.logger.error(f'Error processing {file_path}: {str(e)}')
-                        break
+                        continue
+
+        documents = await self.connector.embed_documents(bodies, progress=self.log_progress)
+        for index, ((rel_path, record), document) in enumerate(zip(list(embeddings_data.items()), documents)):
+            if document is None:
+                self.logger.error(f'Error embedding {rel_path}: {self.connector.batch_errors.get(index)}')
+                del embeddings_data[rel_path]
+                continue
+            record['embedding'] = document.embedding
+            # long bodies keep the vector of every chunk for retrieval of the matching section
+            if len(document.chunks) > 1:
+                record['chunks'] = [chunk.as_dict() for chunk in document.chunks]
+            file_count += 1
+        if self.connector.cache:
+            self.logger.info(f'Embedding cache: {self.connector.cache.stats()}')
         self.embeddings = embeddings_data
         self.repair_path()
         return file_count
 
+    def log_progress(self, done, total):
+        self.logger.info(f'Embedded {done}/{total} chunks')
+
     def repair_path(self):
         for file_name in self.embeddings.keys():
             file1 = self.embeddings[file_name]
@@ -217,14 +243,17 @@ if __name__ == '__main__':
         '--model',
         '-m',
         type=str,
-        default='gemini',
-        choices=['gemini', 'openai', 'azure'],
-        help='Embedding model type to use (gemini, openai, or azure)',
+        default='google',
+        choices=['google', 'gemini', 'openai', 'azure', 'local'],
+        help='Embedding model type to use (google, gemini, openai, azure, or local for offline CPU)',
     )
     parser.add_argument('--input', '-i', type=str, help='Input JSON file containing pre-computed embeddings')
     parser.add_argument('--cluster', '-c', action='store_true', help='Perform clustering on the embeddings')
+    parser.add_argument('--cache', type=str, help=f'Embedding cache file (default: ${CACHE_PATH_ENV})')
 
     args = parser.parse_args()
+    if args.cache:
+        os.environ[CACHE_PATH_ENV] = args.cache
 
     # Configure logging
     import logging
@@ -232,5 +261,25 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logger = logging.getLogger('md_embeddings')
 
-    # Create instance of the embedding generator
-    generator = MarkdownEmbeddingGenerator(logger)
+    async def main():
+        # Create instance of the embedding generator
+        generator = MarkdownEmbeddingGenerator(logger, args.model)
+        try:
+            if args.directory:
+                count = await generator.process_directory(args.directory)
+                logger.info(f'Embedded {count} files from {args.directory}')
+                if args.output:
+                    generator.save_embeddings_to_json(args.output)
+        finally:
+            # drain the pooled connections before the loop goes away
+            await close_transport()
+
+        embeddings_file = args.input or args.output
+        if args.cluster and embeddings_file:
+            from src.md_clustering import ContentClustering
+
+            clustering = ContentClustering(logger)
+            if clustering.load_embeddings_from_json(embeddings_file):
+                logger.info(f'Clusters: {clustering.perform_clustering()}')
+
+    asyncio.run(main())
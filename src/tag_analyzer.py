@@ -1,14 +1,16 @@
+import asyncio
 import json
 import os
 import logging
-import numpy as np
+import sys
 from typing import Dict, List, Any
 from pathlib import Path
 
 from src.helpers.string_helper import url_frendly
 from src.helpers.chat_connector import ChatConnector
 from src.helpers.embedding_connector import EmbeddingConnector
-from src.helpers.np_helper import cosine_similarity
+from src.helpers.np_helper import EmbeddingMatrix, NumpyEncoder
+from src.helpers.transport import close_transport
 
 
 class TagAnalyzer:
@@ -32,6 +34,9 @@ class TagAnalyzer:
         self.embedding_model = EmbeddingConnector(logger)
         self.embedding_model.init_model('google')
         self.embeddings = None
+        self.corpus = EmbeddingMatrix({})
+        # prompt tokens spent on source samples of one tag
+        self.source_budget = 24000
 
     def load_tag_report(self) -> Dict[str, Any]:
         if not self.embeddings:
@@ -50,6 +55,8 @@ class TagAnalyzer:
         try:
             with open(self.output_dir / 'embeddings.json', 'r', encoding='utf-8') as f:
                 self.embeddings = json.load(f)
+            # one float32 matrix of the normalized vectors of all posts, the records keep their own
+            self.corpus = EmbeddingMatrix(self.embeddings)
 
             self.logger.info(f'Loaded embeddings for {len(self.embeddings)} posts')
             return True
@@ -108,8 +115,12 @@ class TagAnalyzer:
         Returns:
             Formatted prompt string
         """
-        content_sample = '\n\n'.join(source_content[:5])  # Limit to first 3 sources to avoid token limits
+        template = self._definition_prompt(tag_name, '')
+        # as many sources as fit the model budget, capped to keep the request cost reasonable
+        content_sample = '\n\n'.join(self.model.fit_sources(source_content, template, limit=self.source_budget))
+        return self._definition_prompt(tag_name, content_sample)
 
+    def _definition_prompt(self, tag_name: str, content_sample: str) -> str:
         prompt = f"""
 Based on the following articles that use the tag '{tag_name}', create a comprehensive definition
 of what this tag represents in the context of the Madar software system for Enterprise Resource Planning. 
@@ -184,21 +195,14 @@ they can expect to find under this tag.
             List of the n most similar posts with similarity scores
         """
 
-        if not self.embeddings or not embedding:
+        if not self.embeddings or embedding is None or not len(embedding) or not len(self.corpus):
             return []
 
         similarities = []
 
-        tag_embedding = np.array(embedding)
-
-        # Calculate cosine similarity for each post embedding
-        for post_id, post_data in self.embeddings.items():
-            if 'embedding' not in post_data or not post_data['embedding']:
-                continue
-
-            post_embedding = np.array(post_data['embedding'])
-            similarity = cosine_similarity(tag_embedding, post_embedding)
-
+        # Cosine similarity to every post embedding in one product with the corpus matrix
+        for post_id, similarity in self.corpus.most_similar(embedding, n):
+            post_data = self.embeddings[post_id]
             post_info = {
                 'id': post_id,
                 #'title': post_data.get('title', 'Unknown'),
@@ -210,27 +214,57 @@ they can expect to find under this tag.
 
             similarities.append(post_info)
 
-        sorted_similarities = sorted(similarities, key=lambda x: x['similarity'], reverse=True)
-        return sorted_similarities[:n]
+        return similarities
 
-    async def process_tags(self, tags) -> Dict[str, str]:
+    async def process_tags(self, tags, concurrency: int = 8, batch_state: Path = None) -> Dict[str, str]:
         """
         Process all tags and generate definitions.
 
+        Args:
+            tags: Tag names to process
+            concurrency: Number of definition requests sent in parallel
+            batch_state: When given, definitions go through the provider batch endpoint
+                and this file keeps the job state, rerun to resume after a restart
+
         Returns:
             Dictionary mapping tag names to their definitions
         """
 
         tag_definitions = {}
+        prepared = {tag_name: self.collect_tag_content(tag_name) for tag_name in tags}
+        prompts = {
+            tag_name: self._create_definition_prompt(tag_name, prepared[tag_name][1])
+            for tag_name in tags
+            if prepared[tag_name][1]
+        }
 
-        for tag_name in tags:
+        # every tag is stored as soon as its definition arrives, an interrupted run keeps what is done
+        async def finish(tag_name, definition):
             self.logger.info(f'Processing tag: {tag_name}')
-            tag_definitions[tag_name] = await self.process_tag(tag_name)
+            sources, source_content = prepared[tag_name]
+            if not source_content:
+                self.logger.warning(f"No content found for tag '{tag_name}'")
+            tag_definitions[tag_name] = await self.complete_tag(tag_name, sources, definition)
             self.store_tag(tag_definitions[tag_name])
 
-        return tag_definitions
+        if batch_state:
+            answers = await self.model.ask_batch(prompts, batch_state)
+            for tag_name, item in answers.items():
+                await finish(tag_name, item.text or '')
+        else:
+            names = list(prompts)
+            await self.model.ask_many(
+                list(prompts.values()),
+                concurrency=concurrency,
+                on_item=lambda item: finish(names[item.index], item.text or ''),
+            )
+        for tag_name in tags:
+            if tag_name not in prompts:
+                await finish(tag_name, '')
 
-    async def process_tag(self, tag_name: str):
+        return {tag_name: tag_definitions[tag_name] for tag_name in tags if tag_name in tag_definitions}
+
+    def collect_tag_content(self, tag_name: str):
         sources = self.get_tag_sources(tag_name)
 
         # Extract content from the source files
@@ -240,29 +274,36 @@ they can expect to find under this tag.
                 content = self.read_source_content(source['path'])
                 if content:
                     source_content.append(content)
+        return sources, source_content
+
+    async def process_tag(self, tag_name: str):
+        sources, source_content = self.collect_tag_content(tag_name)
 
         # Generate definition
         definition = ''
-        definition_embedding = None
-        similar_posts = []
-
         if source_content:
-            prompt = self._create_definition_prompt(tag_name, source_content)       
-            definition = await self.model.ask(prompt)
-            # Compute embedding for the definition
-            if definition:
-                try:
-                    self.logger.info(f"Computing embedding for tag '{tag_name}'")
-                    definition_embedding = await self.embedding_model.embed(definition)
-
-                    similar_posts = self.find_similar_posts(definition_embedding)
-                    self.logger.info(f"Found {len(similar_posts)} similar posts for tag '{tag_name}'")
-
-                except Exception as e:
-                    self.logger.error(f"Error computing embedding for tag '{tag_name}': {e}")
-                    definition_embedding = None
+            prompt = self._create_definition_prompt(tag_name, source_content)
+            definition = (await self.model.ask(prompt)).text
         else:
             self.logger.warning(f"No content found for tag '{tag_name}'")
+        return await self.complete_tag(tag_name, sources, definition)
+
+    async def complete_tag(self, tag_name: str, sources, definition: str):
+        definition_embedding = None
+        similar_posts = []
+
+        # Compute embedding for the definition
+        if definition:
+            try:
+                self.logger.info(f"Computing embedding for tag '{tag_name}'")
+                definition_embedding = await self.embedding_model.embed(definition)
+
+                similar_posts = self.find_similar_posts(definition_embedding)
+                self.logger.info(f"Found {len(similar_posts)} similar posts for tag '{tag_name}'")
+
+            except Exception as e:
+                self.logger.error(f"Error computing embedding for tag '{tag_name}': {e}")
+                definition_embedding = None
 
         return {
             'tag_name': tag_name,
@@ -332,7 +373,7 @@ they can expect to find under this tag.
 
         try:
             with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, indent=2, ensure_ascii=False)
+                json.dump(output_data, f, indent=2, ensure_ascii=False, cls=NumpyEncoder)
 
             self.logger.info(f'Tag definitions processed {len(tag_definitions)}  saved to {output_file}')
 
@@ -340,3 +381,20 @@ they can expect to find under this tag.
         except Exception as e:
             self.logger.error(f'Error saving tag definitions: {e}')
             raise
+
+
+async def main(base_dir: Path):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    analyzer = TagAnalyzer(logging.getLogger('tag_analyzer'), base_dir)
+    try:
+        analyzer.load_tag_report()
+        tags = analyzer.get_unique_tags()
+        definitions = await analyzer.process_tags(tags)
+        analyzer.save_tags_to_json(definitions)
+    finally:
+        # drain the pooled connections before the loop goes away
+        await close_transport()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(Path(sys.argv[1])))
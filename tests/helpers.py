@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import unittest
+import unittest.async_case
+
+import httpx
+
+from src.helpers.circuit_breaker import reset_breakers
+from src.helpers.transport import TransportRegistry, install_transport, close_transport
+
+# providers whose keys are checked at init_model, every request of the tests goes to a MockTransport
+TEST_KEYS = ('OPENAI_API_KEY', 'ANTHROPIC_API_KEY', 'GOOGLE_API_KEY')
+
+
+def set_test_keys() -> None:
+    for name in TEST_KEYS:
+        os.environ.setdefault(name, 'test')
+
+
+def mock_transport(handler) -> None:
+    """Send every request of the running event loop to `handler`."""
+    install_transport(TransportRegistry(transport=httpx.MockTransport(handler)))
+
+
+def chat_completion(content, total_tokens=5, finish_reason='stop') -> httpx.Response:
+    """OpenAI chat completions answer with `content`."""
+    message = {'content': content}
+    return httpx.Response(
+        200,
+        json={
+            'choices': [{'message': message, 'finish_reason': finish_reason}],
+            'usage': {'total_tokens': total_tokens},
+        },
+    )
+
+
+class EmbeddingStandIn:
+    """Embeds a text as [len(text), number of requests so far]; a batch holding 'bad' is rejected with 400."""
+
+    def __init__(self) -> None:
+        self.batches = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        if 'requests' in body:
+            texts = [item['content']['parts'][0]['text'] for item in body['requests']]
+        else:
+            texts = body['input']
+        self.batches.append(texts)
+        if 'bad' in texts:
+            return httpx.Response(400, json={'error': {'message': 'invalid input'}})
+        vectors = [[float(len(text)), float(len(self.batches))] for text in texts]
+        if 'requests' in body:
+            return httpx.Response(200, json={'embeddings': [{'values': vector} for vector in vectors]})
+        # OpenAI does not promise the order of `data`, only its `index`
+        data = [{'index': index, 'embedding': vector} for index, vector in enumerate(vectors)]
+        return httpx.Response(200, json={'data': data[::-1], 'usage': {'prompt_tokens': len(texts)}})
+
+
+class MockedTestCase(unittest.async_case.IsolatedAsyncioTestCase):
+    """Async test case whose requests go to `self.endpoint`, the stand-in returned by `make_endpoint`.
+
+    Breakers are reset and the pooled transport is closed after every test.
+    """
+
+    def setUp(self) -> None:
+        self.logger = logging.getLogger(type(self).__name__)
+        set_test_keys()
+        return super().setUp()
+
+    def make_endpoint(self):
+        """Request handler installed before every test, None installs nothing."""
+        return None
+
+    async def asyncSetUp(self) -> None:
+        self.endpoint = self.make_endpoint()
+        if self.endpoint is not None:
+            mock_transport(self.endpoint)
+
+    async def asyncTearDown(self) -> None:
+        reset_breakers()
+        await close_transport()
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import pathlib
+import tempfile
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, ChatConnector
+from src.tag_analyzer import TagAnalyzer
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class SlowFirstEndpoint:
+    """Echoes the prompt; a prompt starting with 'slow' is answered only after `release` is set."""
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        prompt = body['messages'][-1]['content'] if 'messages' in body else json.dumps(body)
+        if 'slow' in prompt:
+            await self.release.wait()
+        if 'fail' in prompt:
+            return httpx.Response(400, json={'error': 'bad request'})
+        return chat_completion(f'answer {prompt}', total_tokens=2)
+
+
+class TestAskMany(MockedTestCase):
+    def make_endpoint(self):
+        return SlowFirstEndpoint()
+
+    def connector(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        return chat
+
+    async def test_items_are_handed_over_as_they_arrive(self):
+        chat = self.connector()
+        seen = []
+
+        def on_item(item):
+            seen.append(item.index)
+            if item.index == 1:
+                # the fast prompt is through while the slow one still waits
+                self.endpoint.release.set()
+
+        items = await chat.ask_many(['slow one', 'fast', 'fail'], concurrency=3, options=AskOptions(cache=False),
+                                    on_item=on_item)
+        self.assertEqual([item.index for item in items], [0, 1, 2])
+        self.assertEqual(seen[-1], 0)
+        self.assertEqual(sorted(seen), [0, 1, 2])
+        self.assertFalse(items[2].ok)
+        self.assertEqual(items[1].text, 'answer fast')
+
+    async def test_failing_handler_keeps_the_batch(self):
+        chat = self.connector()
+        self.endpoint.release.set()
+
+        async def on_item(item):
+            raise OSError('disk full')
+
+        items = await chat.ask_many(['a', 'b'], options=AskOptions(cache=False), on_item=on_item)
+        self.assertTrue(all(item.ok for item in items))
+
+    async def test_tags_are_stored_one_by_one(self):
+        with tempfile.TemporaryDirectory() as folder:
+            analyzer = TagAnalyzer(self.logger, pathlib.Path(folder))
+        analyzer.model = self.connector()
+        analyzer.collect_tag_content = lambda tag: ([], [f'content of {tag}'] if tag != 'empty' else [])
+        stored = []
+
+        async def complete_tag(tag_name, sources, definition):
+            return {'tag_name': tag_name, 'definition': definition}
+
+        def store_tag(definition):
+            stored.append(definition['tag_name'])
+            if definition['tag_name'] == 'fast':
+                self.endpoint.release.set()
+
+        analyzer.complete_tag = complete_tag
+        analyzer.store_tag = store_tag
+        analyzer._create_definition_prompt = lambda tag, content: tag
+        definitions = await analyzer.process_tags(['slow', 'fast', 'empty'], concurrency=2)
+        self.assertEqual(stored, ['fast', 'slow', 'empty'])
+        self.assertEqual(list(definitions), ['slow', 'fast', 'empty'])
+        self.assertEqual(definitions['slow']['definition'], 'answer slow')
+        self.assertEqual(definitions['empty']['definition'], '')
+
+
+if __name__ == '__main__':
+    unittest.main()
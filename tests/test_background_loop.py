@@ -0,0 +1,58 @@
+import logging
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from src.helpers.background_loop import run_sync
+from src.helpers.chat_connector import AskOptions, ChatConnector, ConnectorException
+from src.helpers.transport import get_transport
+from tests.helpers import chat_completion, mock_transport, set_test_keys
+
+
+def answer(request: httpx.Request) -> httpx.Response:
+    if b'fail' in request.content:
+        return httpx.Response(400, json={'error': 'bad request'})
+    return chat_completion('ok', total_tokens=3)
+
+
+async def use_mock_transport():
+    mock_transport(answer)
+
+
+async def current_client(url):
+    return get_transport().client(url), threading.current_thread().name
+
+
+class TestBackgroundLoop(unittest.TestCase):
+    def setUp(self) -> None:
+        self.logger = logging.getLogger('BackgroundLoop')
+        set_test_keys()
+        run_sync(use_mock_transport())
+        self.chat = ChatConnector(self.logger, cache=False)
+        self.chat.init_model('4o-mini')
+        return super().setUp()
+
+    def test_ask_sync_returns_result(self):
+        result = self.chat.ask_sync('question')
+        self.assertEqual(result.text, 'ok')
+        self.assertEqual(result.billed_tokens, 3)
+
+    def test_client_survives_calls_and_threads(self):
+        client, thread = run_sync(current_client(self.chat.api_url))
+        self.assertEqual(thread, 'llm-loop')
+        options = AskOptions(coalesce=False)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda i: self.chat.ask_sync(f'q{i}', options), range(32)))
+        self.assertEqual({r.text for r in results}, {'ok'})
+        self.assertIs(run_sync(current_client(self.chat.api_url))[0], client)
+
+    def test_exception_reaches_caller(self):
+        with self.assertRaises(ConnectorException) as raised:
+            self.chat.ask_sync('fail')
+        self.assertEqual(raised.exception.code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
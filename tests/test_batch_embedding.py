@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+import numpy as np
+
+from src.helpers.embedding_cache import EmbeddingCache
+from src.helpers.embedding_connector import EmbeddingConnector, EmbeddingConnectorException, pack_batches
+from src.helpers.np_helper import EmbeddingMatrix, find_similarities
+from tests.helpers import EmbeddingStandIn, MockedTestCase, mock_transport
+
+
+class TestBatchEmbedding(MockedTestCase):
+    def make_endpoint(self):
+        return EmbeddingStandIn()
+
+    def test_pack_batches(self):
+        self.assertEqual(pack_batches([1, 1, 1, 1, 1], 2, 100), [[0, 1], [2, 3], [4]])
+        self.assertEqual(pack_batches([40, 40, 40, 500, 10], 10, 100), [[0, 1], [2], [3], [4]])
+        self.assertEqual(pack_batches([], 2, 100), [])
+
+    async def test_order_and_packing(self):
+        connector = EmbeddingConnector(self.logger)
+        connector.init_model('openai')
+        connector.batch_size = 3
+        texts = [f'text {"x" * i}' for i in range(8)]
+        embeddings = await connector.batch_embed(texts + texts[:2])
+        self.assertEqual(len(self.endpoint.batches), 3)
+        self.assertEqual([e[0] for e in embeddings], [float(len(t)) for t in texts + texts[:2]])
+        self.assertEqual(embeddings[0].tolist(), embeddings[8].tolist())
+        self.assertEqual({e.dtype.name for e in embeddings}, {'float32'})
+        self.assertTrue(all(e.flags.c_contiguous and not e.flags.writeable for e in embeddings))
+
+    async def test_gemini_batch_endpoint(self):
+        connector = EmbeddingConnector(self.logger)
+        connector.init_model('gemini')
+        embeddings = await connector.batch_embed(['a', 'bb', 'ccc'])
+        np.testing.assert_array_equal(embeddings, [[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]])
+        self.assertEqual(self.endpoint.batches, [['a', 'bb', 'ccc']])
+
+    async def test_failing_item_keeps_batch(self):
+        connector = EmbeddingConnector(self.logger)
+        connector.init_model('openai')
+        embeddings = await connector.batch_embed(['one', 'two', 'bad', 'four', '  '])
+        self.assertEqual([e is None for e in embeddings], [False, False, True, False, True])
+        self.assertEqual(sorted(connector.batch_errors), [2, 4])
+        self.assertEqual(connector.batch_errors[2].code, 400)
+
+    async def test_cache_skips_unchanged_texts(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = EmbeddingCache(os.path.join(folder, 'embeddings.db'))
+            connector = EmbeddingConnector(self.logger, cache=cache)
+            connector.init_model('openai')
+            first = await connector.batch_embed(['alpha', 'beta'])
+            again = await connector.batch_embed(['alpha  \r\n', 'beta', 'gamma'])
+            np.testing.assert_array_equal(again[:2], first)
+            self.assertEqual(self.endpoint.batches, [['alpha', 'beta'], ['gamma']])
+            np.testing.assert_array_equal(await connector.embed('gamma'), again[2])
+            self.assertEqual(len(self.endpoint.batches), 2)
+            self.assertEqual(cache.stats()['hits'], 3)
+            self.assertEqual(cache.stats()['entries'], 3)
+            cache.close()
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = EmbeddingCache(os.path.join(folder, 'embeddings.db'), max_bytes=3 * 4 * 100)
+            for index in range(5):
+                cache.put(EmbeddingCache.make_key('m', None, str(index)), [float(index)] * 100)
+            self.assertLessEqual(cache.stats()['bytes'], 3 * 4 * 100)
+            self.assertGreater(cache.evictions, 0)
+            vector = cache.get(EmbeddingCache.make_key('m', None, '4'))
+            self.assertEqual(vector.dtype.name, 'float32')
+            self.assertIsNone(cache.get(EmbeddingCache.make_key('m', None, '0')))
+            cache.close()
+
+    def test_embedding_matrix(self):
+        records = {
+            'a': {'embedding': [1.0, 0.0]},
+            'b': {'embedding': [3.0, 4.0]},
+            'c': {'embedding': [0.0, 2.0]},
+            'none': {'embedding': None},
+        }
+        corpus = EmbeddingMatrix(records)
+        self.assertEqual(corpus.ids, ['a', 'b', 'c'])
+        self.assertEqual(corpus.matrix.dtype, np.float32)
+        np.testing.assert_allclose(corpus.matrix[corpus.index['b']], [0.6, 0.8], rtol=1e-6)
+        # the records keep their raw vectors
+        self.assertEqual(records['b']['embedding'], [3.0, 4.0])
+        self.assertEqual([key for key, _ in corpus.most_similar([0.0, 1.0], 2)], ['c', 'b'])
+        self.assertEqual([key for key, _ in corpus.most_similar([0.0, 1.0], 5, exclude='c')], ['b', 'a'])
+        pairs = dict(corpus.pairwise_top(1, block=2))
+        self.assertEqual({key: top[0][0] for key, top in pairs.items()}, {'a': 'b', 'b': 'c', 'c': 'b'})
+        self.assertAlmostEqual(pairs['a'][0][1], 0.6, places=6)
+
+    def test_empty_embedding_matrix(self):
+        corpus = EmbeddingMatrix({'none': {'embedding': None}})
+        self.assertEqual(len(corpus), 0)
+        self.assertEqual(corpus.similarities([1.0, 0.0]).shape, (0,))
+        self.assertEqual(corpus.most_similar([1.0, 0.0], 3), [])
+        self.assertEqual(list(corpus.pairwise_top(3)), [])
+        self.assertEqual(find_similarities([1.0, 0.0], {}), [])
+
+    async def test_concurrency_retry_and_progress(self):
+        in_flight = []
+        peak = [0]
+        throttled = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            in_flight.append(request)
+            peak[0] = max(peak[0], len(in_flight))
+            await asyncio.sleep(0.02)
+            in_flight.remove(request)
+            texts = json.loads(request.content)['input']
+            if texts[0] == 'text 3' and not throttled:
+                throttled.append(texts)
+                return httpx.Response(429, headers={'retry-after': '0'})
+            data = [{'index': index, 'embedding': [float(len(text))]} for index, text in enumerate(texts)]
+            return httpx.Response(200, json={'data': data, 'usage': {'prompt_tokens': len(texts)}})
+
+        mock_transport(handler)
+        connector = EmbeddingConnector(self.logger)
+        connector.init_model('openai')
+        connector.batch_size = 1
+        reports = []
+        texts = [f'text {index}' for index in range(12)]
+        embeddings = await connector.batch_embed(texts, concurrency=3, progress=lambda *done: reports.append(done))
+        np.testing.assert_array_equal(embeddings, [[6.0]] * 10 + [[7.0]] * 2)
+        self.assertEqual(len(throttled), 1)
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(reports[0], (0, 12))
+        self.assertEqual(reports[-1], (12, 12))
+        self.assertEqual(len(reports), 13)
+
+    @mock.patch('src.helpers.embedding_connector.backoff_delay', return_value=0.0)
+    async def test_transport_errors_are_retried(self, _):
+        failures = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if len(failures) < 2:
+                failures.append(request)
+                raise httpx.ConnectError('connection refused', request=request)
+            return httpx.Response(200, json={'data': [{'index': 0, 'embedding': [1.0]}], 'usage': {'prompt_tokens': 1}})
+
+        mock_transport(handler)
+        connector = EmbeddingConnector(self.logger, cache=False)
+        connector.init_model('openai')
+        self.assertEqual((await connector.embed('query')).tolist(), [1.0])
+        self.assertEqual(len(failures), 2)
+
+    async def test_backoff_past_the_deadline_raises(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(503, headers={'retry-after': '30'})
+
+        mock_transport(handler)
+        connector = EmbeddingConnector(self.logger, cache=False)
+        connector.init_model('openai')
+        with self.assertRaises(EmbeddingConnectorException) as raised:
+            await connector.embed('query', timeout=5)
+        self.assertEqual(raised.exception.code, 408)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import json
+import os
+import tempfile
+import unittest
+
+import httpx
+
+from src.helpers.batch_jobs import BatchJob, BatchJobException
+from src.helpers.chat_connector import ChatConnector
+from tests.helpers import MockedTestCase
+
+
+class BatchStandIn:
+    """In-process stand-in for the OpenAI, Anthropic and Gemini batch endpoints.
+
+    A job reports `in_progress` for `polls` status requests and then completes,
+    answering every request with its prompt upper-cased.
+    """
+
+    def __init__(self, polls=1) -> None:
+        self.polls = polls
+        self.files = {}
+        self.jobs = {}
+        self.uploads = 0
+        # batch creations answered with 500 before one succeeds
+        self.create_failures = 0
+
+    def answer(self, prompt):
+        return prompt.upper()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path == '/v1/files' and request.method == 'POST':
+            body = request.content.decode('utf-8')
+            lines = [json.loads(line.strip()) for line in body.split('\n') if line.startswith('{')]
+            self.files['file-in'] = lines
+            self.uploads += 1
+            return httpx.Response(200, json={'id': 'file-in'})
+        if path == '/v1/batches' and self.create_failures:
+            self.create_failures -= 1
+            return httpx.Response(500, text='server error')
+        if path == '/v1/batches':
+            self.jobs['batch-1'] = {'file': json.loads(request.content)['input_file_id'], 'polls': 0}
+            return httpx.Response(200, json={'id': 'batch-1', 'status': 'validating'})
+        if path == '/v1/batches/batch-1':
+            job = self.jobs['batch-1']
+            job['polls'] += 1
+            if job['polls'] <= self.polls:
+                return httpx.Response(200, json={'id': 'batch-1', 'status': 'in_progress'})
+            return httpx.Response(200, json={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out'})
+        if path == '/v1/files/file-out/content':
+            lines = []
+            for line in self.files['file-in']:
+                text = self.answer(line['body']['input'])
+                body = {
+                    'output': [{'status': 'completed', 'content': [{'text': text}]}],
+                    'usage': {'input_tokens': 1, 'output_tokens': 2},
+                }
+                lines.append({'custom_id': line['custom_id'], 'response': {'status_code': 200, 'body': body}})
+            return httpx.Response(200, text='\n'.join(json.dumps(line) for line in lines))
+
+        if path == '/v1/messages/batches':
+            self.jobs['msgbatch-1'] = {'requests': json.loads(request.content)['requests'], 'polls': 0}
+            return httpx.Response(200, json={'id': 'msgbatch-1', 'processing_status': 'in_progress'})
+        if path == '/v1/messages/batches/msgbatch-1':
+            job = self.jobs['msgbatch-1']
+            job['polls'] += 1
+            if job['polls'] <= self.polls:
+                return httpx.Response(200, json={'id': 'msgbatch-1', 'processing_status': 'in_progress'})
+            return httpx.Response(
+                200,
+                json={
+                    'id': 'msgbatch-1',
+                    'processing_status': 'ended',
+                    'results_url': 'http://standin/v1/messages/batches/msgbatch-1/results',
+                },
+            )
+        if path == '/v1/messages/batches/msgbatch-1/results':
+            lines = []
+            for item in self.jobs['msgbatch-1']['requests']:
+                text = self.answer(item['params']['messages'][0]['content'])
+                message = {
+                    'content': [{'type': 'text', 'text': f'```json{text}```'}],
+                    'stop_reason': 'end_turn',
+                    'usage': {'input_tokens': 3, 'output_tokens': 4},
+                }
+                lines.append({'custom_id': item['custom_id'], 'result': {'type': 'succeeded', 'message': message}})
+            return httpx.Response(200, text='\n'.join(json.dumps(line) for line in lines))
+
+        if path.endswith(':batchGenerateContent'):
+            requests = json.loads(request.content)['batch']['input_config']['requests']['requests']
+            self.jobs['batches/g1'] = {'requests': requests, 'polls': 0}
+            return httpx.Response(200, json={'name': 'batches/g1'})
+        if path == '/v1beta/batches/g1':
+            job = self.jobs['batches/g1']
+            job['polls'] += 1
+            if job['polls'] <= self.polls:
+                return httpx.Response(200, json={'name': 'batches/g1', 'metadata': {'state': 'BATCH_STATE_RUNNING'}})
+            responses = []
+            for item in job['requests']:
+                text = self.answer(item['request']['contents'][0]['parts'][0]['text'])
+                response = {
+                    'candidates': [{'finishReason': 'STOP', 'content': {'parts': [{'text': text}]}}],
+                    'usageMetadata': {'totalTokenCount': 5},
+                }
+                responses.append({'response': response, 'metadata': item['metadata']})
+            return httpx.Response(
+                200,
+                json={
+                    'name': 'batches/g1',
+                    'done': True,
+                    'metadata': {'state': 'BATCH_STATE_SUCCEEDED'},
+                    'response': {'inlinedResponses': {'inlinedResponses': responses}},
+                },
+            )
+        return httpx.Response(404, text=f'unknown {request.method} {path}')
+
+
+class TestBatchJobs(MockedTestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp.name, 'batch.json')
+        self.prompts = {'księgowanie VAT': 'vat', 'lista płac': 'płace'}
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        return super().tearDown()
+
+    def make_endpoint(self):
+        return BatchStandIn()
+
+    def connector(self, model):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model(model)
+        return chat
+
+    async def test_openai_batch(self):
+        chat = self.connector('openai41nano')
+        items = await chat.ask_batch(self.prompts, self.state_file, base_url='http://standin', poll_interval=0)
+        self.assertEqual(items['księgowanie VAT'].text, 'VAT')
+        self.assertEqual(items['lista płac'].text, 'PŁACE')
+        self.assertEqual(chat.billed_tokens, 6)
+
+    async def test_anthropic_batch(self):
+        chat = self.connector('claude')
+        items = await chat.ask_batch(self.prompts, self.state_file, base_url='http://standin', poll_interval=0)
+        self.assertEqual([item.text for item in items.values()], ['VAT', 'PŁACE'])
+        self.assertTrue(all(item.ok for item in items.values()))
+
+    async def test_gemini_batch(self):
+        chat = self.connector('gemini')
+        items = await chat.ask_batch(self.prompts, self.state_file, base_url='http://standin', poll_interval=0)
+        self.assertEqual(items['lista płac'].text, 'PŁACE')
+        self.assertEqual(chat.billed_tokens, 10)
+
+    async def test_resume_after_restart(self):
+        self.endpoint.polls = 3
+        job = BatchJob(self.logger, self.connector('claude'), self.state_file, base_url='http://standin')
+        await job.submit(self.prompts)
+        self.assertFalse(await job.poll())
+
+        # a new process only knows the state file
+        resumed = BatchJob(self.logger, self.connector('claude'), self.state_file, base_url='http://standin')
+        resumed.poll_interval = 0
+        self.assertEqual(resumed.job_id, 'msgbatch-1')
+        results = await resumed.wait()
+        self.assertEqual(results['lista płac']['text'], 'PŁACE')
+        self.assertEqual(len(self.endpoint.jobs), 1)
+
+    async def test_rerun_reuses_uploaded_file(self):
+        self.endpoint.create_failures = 1
+        chat = self.connector('openai41nano')
+        job = BatchJob(self.logger, chat, self.state_file, base_url='http://standin')
+        with self.assertRaises(BatchJobException):
+            await job.submit(self.prompts)
+        with open(self.state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        self.assertEqual((state['status'], state['input_file_id']), ('submitting', 'file-in'))
+
+        items = await chat.ask_batch(self.prompts, self.state_file, base_url='http://standin', poll_interval=0)
+        self.assertEqual(items['lista płac'].text, 'PŁACE')
+        self.assertEqual(self.endpoint.uploads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
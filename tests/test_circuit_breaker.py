@@ -0,0 +1,109 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, ChatConnector, ConnectorCircuitOpen, ConnectorException
+from src.helpers.circuit_breaker import CircuitBreaker, configure_breaker, deadline
+from src.helpers.rate_limiter import RateLimiter
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class SickEndpoint:
+    """gpt-4o answers 503, every other model answers normally; `delay` stalls the healthy answers."""
+
+    def __init__(self, delay=0.0) -> None:
+        self.delay = delay
+        self.models = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        model = request.read().decode('utf-8')
+        self.models.append('gpt-4o-mini' if 'gpt-4o-mini' in model else 'gpt-4o')
+        if self.models[-1] == 'gpt-4o':
+            return httpx.Response(503)
+        await asyncio.sleep(self.delay)
+        return chat_completion('ok')
+
+
+class TestCircuitBreaker(MockedTestCase):
+    def make_endpoint(self):
+        return SickEndpoint()
+
+    def connector(self, fallback=None):
+        chat = ChatConnector(self.logger, cache=False, fallback=fallback)
+        chat.init_model('openai4o')
+        chat.max_retries = 3
+        configure_breaker(chat.api_url, chat.model, threshold=2, reset_timeout=60)
+        return chat
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow(), 'a single probe while half-open')
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.trips, 1)
+
+    async def test_fail_fast(self):
+        chat = self.connector()
+        with self.assertRaises(ConnectorCircuitOpen):
+            await chat.ask('question', AskOptions(cache=False))
+        sent = len(self.endpoint.models)
+        with self.assertRaises(ConnectorCircuitOpen):
+            await chat.ask('question', AskOptions(cache=False))
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(self.endpoint.models), sent, 'an open circuit sends nothing')
+
+    async def test_failover(self):
+        chat = self.connector(fallback='4o-mini')
+        result = await chat.ask('question', AskOptions(cache=False))
+        self.assertEqual(result.text, 'ok')
+        self.assertEqual(result.model, 'gpt-4o-mini')
+        self.assertEqual(chat.billed_tokens, 5)
+        await chat.ask('question', AskOptions(cache=False))
+        self.assertEqual(self.endpoint.models, ['gpt-4o', 'gpt-4o', 'gpt-4o-mini', 'gpt-4o-mini'])
+
+    async def test_deadline(self):
+        self.endpoint.delay = 1.0
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        chat.max_retries = 0
+        start = time.perf_counter()
+        with deadline(0.2), self.assertRaises(ConnectorException) as raised:
+            await chat.ask('question', AskOptions(cache=False, timeout=5))
+        self.assertEqual(raised.exception.code, 408)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    async def test_open_circuit_spends_no_budget(self):
+        chat = self.connector()
+        limiter = chat.spec.keys.limiter(chat.spec.keys.keys[0])
+        with self.assertRaises(ConnectorCircuitOpen):
+            await chat.ask('question', AskOptions(cache=False))
+        spent = limiter.requests.per_minute - limiter.requests.available
+        with self.assertRaises(ConnectorCircuitOpen):
+            await chat.ask('question', AskOptions(cache=False))
+        self.assertAlmostEqual(limiter.requests.per_minute - limiter.requests.available, spent, places=1)
+
+    async def test_rate_limit_wait_ends_at_deadline(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        # the key pool of a provider is shared, give its key a budget of one request per minute for this test
+        pool, key = chat.spec.keys, chat.spec.keys.keys[0]
+        self.addCleanup(pool.limiters.__setitem__, key, pool.limiters[key])
+        pool.limiters[key] = RateLimiter(1, 10**6)
+        await chat.ask('first', AskOptions(cache=False))
+        start = time.perf_counter()
+        with self.assertRaises(ConnectorException) as raised:
+            await chat.ask('second', AskOptions(cache=False, timeout=0.3))
+        self.assertEqual(raised.exception.code, 408)
+        self.assertLess(time.perf_counter() - start, 0.2, 'no sleep for a budget that frees up after the deadline')
+
+
+if __name__ == '__main__':
+    unittest.main()
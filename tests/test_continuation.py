@@ -0,0 +1,100 @@
+import json
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, ChatConnector, ConnectorException
+from src.helpers.string_helper import json_resume_point, stitch
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class TestStitch(unittest.TestCase):
+    def test_overlap_is_dropped(self):
+        head = 'The quick brown fox jumps over the lazy dog and'
+        self.assertEqual(
+            stitch(head, 'jumps over the lazy dog and then runs away.'),
+            'The quick brown fox jumps over the lazy dog and then runs away.',
+        )
+        # an overlap shorter than `min_overlap` is taken as new text
+        self.assertEqual(stitch('one two', 'two three'), 'one twotwo three')
+        self.assertEqual(stitch('one two', 'two three', min_overlap=3), 'one two three')
+
+    def test_leading_fence_is_dropped(self):
+        self.assertEqual(stitch('{"a": [1,', '\n```json\n2]}'), '{"a": [1,2]}')
+
+    def test_resume_point(self):
+        text = '{"items": [{"a": 1}, {"a": 2}, {"a"'
+        self.assertEqual(text[: json_resume_point(text)], '{"items": [{"a": 1}, {"a": 2},')
+        fenced = '```json\n["x", "y, z", "w'
+        self.assertEqual(fenced[: json_resume_point(fenced)], '```json\n["x", "y, z",')
+        # nothing complete yet, or no JSON at all, keeps the whole text
+        self.assertEqual(json_resume_point('{"a'), 3)
+        self.assertEqual(json_resume_point('plain text'), 10)
+
+
+class ContinuingEndpoint:
+    """Answers the queued (content, finish_reason) pairs in turn, recording the request bodies."""
+
+    def __init__(self) -> None:
+        self.answers = []
+        self.bodies = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.bodies.append(json.loads(request.content))
+        content, finish_reason = self.answers.pop(0)
+        return chat_completion(content, total_tokens=len(self.bodies) * 10, finish_reason=finish_reason)
+
+
+class TestContinuation(MockedTestCase):
+    def make_endpoint(self):
+        return ContinuingEndpoint()
+
+    def connector(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        return chat
+
+    async def test_text_answer_is_continued(self):
+        self.endpoint.answers = [
+            ('The quick brown fox jumps over the lazy dog and', 'length'),
+            ('jumps over the lazy dog and then runs away.', 'stop'),
+        ]
+        chat = self.connector()
+        result = await chat.ask('question', AskOptions(extract_json=False, continuations=2))
+        self.assertEqual(result.text, 'The quick brown fox jumps over the lazy dog and then runs away.')
+        self.assertEqual(result.billed_tokens, 30)
+        self.assertEqual(chat.billed_tokens, 30)
+        first, follow_up = self.endpoint.bodies
+        self.assertEqual(follow_up['messages'][: len(first['messages'])], first['messages'])
+        self.assertEqual(follow_up['messages'][-2]['content'], 'The quick brown fox jumps over the lazy dog and')
+
+    async def test_json_answer_resumes_after_last_element(self):
+        self.endpoint.answers = [
+            ('{"items": [{"a": 1}, {"a": 2}, {"a"', 'length'),
+            ('```json\n{"a": 3}]}', 'stop'),
+        ]
+        result = await self.connector().ask('question', AskOptions(extract_json=True, continuations=1))
+        self.assertEqual(json.loads(result.text), {'items': [{'a': 1}, {'a': 2}, {'a': 3}]})
+        first, follow_up = self.endpoint.bodies
+        self.assertEqual(first['response_format'], {'type': 'json_object'})
+        # json mode would force a complete object instead of the rest of the fragment
+        self.assertNotIn('response_format', follow_up)
+        self.assertEqual(follow_up['messages'][-2]['content'], '{"items": [{"a": 1}, {"a": 2},')
+
+    async def test_still_truncated_fails(self):
+        self.endpoint.answers = [('first part of a long answer', 'length'), ('second part of a long answer', 'length')]
+        with self.assertRaises(ConnectorException) as raised:
+            await self.connector().ask('question', AskOptions(extract_json=False, continuations=1))
+        self.assertEqual(raised.exception.code, 701)
+        self.assertEqual(len(self.endpoint.bodies), 2)
+
+    async def test_no_continuations_reports_truncation(self):
+        self.endpoint.answers = [('cut', 'length')]
+        with self.assertRaises(ConnectorException) as raised:
+            await self.connector().ask('question', AskOptions(extract_json=False))
+        self.assertEqual(raised.exception.code, 701)
+        self.assertEqual(len(self.endpoint.bodies), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,7 @@ import unittest
 import unittest.async_case
 import logging
 
+from src.helpers.transport import close_transport
 from src.tag_analyzer import TagAnalyzer
 
 TEST_DIR = pathlib.Path(__file__).parent
@@ -33,6 +34,9 @@ class TestRunScrape(unittest.async_case.IsolatedAsyncioTestCase):
 
         return super().setUp()
 
+    async def asyncTearDown(self) -> None:
+        await close_transport()
+
     def test_scrape_invoicer(self):
         blog_url = 'https://invoicer.blogspot.com'
         output_directory = os.path.join('c:\\git\\prompts', 'scraped', 'invoicer_blogspot')
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.helpers.embedding_connector import EmbeddingConnector, EmbeddingConnectorException
+from src.helpers.local_embedding import MODEL_PATH_ENV
+from tests.helpers import MockedTestCase
+
+TOPICS = {
+    'invoice': 'faktura vat nabywca sprzedawca netto brutto stawka podatku',
+    'warehouse': 'magazyn towar dostawa przyjęcie wydanie stan regał',
+    'payroll': 'wynagrodzenie pracownik umowa składka zus urlop etat',
+}
+
+
+def corpus():
+    texts = []
+    for topic, words in TOPICS.items():
+        words = words.split()
+        for index in range(20):
+            texts.append(f'{topic} ' + ' '.join(words[(index + i) % len(words)] for i in range(12)))
+    return texts
+
+
+class TestLocalEmbedding(MockedTestCase):
+    def setUp(self) -> None:
+        os.environ.pop(MODEL_PATH_ENV, None)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        os.environ.pop(MODEL_PATH_ENV, None)
+        return super().tearDown()
+
+    async def test_unfitted_model_rejects_single_text(self):
+        connector = EmbeddingConnector(self.logger, cache=False)
+        connector.init_model('local')
+        with self.assertRaises(EmbeddingConnectorException) as raised:
+            await connector.embed('faktura')
+        self.assertEqual(raised.exception.code, 409)
+
+    async def test_batch_embed_fits_and_groups_topics(self):
+        connector = EmbeddingConnector(self.logger, cache=False)
+        connector.init_model('local')
+        texts = corpus()
+        embeddings = await connector.batch_embed(texts + [''])
+        self.assertTrue(connector.model.startswith('local-tfidf-svd-'))
+        self.assertEqual(list(connector.batch_errors), [len(texts)])
+        vectors = np.asarray(embeddings[: len(texts)])
+        self.assertTrue(np.allclose(np.linalg.norm(vectors, axis=1), 1.0, atol=1e-5))
+        query = np.asarray(await connector.embed('faktura vat netto brutto'))
+        nearest = int(np.argmax(vectors @ query))
+        self.assertTrue(texts[nearest].startswith('invoice'))
+
+    async def test_saved_model_is_reused(self):
+        with tempfile.TemporaryDirectory() as folder:
+            os.environ[MODEL_PATH_ENV] = os.path.join(folder, 'local.joblib')
+            first = EmbeddingConnector(self.logger, cache=False)
+            first.init_model('local')
+            await first.batch_embed(corpus())
+            self.assertTrue(os.path.exists(os.environ[MODEL_PATH_ENV]))
+            second = EmbeddingConnector(self.logger, cache=False)
+            second.init_model('local')
+            self.assertEqual(second.model, first.model)
+            text = 'magazyn towar dostawa'
+            self.assertTrue(np.allclose(await first.embed(text), await second.embed(text)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from src.helpers.embedding_connector import EmbeddingConnector
+from src.helpers.md_chunker import chunk_markdown
+from src.helpers.np_helper import pool_vectors
+from src.helpers.token_budget import estimate_tokens
+from tests.helpers import EmbeddingStandIn, MockedTestCase
+
+
+def long_post(sections=4, paragraphs=6):
+    parts = ['Intro paragraph about things.']
+    for section in range(sections):
+        parts.append(f'## Section {section}')
+        for paragraph in range(paragraphs):
+            parts.append(f'Paragraph {section}.{paragraph} ' + 'word ' * 120)
+    return '\n\n'.join(parts)
+
+
+class TestMarkdownChunker(MockedTestCase):
+    def make_endpoint(self):
+        return EmbeddingStandIn()
+
+    def test_short_body_is_one_chunk(self):
+        chunks = chunk_markdown('# Title\n\nShort post.', 300)
+        self.assertEqual([chunk.text for chunk in chunks], ['# Title\n\nShort post.'])
+        self.assertEqual(chunk_markdown('  \n', 300), [])
+
+    def test_long_body_respects_budget_and_headings(self):
+        body = long_post() + '\n\n' + 'x' * 5000
+        chunks = chunk_markdown(body, 300)
+        self.assertGreater(len(chunks), 5)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk.text), 300)
+        self.assertEqual(chunks[0].heading, '')
+        self.assertEqual(chunks[-1].heading, '## Section 3')
+        continued = [chunk for chunk in chunks if chunk.heading and not body[chunk.start :].startswith('##')]
+        self.assertTrue(continued)
+        self.assertTrue(all(chunk.text.startswith(chunk.heading) for chunk in continued))
+        self.assertEqual([c.start for c in chunks], sorted(c.start for c in chunks))
+
+    def test_pool_vectors(self):
+        np.testing.assert_array_equal(pool_vectors([[3.0, 4.0]]), [3.0, 4.0])
+        pooled = pool_vectors([[1.0, 0.0], [0.0, 1.0]], [3, 1])
+        self.assertEqual(pooled.dtype, np.float32)
+        np.testing.assert_allclose(pooled, [0.9486833, 0.3162278], rtol=1e-6)
+
+    async def test_embed_documents(self):
+        connector = EmbeddingConnector(self.logger)
+        connector.init_model('openai')
+        connector.max_input_tokens = 400
+        documents = await connector.embed_documents(['short post', long_post(), ' '])
+        np.testing.assert_array_equal(documents[0].embedding, [10.0, 1.0])
+        self.assertEqual(len(documents[0].chunks), 1)
+        self.assertGreater(len(documents[1].chunks), 1)
+        self.assertAlmostEqual(float(np.linalg.norm(documents[1].embedding)), 1.0, places=6)
+        self.assertIsNone(documents[2])
+        self.assertEqual(list(connector.batch_errors), [2])
+        self.assertEqual(len(self.endpoint.batches), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
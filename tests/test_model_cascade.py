@@ -0,0 +1,106 @@
+import logging
+import unittest
+
+from src.helpers.chat_connector import AskResult, ConnectorException
+from src.helpers.model_cascade import ModelCascade, json_validator, keys_validator, schema_validator
+
+
+class ScriptedConnector:
+    """Answers with the text scripted for its model, an exception in the script is raised."""
+
+    def __init__(self, model, answer, tokens) -> None:
+        self.model = model
+        self.answer = answer
+        self.tokens = tokens
+        self.prompts = []
+
+    async def ask(self, prompt, options=None) -> AskResult:
+        self.prompts.append(prompt)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return AskResult(self.answer, model=self.model, billed_tokens=self.tokens)
+
+
+class TestValidators(unittest.TestCase):
+    def test_json(self):
+        self.assertTrue(json_validator('{"a": 1}'))
+        self.assertTrue(json_validator('[1]'))
+        for text in ('{}', '[]', '"text"', 'not json', None):
+            self.assertFalse(json_validator(text), text)
+
+    def test_keys(self):
+        validate = keys_validator('genre', 'value')
+        self.assertTrue(validate('{"genre": "faktura", "value": 10, "cite": ""}'))
+        self.assertFalse(validate('{"genre": "faktura"}'))
+        self.assertFalse(validate('["genre", "value"]'))
+        self.assertFalse(validate('not json'))
+
+    def test_schema(self):
+        schema = {'type': 'object', 'properties': {'value': {'type': 'number'}}, 'required': ['value']}
+        validate = schema_validator(schema)
+        self.assertTrue(validate('{"value": 10}'))
+        self.assertFalse(validate('{"value": "ten"}'))
+        self.assertFalse(validate('{}'))
+        self.assertFalse(validate('not json'))
+
+
+class TestModelCascade(unittest.IsolatedAsyncioTestCase):
+    def cascade(self, **answers) -> ModelCascade:
+        self.connectors = {
+            model: ScriptedConnector(model, answer, tokens=10 * (index + 1))
+            for index, (model, answer) in enumerate(answers.items())
+        }
+        return ModelCascade(logging.getLogger('cascade'), list(answers), connector=self.connectors.get)
+
+    async def test_first_valid_answer_wins(self):
+        cascade = self.cascade(small='{"a": 1}', big='{"a": 2}')
+        result = await cascade.ask('question')
+        self.assertEqual(result.text, '{"a": 1}')
+        self.assertEqual(cascade.last_model, 'small')
+        self.assertEqual(self.connectors['big'].prompts, [])
+
+    async def test_rejected_answer_escalates(self):
+        cascade = self.cascade(small='no idea', medium='{}', big='{"a": 2}')
+        result = await cascade.ask('question')
+        self.assertEqual(result.text, '{"a": 2}')
+        self.assertEqual(cascade.last_model, 'big')
+        # the result is billed for every stage tried
+        self.assertEqual(result.billed_tokens, 60)
+        self.assertEqual(cascade.billed_tokens, 60)
+        summary = cascade.summary()
+        self.assertEqual((summary['small']['rejected'], summary['medium']['rejected']), (1, 1))
+        self.assertEqual(summary['big']['accepted'], 1)
+        self.assertEqual(summary['big']['hit_rate'], 1.0)
+        self.assertEqual(summary['medium']['tokens'], 20)
+
+    async def test_error_escalates(self):
+        cascade = self.cascade(small=ConnectorException(500, 'down'), big='{"a": 2}')
+        result = await cascade.ask('question')
+        self.assertEqual(result.text, '{"a": 2}')
+        self.assertEqual(result.billed_tokens, 20)
+        self.assertEqual(cascade.stats['small'].errors, 1)
+
+    async def test_last_stage_is_returned_even_when_invalid(self):
+        cascade = self.cascade(small='no', big='still no')
+        result = await cascade.ask('question')
+        self.assertEqual(result.text, 'still no')
+        self.assertEqual(cascade.stats['big'].rejected, 1)
+
+    async def test_last_stage_error_is_raised(self):
+        cascade = self.cascade(small='no', big=ConnectorException(503, 'overloaded'))
+        with self.assertRaises(ConnectorException) as raised:
+            await cascade.ask('question')
+        self.assertEqual(raised.exception.code, 503)
+
+    async def test_validator_per_call(self):
+        cascade = self.cascade(small='{"a": 1}', big='{"a": 1, "b": 2}')
+        result = await cascade.ask('question', validator=keys_validator('b'))
+        self.assertEqual(cascade.last_model, 'big')
+        self.assertEqual(result.text, '{"a": 1, "b": 2}')
+        # a failing validator rejects the answer instead of breaking the cascade
+        result = await cascade.ask('question', validator=lambda text: 1 / 0)
+        self.assertEqual(result.text, '{"a": 1, "b": 2}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import ChatConnector
+from src.helpers.model_router import ModelRouter
+from tests.helpers import MockedTestCase, chat_completion, mock_transport
+
+
+class TimedEndpoint:
+    """Answers each model with its name after `delays[model]` seconds, models in `failing` answer 400."""
+
+    def __init__(self, delays, failing=()) -> None:
+        self.delays = delays
+        self.failing = set(failing)
+        self.models = []
+        self.cancelled = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        model = json.loads(request.read())['model']
+        self.models.append(model)
+        if model in self.failing:
+            return httpx.Response(400, json={'error': 'bad request'})
+        try:
+            await asyncio.sleep(self.delays.get(model, 0.0))
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        return chat_completion(model)
+
+
+class TestModelRouter(MockedTestCase):
+    def router(self, endpoint, **kwargs):
+        mock_transport(endpoint)
+
+        def connector(model):
+            chat = ChatConnector(self.logger, cache=False)
+            chat.init_model(model)
+            chat.max_retries = 1
+            return chat
+
+        return ModelRouter(self.logger, ['openai4o', '4o-mini'], connector=connector, **kwargs)
+
+    async def test_unmeasured_models_rank_after_measured(self):
+        router = self.router(TimedEndpoint({}))
+        self.assertEqual(router.rank(), ['openai4o', '4o-mini'])
+        router.stats['4o-mini'].record(0.5)
+        self.assertEqual(router.rank(), ['4o-mini', 'openai4o'])
+        router.stats['openai4o'].record(0.2)
+        self.assertEqual(router.rank(), ['openai4o', '4o-mini'])
+
+    async def test_failing_model_is_ranked_out(self):
+        endpoint = TimedEndpoint({}, failing={'gpt-4o'})
+        router = self.router(endpoint)
+        self.assertEqual(await router.ask('question'), 'gpt-4o-mini')
+        self.assertEqual(endpoint.models, ['gpt-4o', 'gpt-4o-mini'])
+        self.assertEqual(router.stats['openai4o'].error_rate, 1.0)
+        self.assertEqual(router.rank(), ['4o-mini'])
+
+    async def test_slow_primary_is_hedged(self):
+        endpoint = TimedEndpoint({'gpt-4o': 5.0, 'gpt-4o-mini': 0.0})
+        router = self.router(endpoint, hedge=True, hedge_delay=0.05)
+        self.assertEqual(await router.ask('question'), 'gpt-4o-mini')
+        self.assertEqual(router.last_model, '4o-mini')
+        self.assertEqual((router.hedges, router.hedge_wins), (1, 1))
+        self.assertEqual(endpoint.cancelled, ['gpt-4o'])
+        # the cancelled primary leaves no latency sample behind, yet its prompt is billed
+        self.assertEqual(router.stats['openai4o'].summary()['samples'], 0)
+        self.assertEqual(router.stats['4o-mini'].summary()['samples'], 1)
+        self.assertGreater(router.billed_tokens, 5)
+        self.assertEqual(router.rank(), ['4o-mini', 'openai4o'])
+
+    async def test_fast_primary_is_not_hedged(self):
+        endpoint = TimedEndpoint({'gpt-4o': 0.0, 'gpt-4o-mini': 0.0})
+        router = self.router(endpoint, hedge=True, hedge_delay=1.0)
+        self.assertEqual(await router.ask('question'), 'gpt-4o')
+        self.assertEqual(endpoint.models, ['gpt-4o'])
+        self.assertEqual((router.hedges, router.hedge_wins), (0, 0))
+        self.assertEqual(router.billed_tokens, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
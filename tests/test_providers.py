@@ -0,0 +1,128 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import GEMINI_CONTEXT_CACHE_MIN_CHARS, AskOptions, ChatConnector, StructuredPrompt
+from src.helpers.providers import MODELS, OPENAI_CHAT, ModelEntry, get_spec, register_model
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class RecordingEndpoint:
+    """Answers every provider with the question it was asked, recording url and body of each request."""
+
+    def __init__(self) -> None:
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        url, body = str(request.url), json.loads(request.content)
+        self.requests.append((url, body))
+        if url.endswith('/cachedContents'):
+            return httpx.Response(200, json={'name': f'cachedContents/{len(self.requests)}'})
+        if 'generativelanguage' in url:
+            usage = {'totalTokenCount': 9, 'cachedContentTokenCount': 4000 if 'cachedContent' in body else 0}
+            parts = [{'text': body['contents'][-1]['parts'][0]['text']}]
+            candidates = [{'content': {'parts': parts}, 'finishReason': 'STOP'}]
+            return httpx.Response(200, json={'candidates': candidates, 'usageMetadata': usage})
+        if url.endswith('/responses'):
+            output = [{'status': 'completed', 'content': [{'type': 'output_text', 'text': body['input']}]}]
+            usage = {'input_tokens': 3, 'output_tokens': 2}
+            return httpx.Response(200, json={'output': output, 'status': 'completed', 'usage': usage})
+        if 'anthropic' in url:
+            content = [{'type': 'text', 'text': body['messages'][-1]['content']}]
+            usage = {'input_tokens': 5, 'output_tokens': 2, 'cache_read_input_tokens': 3}
+            return httpx.Response(200, json={'content': content, 'stop_reason': 'end_turn', 'usage': usage})
+        return chat_completion(body['messages'][-1]['content'])
+
+
+class TestProviders(MockedTestCase):
+    def make_endpoint(self):
+        return RecordingEndpoint()
+
+    def connector(self, model):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model(model)
+        return chat
+
+    def test_unknown_model(self):
+        with self.assertRaises(ValueError) as raised:
+            get_spec('no-such-model')
+        self.assertIn('openai41', str(raised.exception))
+
+    def test_specs_are_shared_and_immutable(self):
+        spec = get_spec('4o-mini')
+        self.assertIs(get_spec('4o-mini'), spec)
+        with self.assertRaises(AttributeError):
+            spec.model = 'gpt-4o'
+        changed = spec.replace(max_output_tokens=100)
+        self.assertEqual(changed.template['max_tokens'], 100)
+        self.assertEqual(spec.template['max_tokens'], 16380)
+
+    def test_registered_model(self):
+        self.addCleanup(MODELS.pop, 'test-mini')
+        register_model('test-mini', ModelEntry('openai', OPENAI_CHAT, 'gpt-test-mini'))
+        chat = self.connector('test-mini')
+        self.assertEqual(chat.model, 'gpt-test-mini')
+        self.assertEqual(chat.api_url, 'https://api.openai.com/v1/chat/completions')
+
+    def test_model_specific_payloads(self):
+        self.assertNotIn('temperature', self.connector('o3-mini').build_payload('q'))
+        phi = self.connector('phi4').build_payload('q')
+        self.assertEqual((phi['temperature'], phi['max_tokens']), (1.0, 8192))
+        o1 = self.connector('o1-mini').build_payload(StructuredPrompt('rules', 'q'))
+        self.assertEqual(o1['messages'][0], {'role': 'user', 'content': 'rules'})
+
+    async def test_prefix_goes_first_unchanged(self):
+        prompt = StructuredPrompt('static rules ', 'question?')
+        await self.connector('4o-mini').ask(prompt)
+        await self.connector('openai41').ask(prompt, AskOptions(extract_json=False))
+        (_, chat), (_, responses) = self.endpoint.requests
+        self.assertEqual(chat['messages'][0], {'role': 'system', 'content': 'static rules '})
+        self.assertEqual(chat['messages'][1], {'role': 'user', 'content': 'question?'})
+        self.assertEqual((responses['instructions'], responses['input']), ('static rules ', 'question?'))
+
+    async def test_anthropic_prefix_is_a_cached_block(self):
+        chat = self.connector('claude')
+        result = await chat.ask(StructuredPrompt('static rules ', 'question?'))
+        _, body = self.endpoint.requests[0]
+        block = {'type': 'text', 'text': 'static rules ', 'cache_control': {'type': 'ephemeral'}}
+        self.assertEqual(body['system'], [block])
+        self.assertEqual(result.cached_tokens, 3)
+
+    async def test_gemini_large_prefix_is_stored_once(self):
+        chat = self.connector('gemini')
+        prefix = 'rule ' * (GEMINI_CONTEXT_CACHE_MIN_CHARS // 5 + 1)
+        first = await chat.ask(StructuredPrompt(prefix, 'first'))
+        second = await chat.ask(StructuredPrompt(prefix, 'second'))
+        urls = [url for url, _ in self.endpoint.requests]
+        self.assertEqual(sum(url.endswith('/cachedContents') for url in urls), 1)
+        _, upload = self.endpoint.requests[0]
+        self.assertEqual(upload['systemInstruction'], {'parts': [{'text': prefix}]})
+        for _, body in self.endpoint.requests[1:]:
+            self.assertEqual(body['cachedContent'], 'cachedContents/1')
+            self.assertNotIn('systemInstruction', body)
+        self.assertEqual((first.text, second.text), ('first', 'second'))
+        self.assertEqual(chat.cached_tokens, 8000)
+
+    async def test_gemini_small_prefix_is_sent_inline(self):
+        await self.connector('gemini').ask(StructuredPrompt('short rules ', 'q'))
+        (url, body), = self.endpoint.requests
+        self.assertFalse(url.endswith('/cachedContents'))
+        self.assertEqual(body['systemInstruction'], {'parts': [{'text': 'short rules '}]})
+
+    async def test_options_belong_to_their_request(self):
+        chat = self.connector('4o-mini')
+        as_json, as_text = await asyncio.gather(
+            chat.ask('{"a": 1}', AskOptions(extract_json=True)), chat.ask('plain', AskOptions(extract_json=False))
+        )
+        bodies = {body['messages'][-1]['content']: body for _, body in self.endpoint.requests}
+        self.assertEqual(bodies['{"a": 1}']['response_format'], {'type': 'json_object'})
+        self.assertNotIn('response_format', bodies['plain'])
+        self.assertEqual((as_json.text, as_text.text), ('{"a": 1}', 'plain'))
+        self.assertIsNone(AskOptions().extract_json)
+        self.assertEqual(AskOptions(timeout=3).replace(cache=False).timeout, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, ChatConnector
+from src.helpers.key_pool import KeyPool, load_keys
+from src.helpers.providers import bearer_headers
+from src.helpers.rate_limiter import BACKOFF_CAP, RateLimiter, TokenBucket, backoff_delay, retry_after
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class ThrottlingEndpoint:
+    """Answers 429 with Retry-After to the keys in `throttled` and to the first `failures` requests."""
+
+    def __init__(self) -> None:
+        self.throttled = set()
+        self.failures = 0
+        self.keys = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        key = request.headers['authorization'].removeprefix('Bearer ')
+        self.keys.append(key)
+        if key in self.throttled or self.failures:
+            self.failures = max(0, self.failures - 1)
+            return httpx.Response(429, headers={'retry-after': '0'}, json={'error': 'rate limited'})
+        return chat_completion('ok', total_tokens=10)
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_header_forms(self):
+        self.assertEqual(retry_after(httpx.Headers({'retry-after': '7'})), 7.0)
+        self.assertEqual(retry_after(httpx.Headers({'retry-after-ms': '250', 'retry-after': '7'})), 0.25)
+        self.assertAlmostEqual(
+            retry_after(httpx.Headers({'retry-after': formatdate(time.time() + 30, usegmt=True)})), 30, delta=2
+        )
+        self.assertEqual(retry_after(httpx.Headers({'retry-after': formatdate(time.time() - 30, usegmt=True)})), 0.0)
+        self.assertIsNone(retry_after(httpx.Headers({'retry-after': 'soon'})))
+        self.assertIsNone(retry_after(httpx.Headers()))
+
+    def test_backoff_is_capped(self):
+        for attempt in range(12):
+            self.assertLessEqual(backoff_delay(attempt), min(BACKOFF_CAP, 2**attempt))
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    def test_bucket_refills_over_time(self):
+        clock = [100.0]
+        with mock.patch('src.helpers.rate_limiter.time.monotonic', side_effect=lambda: clock[0]):
+            bucket = TokenBucket(60)
+            bucket.take(60)
+            self.assertAlmostEqual(bucket.wait_time(1), 1.0)
+            clock[0] += 30
+            self.assertEqual(bucket.wait_time(30), 0.0)
+            # a request bigger than the whole budget waits for a full bucket only
+            self.assertAlmostEqual(bucket.wait_time(1000), 30.0)
+
+    async def test_acquire_waits_for_budget(self):
+        limiter = RateLimiter(600, 10**6)
+        limiter.requests.take(600)
+        start = time.perf_counter()
+        await limiter.acquire()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.09)
+
+    async def test_acquire_gives_up_at_timeout(self):
+        limiter = RateLimiter(1, 10**6)
+        await limiter.acquire()
+        with self.assertRaises(asyncio.TimeoutError):
+            await limiter.acquire(timeout=1)
+
+    def test_billed_tokens_settle_the_estimate(self):
+        limiter = RateLimiter(60, 1000)
+        limiter.tokens.take(100)
+        limiter.record(billed_tokens=300, estimated_tokens=100)
+        self.assertAlmostEqual(limiter.tokens.available, 700, delta=1)
+
+    def test_provider_headers_resize_budgets(self):
+        limiter = RateLimiter(500, 200000)
+        limiter.observe(httpx.Headers({'x-ratelimit-limit-requests': '30', 'x-ratelimit-limit-tokens': '9000'}))
+        self.assertEqual((limiter.requests.per_minute, limiter.tokens.per_minute), (30, 9000))
+        self.assertLessEqual(limiter.requests.available, 30)
+        limiter.observe(httpx.Headers({'anthropic-ratelimit-requests-limit': '50'}))
+        self.assertEqual(limiter.requests.per_minute, 50)
+
+    def test_backoff_blocks(self):
+        limiter = RateLimiter(60, 1000)
+        limiter.backoff(5)
+        self.assertTrue(limiter.blocked)
+        self.assertGreater(limiter.wait_time(), 4)
+        self.assertEqual(limiter.throttled, 1)
+
+
+class TestRetry(MockedTestCase):
+    def make_endpoint(self):
+        return ThrottlingEndpoint()
+
+    @mock.patch('src.helpers.chat_connector.random.uniform', return_value=0.0)
+    async def test_429_is_retried_after_retry_after(self, _):
+        self.endpoint.failures = 2
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        result = await chat.ask('question', AskOptions(cache=False))
+        self.assertEqual(result.text, 'ok')
+        self.assertEqual(len(self.endpoint.keys), 3)
+
+
+class TestKeyPool(MockedTestCase):
+    def make_endpoint(self):
+        return ThrottlingEndpoint()
+
+    def pool(self, *keys) -> KeyPool:
+        # limiters are registered per key, every test uses keys of its own
+        return KeyPool('https://api.openai.com/v1', [f'{self.id()}-{key}' for key in keys], bearer_headers)
+
+    def test_load_keys(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'keys.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('# spare keys\nk3\nk1\n\n')
+            env = {'POOL_TEST_KEY': 'k1, k2,', 'POOL_TEST_KEY_FILE': path}
+            with mock.patch.dict(os.environ, env):
+                self.assertEqual(load_keys('POOL_TEST_KEY'), ['k1', 'k2', 'k3'])
+        self.assertEqual(load_keys('POOL_TEST_MISSING_KEY'), [])
+
+    def test_free_keys_take_turns(self):
+        pool = self.pool('a', 'b', 'c')
+        picked = [pool.pick() for _ in range(6)]
+        self.assertEqual(picked, pool.keys * 2)
+
+    def test_cooling_key_is_skipped(self):
+        pool = self.pool('a', 'b')
+        pool.cooldown(pool.keys[0], 30)
+        self.assertEqual(pool.available(), 1)
+        self.assertEqual({pool.pick() for _ in range(4)}, {pool.keys[1]})
+        pool.cooldown(pool.keys[1], 10)
+        # with every key cooling down the one free soonest is used
+        self.assertEqual(pool.pick(), pool.keys[1])
+
+    def connector(self, pool) -> ChatConnector:
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        chat.spec = chat.spec.replace(keys=pool)
+        return chat
+
+    async def test_throttled_key_switches_at_once(self):
+        pool = self.pool('a', 'b')
+        self.endpoint.throttled.add(pool.keys[0])
+        chat = self.connector(pool)
+        self.assertEqual((await chat.ask('question', AskOptions(cache=False))).text, 'ok')
+        self.assertEqual(self.endpoint.keys, pool.keys)
+        self.assertTrue(pool.limiter(pool.keys[0]).blocked)
+        # the next request goes straight to the key that is not cooling down
+        await chat.ask('question', AskOptions(cache=False, coalesce=False))
+        self.assertEqual(self.endpoint.keys[-1], pool.keys[1])
+
+    @mock.patch('src.helpers.chat_connector.random.uniform', return_value=0.0)
+    async def test_single_key_waits_for_retry_after(self, _):
+        pool = self.pool('a')
+        self.endpoint.failures = 2
+        chat = self.connector(pool)
+        result = await chat.ask('question', AskOptions(cache=False))
+        self.assertEqual(result.text, 'ok')
+        self.assertEqual(len(self.endpoint.keys), 3)
+        self.assertEqual(pool.limiter(pool.keys[0]).throttled, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
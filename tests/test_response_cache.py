@@ -0,0 +1,145 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, AskResult, ChatConnector
+from src.helpers.response_cache import ResponseCache
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class CountingEndpoint:
+    """Echoes the prompt, counting the requests that reach it."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, request):
+        self.calls += 1
+        return chat_completion(json.loads(request.content)['messages'][-1]['content'], total_tokens=4)
+
+
+class GeminiStreamEndpoint:
+    """Streams 'Hello' ending with `finish`, counting the requests that reach it."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.finish = 'STOP'
+
+    def __call__(self, request):
+        self.calls += 1
+        event = {
+            'candidates': [{'content': {'parts': [{'text': 'Hello'}]}, 'finishReason': self.finish}],
+            'usageMetadata': {'totalTokenCount': 3},
+        }
+        body = f'data: {json.dumps(event)}\n\n'.encode('utf-8')
+        return httpx.Response(200, content=body, headers={'content-type': 'text/event-stream'})
+
+
+class TestResponseCache(MockedTestCase):
+    def make_endpoint(self):
+        return CountingEndpoint()
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        return super().tearDown()
+
+    def cache(self, **kwargs) -> ResponseCache:
+        cache = ResponseCache(os.path.join(self.tmp.name, 'responses.db'), **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_key_ignores_api_key_in_url(self):
+        payload = {'contents': [{'parts': [{'text': 'q'}]}], 'b': 1}
+        first = ResponseCache.make_key('gemini', 'https://g.test/models/m:generateContent?key=AAA', payload)
+        second = ResponseCache.make_key('gemini', 'https://g.test/models/m:generateContent?key=BBB', dict(payload))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, ResponseCache.make_key('other', 'https://g.test/models/m:generateContent', payload))
+
+    def test_ttl_expires_entries(self):
+        cache = self.cache(ttl=60)
+        cache.put('k', {'answer': 1})
+        self.assertEqual(cache.get('k'), {'answer': 1})
+        with mock.patch('src.helpers.response_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('k'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        body = {'text': 'x' * 100}
+        size = len(json.dumps(body))
+        cache = self.cache(max_bytes=size * 3)
+        clock = [1000.0]
+        with mock.patch('src.helpers.response_cache.time.time', side_effect=lambda: clock[0]):
+            for key in ('a', 'b', 'c'):
+                clock[0] += 1
+                cache.put(key, body)
+            clock[0] += 1
+            # reading 'a' leaves 'b' and 'c' the least recently used entries
+            self.assertIsNotNone(cache.get('a'))
+            clock[0] += 1
+            cache.put('d', body)
+            # eviction goes down to 90% of the limit, which takes two entries of this size
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNone(cache.get('c'))
+            self.assertIsNotNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('d'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertLessEqual(cache.stats()['bytes'], size * 3)
+
+    def test_size_survives_reopen(self):
+        cache = self.cache()
+        cache.put('k', {'answer': 'stored'})
+        cache.put('k', {'answer': 'replaced'})
+        reopened = self.cache()
+        self.assertEqual(reopened.stats()['bytes'], cache.stats()['bytes'])
+        self.assertEqual(reopened.get('k'), {'answer': 'replaced'})
+
+    async def test_connector_serves_repeats_from_cache(self):
+        chat = ChatConnector(self.logger, cache=self.cache())
+        chat.init_model('4o-mini')
+        first = await chat.ask('question')
+        second = await chat.ask('question')
+        self.assertEqual(self.endpoint.calls, 1)
+        self.assertEqual(second.text, first.text)
+        self.assertTrue(second.cache_hit)
+        self.assertEqual(second.billed_tokens, 0)
+        self.assertEqual(chat.billed_tokens, 4)
+        await chat.ask('question', AskOptions(cache=False))
+        await chat.ask('other question')
+        self.assertEqual(self.endpoint.calls, 3)
+
+
+class TestStreamCache(MockedTestCase):
+    def make_endpoint(self):
+        return GeminiStreamEndpoint()
+
+    async def stream(self, chat):
+        return [delta async for delta in chat.ask_stream('question', AskOptions(extract_json=False), AskResult(None))]
+
+    async def test_only_complete_streams_are_cached(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ResponseCache(os.path.join(folder, 'responses.db'))
+            self.addCleanup(cache.close)
+            chat = ChatConnector(self.logger, cache=cache)
+            chat.init_model('gemini')
+            for finish in ('OTHER', 'MAX_TOKENS'):
+                self.endpoint.finish = finish
+                self.assertEqual(await self.stream(chat), ['Hello'])
+            self.assertEqual(cache.stats()['bytes'], 0)
+            self.endpoint.finish = 'STOP'
+            await self.stream(chat)
+            self.assertEqual(await self.stream(chat), ['Hello'])
+            self.assertEqual(self.endpoint.calls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
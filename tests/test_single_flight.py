@@ -0,0 +1,112 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+import numpy as np
+
+from src.helpers.chat_connector import AskOptions, ChatConnector, ConnectorException
+from src.helpers.circuit_breaker import deadline
+from src.helpers.embedding_connector import EmbeddingConnector, EmbeddingConnectorException
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class SlowEndpoint:
+    """Answers chat and embedding requests after a short delay, counting what was sent."""
+
+    def __init__(self) -> None:
+        self.bodies = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.bodies.append(body)
+        await asyncio.sleep(0.05)
+        if 'embeddings' in str(request.url):
+            return httpx.Response(200, json={'data': [{'embedding': [0.5, 0.25]}], 'usage': {'prompt_tokens': 2}})
+        return chat_completion(body['messages'][-1]['content'].upper(), total_tokens=9)
+
+
+class TestSingleFlight(MockedTestCase):
+    def make_endpoint(self):
+        return SlowEndpoint()
+
+    def connector(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        return chat
+
+    async def test_identical_asks_share_one_request(self):
+        chat = self.connector()
+        results = await asyncio.gather(*(chat.ask('tag definition') for _ in range(5)), chat.ask('other'))
+        self.assertEqual(len(self.endpoint.bodies), 2)
+        self.assertEqual([r.text for r in results], ['TAG DEFINITION'] * 5 + ['OTHER'])
+        self.assertEqual(sum(r.billed_tokens for r in results), 18)
+        self.assertEqual(sum(r.coalesced for r in results), 4)
+        self.assertEqual(chat.billed_tokens, 18)
+
+    async def test_opt_out_and_sequential(self):
+        chat = self.connector()
+        options = AskOptions(coalesce=False)
+        await asyncio.gather(*(chat.ask('sample', options) for _ in range(3)))
+        await chat.ask('sample')
+        await chat.ask('sample')
+        self.assertEqual(len(self.endpoint.bodies), 5)
+
+    async def test_different_timeouts_do_not_share(self):
+        chat = self.connector()
+        await asyncio.gather(chat.ask('sample', AskOptions(timeout=5)), chat.ask('sample', AskOptions(timeout=10)))
+        self.assertEqual(len(self.endpoint.bodies), 2)
+
+    async def test_joining_caller_keeps_its_deadline(self):
+        chat = self.connector()
+
+        async def hurried():
+            with deadline(0.01):
+                return await chat.ask('sample')
+
+        first = asyncio.create_task(chat.ask('sample'))
+        await asyncio.sleep(0)
+        with self.assertRaises(ConnectorException) as raised:
+            await hurried()
+        self.assertEqual(raised.exception.code, 408)
+        # the flight goes on for the caller that started it
+        self.assertEqual((await first).text, 'SAMPLE')
+        self.assertEqual(len(self.endpoint.bodies), 1)
+
+    async def test_identical_embeddings_share_one_request(self):
+        embedder = EmbeddingConnector(self.logger)
+        embedder.init_model('openai')
+        vectors = await asyncio.gather(*(embedder.embed('query') for _ in range(4)))
+        self.assertEqual(len(self.endpoint.bodies), 1)
+        self.assertEqual([vector.tolist() for vector in vectors], [[0.5, 0.25]] * 4)
+        self.assertEqual(vectors[0].dtype, np.float32)
+        with self.assertRaises(ValueError):
+            vectors[0][0] = 1.0
+        self.assertEqual(vectors[1].tolist(), [0.5, 0.25])
+
+    async def test_embeddings_with_different_timeouts_do_not_share(self):
+        embedder = EmbeddingConnector(self.logger, cache=False)
+        embedder.init_model('openai')
+        await asyncio.gather(embedder.embed('query', timeout=5), embedder.embed('query', timeout=10))
+        self.assertEqual(len(self.endpoint.bodies), 2)
+
+    async def test_joining_embedding_keeps_its_deadline(self):
+        embedder = EmbeddingConnector(self.logger, cache=False)
+        embedder.init_model('openai')
+
+        async def hurried():
+            with deadline(0.01):
+                return await embedder.embed('query')
+
+        patient = asyncio.create_task(embedder.embed('query'))
+        await asyncio.sleep(0)
+        with self.assertRaises(EmbeddingConnectorException) as raised:
+            await hurried()
+        self.assertEqual(raised.exception.code, 408)
+        # the caller that started the flight gets its vector
+        self.assertEqual((await patient).tolist(), [0.5, 0.25])
+        self.assertEqual(len(self.endpoint.bodies), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import json
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, AskResult, ChatConnector, ConnectorException
+from tests.helpers import MockedTestCase
+
+
+def sse(*events, done=False) -> bytes:
+    lines = [f'data: {json.dumps(event)}\n\n' for event in events]
+    if done:
+        lines.append('data: [DONE]\n\n')
+    return ''.join(lines).encode('utf-8')
+
+
+# the same answer, 'Hello world', as each provider streams it
+STREAMS = {
+    'api.openai.com/v1/chat/completions': sse(
+        {'choices': [{'delta': {'role': 'assistant', 'content': ''}}]},
+        {'choices': [{'delta': {'content': 'Hello'}}]},
+        {'choices': [{'delta': {'content': ' world'}, 'finish_reason': 'stop'}]},
+        {'choices': [], 'usage': {'prompt_tokens': 4, 'completion_tokens': 2, 'total_tokens': 6}},
+        done=True,
+    ),
+    'api.openai.com/v1/responses': sse(
+        {'type': 'response.created', 'response': {'status': 'in_progress'}},
+        {'type': 'response.output_text.delta', 'delta': 'Hello'},
+        {'type': 'response.output_text.delta', 'delta': ' world'},
+        {
+            'type': 'response.completed',
+            'response': {
+                'status': 'completed',
+                'output': [{'status': 'completed', 'content': [{'type': 'output_text', 'text': 'Hello world'}]}],
+                'usage': {'input_tokens': 4, 'output_tokens': 2},
+            },
+        },
+    ),
+    'api.anthropic.com/v1/messages': sse(
+        {'type': 'message_start', 'message': {'usage': {'input_tokens': 4, 'output_tokens': 1}}},
+        {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+        {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': 'Hello'}},
+        {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': ' world'}},
+        {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 2}},
+        {'type': 'message_stop'},
+    ),
+    'streamGenerateContent': sse(
+        {'candidates': [{'content': {'parts': [{'text': 'thinking', 'thought': True}]}}]},
+        {'candidates': [{'content': {'parts': [{'text': 'Hello'}]}}]},
+        {
+            'candidates': [{'content': {'parts': [{'text': ' world'}]}, 'finishReason': 'STOP'}],
+            'usageMetadata': {'promptTokenCount': 4, 'candidatesTokenCount': 2, 'totalTokenCount': 6},
+        },
+    ),
+}
+
+
+class StreamStandIn:
+    """Streams the canned events of the provider a request goes to, `body` overrides them."""
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.body = None
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append((str(request.url), json.loads(request.content)))
+        body = self.body
+        if body is None:
+            body = next(events for url, events in STREAMS.items() if url in str(request.url))
+        return httpx.Response(200, content=body, headers={'content-type': 'text/event-stream'})
+
+
+class TestStreaming(MockedTestCase):
+    def make_endpoint(self):
+        return StreamStandIn()
+
+    def connector(self, model):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model(model)
+        return chat
+
+    async def stream(self, chat, prompt='question', options=None):
+        result = AskResult(None)
+        deltas = [delta async for delta in chat.ask_stream(prompt, options, result)]
+        return deltas, result
+
+    async def test_every_provider_streams_deltas(self):
+        for model in ('4o-mini', 'openai41', 'claude', 'gemini'):
+            with self.subTest(model=model):
+                chat = self.connector(model)
+                deltas, result = await self.stream(chat)
+                self.assertEqual(deltas, ['Hello', ' world'])
+                self.assertEqual(result.text, 'Hello world')
+                self.assertEqual(result.billed_tokens, 6)
+                self.assertEqual(chat.billed_tokens, 6)
+                # the assembled response reads like the one of ask
+                self.assertEqual(chat.get_text(result.raw, AskOptions(extract_json=False)), 'Hello world')
+
+    async def test_stream_requests(self):
+        await self.stream(self.connector('4o-mini'))
+        await self.stream(self.connector('gemini'))
+        (_, openai_body), (gemini_url, _) = self.endpoint.requests
+        self.assertTrue(openai_body['stream'])
+        self.assertEqual(openai_body['stream_options'], {'include_usage': True})
+        self.assertIn(':streamGenerateContent?alt=sse', gemini_url)
+
+    async def test_event_split_over_data_lines(self):
+        self.endpoint.body = (
+            b': keep-alive\n\n'
+            b'data: {"choices": [{"delta":\n'
+            b'data: {"content": "Hel"}}]}\n\n'
+            b'event: ping\n\n'
+            # the last event may end without a blank line
+            b'data: {"choices": [{"delta": {"content": "lo"}, "finish_reason": "stop"}]}'
+        )
+        deltas, result = await self.stream(self.connector('4o-mini'))
+        self.assertEqual(deltas, ['Hel', 'lo'])
+        self.assertEqual(result.billed_tokens, 0)
+
+    async def test_stream_error_event(self):
+        self.endpoint.body = sse(
+            {'type': 'message_start', 'message': {'usage': {'input_tokens': 4}}},
+            {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}},
+        )
+        with self.assertRaises(ConnectorException) as raised:
+            await self.stream(self.connector('claude'))
+        self.assertEqual(raised.exception.code, 529)
+        self.assertIn('overloaded_error', raised.exception.message)
+
+    async def test_truncated_stream_is_reported(self):
+        self.endpoint.body = sse(
+            {'choices': [{'delta': {'content': 'cut'}, 'finish_reason': 'length'}]},
+            {'choices': [], 'usage': {'total_tokens': 3}},
+            done=True,
+        )
+        deltas, result = await self.stream(self.connector('4o-mini'))
+        self.assertEqual(deltas, ['cut'])
+        with self.assertRaises(ConnectorException) as raised:
+            self.connector('4o-mini').get_text(result.raw)
+        self.assertEqual(raised.exception.code, 701)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import unittest
+
+import httpx
+
+from src.helpers.chat_connector import ChatConnector, ConnectorException
+from src.helpers.json_schema import compile_schema, failing_fields
+from tests.helpers import MockedTestCase, chat_completion
+
+INVOICE = {
+    'title': 'invoice',
+    'type': 'object',
+    'properties': {
+        'nip': {'type': 'string', 'pattern': '^[0-9]{10}$'},
+        'vat': {'type': 'number'},
+        'lines': {'type': 'array', 'items': {'type': 'object', 'required': ['n']}},
+    },
+    'required': ['nip', 'vat'],
+}
+
+
+class StructuredStandIn:
+    """Answers with a wrong `nip` first and with the fixed field when re-asked."""
+
+    def __init__(self) -> None:
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append(body)
+        repair = 'previous answer had problems' in json.dumps(body)
+        value = {'nip': '5261040828'} if repair else {'nip': '526-10-40-828', 'vat': 23, 'lines': [{'n': 1}]}
+        if 'anthropic' in str(request.url):
+            content = [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'invoice', 'input': value}]
+            usage = {'input_tokens': 4, 'output_tokens': 3}
+            return httpx.Response(200, json={'content': content, 'stop_reason': 'tool_use', 'usage': usage})
+        return chat_completion(json.dumps(value), total_tokens=7)
+
+
+class TestStructuredOutput(MockedTestCase):
+    def make_endpoint(self):
+        return StructuredStandIn()
+
+    def connector(self, model):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model(model)
+        return chat
+
+    def test_validator(self):
+        validate = compile_schema(INVOICE)
+        errors = validate({'nip': 'x', 'lines': [{}]})
+        self.assertEqual(failing_fields(errors), ['vat', 'nip', 'lines'])
+        self.assertEqual(validate({'nip': '5261040828', 'vat': 23.0}), [])
+        self.assertIs(compile_schema(dict(INVOICE)), validate)
+
+    async def test_openai_json_schema_and_repair(self):
+        chat = self.connector('4o-mini')
+        result = await chat.ask_structured('faktura', INVOICE)
+        self.assertEqual(result.value, {'nip': '5261040828', 'vat': 23, 'lines': [{'n': 1}]})
+        self.assertEqual(result.billed_tokens, 14)
+        first, repair = self.endpoint.requests
+        self.assertEqual(first['response_format']['json_schema']['schema'], INVOICE)
+        self.assertEqual(list(repair['response_format']['json_schema']['schema']['properties']), ['nip'])
+
+    async def test_anthropic_forced_tool(self):
+        value = await self.connector('claude').ask_json('faktura', schema=INVOICE)
+        self.assertEqual(value['nip'], '5261040828')
+        self.assertEqual(self.endpoint.requests[0]['tool_choice'], {'type': 'tool', 'name': 'invoice'})
+
+    async def test_invalid_without_repairs(self):
+        with self.assertRaises(ConnectorException) as raised:
+            await self.connector('4o-mini').ask_structured('faktura', INVOICE, repairs=0)
+        self.assertEqual(raised.exception.code, 422)
+
+
+if __name__ == '__main__':
+    unittest.main()
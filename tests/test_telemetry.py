@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+from src.helpers.chat_connector import AskOptions, ChatConnector, ConnectorException, StructuredPrompt
+from src.helpers.embedding_connector import EmbeddingConnector
+from src.helpers.telemetry import JsonlExporter, PrometheusExporter, RequestMetrics, get_sink, observe
+from tests.helpers import MockedTestCase
+
+
+def measured(status=200, total_time=0.3, **fields) -> RequestMetrics:
+    metrics = RequestMetrics('chat', 'gpt-test', '/v1/chat/completions')
+    for name, value in fields.items():
+        setattr(metrics, name, value)
+    metrics.status = status
+    metrics.total_time = total_time
+    return metrics
+
+
+class TestExporters(unittest.TestCase):
+    def test_prometheus_counters_and_histogram(self):
+        exporter = PrometheusExporter()
+        exporter(measured(total_time=0.3, tokens_in=10, tokens_out=4, request_bytes=120))
+        exporter(measured(total_time=3.0, tokens_in=5, tokens_out=1, retries=2))
+        exporter(measured(status=429, total_time=0.05))
+        lines = exporter.render().splitlines()
+        ok = 'kind="chat",model="gpt-test",endpoint="/v1/chat/completions",status="200"'
+        self.assertIn('# TYPE llm_requests_total counter', lines)
+        self.assertIn('llm_requests_total{%s} 2' % ok, lines)
+        self.assertIn('llm_input_tokens_total{%s} 15' % ok, lines)
+        self.assertIn('llm_output_tokens_total{%s} 5' % ok, lines)
+        self.assertIn('llm_retries_total{%s} 2' % ok, lines)
+        self.assertIn('llm_requests_total{%s} 1' % ok.replace('200', '429'), lines)
+        self.assertIn('# TYPE llm_request_seconds histogram', lines)
+        # buckets are cumulative: 0.3s falls in 0.5 and above, 3s in 5 and above
+        self.assertIn('llm_request_seconds_bucket{%s,le="0.25"} 0' % ok, lines)
+        self.assertIn('llm_request_seconds_bucket{%s,le="0.5"} 1' % ok, lines)
+        self.assertIn('llm_request_seconds_bucket{%s,le="5"} 2' % ok, lines)
+        self.assertIn('llm_request_seconds_bucket{%s,le="+Inf"} 2' % ok, lines)
+        self.assertIn('llm_request_seconds_sum{%s} 3.3' % ok, lines)
+        self.assertIn('llm_request_seconds_count{%s} 2' % ok, lines)
+
+    def test_jsonl_appends_a_line_per_call(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'metrics.jsonl')
+            exporter = JsonlExporter(path)
+            exporter(measured(tokens_in=3))
+            exporter(measured(status=500, cache_hit=True))
+            with open(path, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([record['status'] for record in records], [200, 500])
+        self.assertEqual(records[0]['tokens_in'], 3)
+        self.assertTrue(records[1]['cache_hit'])
+        self.assertEqual(set(records[0]), set(measured().as_dict()))
+
+    def test_observe_takes_status_from_the_outcome(self):
+        seen = []
+        get_sink().subscribe(seen.append)
+        self.addCleanup(get_sink().unsubscribe, seen.append)
+        with observe(RequestMetrics('embed', 'm', '/e')):
+            pass
+        with self.assertRaises(ConnectorException):
+            with observe(RequestMetrics('embed', 'm', '/e')):
+                raise ConnectorException(503, 'unavailable')
+        with self.assertRaises(KeyError):
+            with observe(RequestMetrics('embed', 'm', '/e')):
+                raise KeyError('data')
+        statuses = [metrics.status for metrics in seen]
+        self.assertEqual(statuses, [200, 503, 'KeyError'])
+        self.assertTrue(all(metrics.total_time >= 0 for metrics in seen))
+
+
+class TestConnectorMetrics(MockedTestCase):
+    def make_endpoint(self):
+        def answer(request):
+            usage = {'prompt_tokens': 7, 'completion_tokens': 3, 'total_tokens': 10}
+            choices = [{'message': {'content': 'ok'}, 'finish_reason': 'stop'}]
+            return httpx.Response(200, json={'choices': choices, 'usage': usage})
+
+        return answer
+
+    def setUp(self) -> None:
+        self.seen = []
+        get_sink().subscribe(self.seen.append)
+        self.addCleanup(get_sink().unsubscribe, self.seen.append)
+        return super().setUp()
+
+    async def test_each_ask_is_measured(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        await chat.ask('question', AskOptions(extract_json=False))
+        metrics, = self.seen
+        self.assertEqual((metrics.kind, metrics.model, metrics.endpoint), ('chat', chat.model, '/v1/chat/completions'))
+        self.assertEqual(metrics.status, 200)
+        self.assertEqual((metrics.tokens_in, metrics.tokens_out), (7, 3))
+        self.assertGreater(metrics.request_bytes, 0)
+        self.assertGreater(metrics.response_bytes, 0)
+        self.assertGreaterEqual(metrics.total_time, metrics.time_to_headers)
+        self.assertFalse(metrics.cache_hit)
+
+    async def test_rejected_prompt_is_measured(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('phi4')
+        with self.assertRaises(ConnectorException):
+            await chat.ask(StructuredPrompt('rules ' * 20000, 'question'))
+        self.assertEqual([metrics.status for metrics in self.seen], [413])
+        self.assertEqual(self.seen[0].request_bytes, 0)
+
+
+class TestEmbeddingMetrics(MockedTestCase):
+    def make_endpoint(self):
+        self.calls = 0
+
+        async def answer(request):
+            self.calls += 1
+            if self.calls == 1:
+                await asyncio.sleep(0.1)
+                return httpx.Response(503, json={'error': {'message': 'unavailable'}})
+            return httpx.Response(200, json={'data': [{'embedding': [0.5, 0.25]}], 'usage': {'prompt_tokens': 2}})
+
+        return answer
+
+    def setUp(self) -> None:
+        self.seen = []
+        get_sink().subscribe(self.seen.append)
+        self.addCleanup(get_sink().unsubscribe, self.seen.append)
+        return super().setUp()
+
+    @mock.patch('src.helpers.embedding_connector.backoff_delay', return_value=0.0)
+    async def test_time_to_headers_of_the_last_attempt(self, _):
+        embedder = EmbeddingConnector(self.logger, cache=False)
+        embedder.init_model('openai')
+        await embedder.embed('query')
+        metrics, = self.seen
+        self.assertEqual((metrics.kind, metrics.status, metrics.retries), ('embed', 200, 1))
+        # the slow failed attempt counts in the total time only
+        self.assertGreaterEqual(metrics.total_time, 0.1)
+        self.assertLess(metrics.time_to_headers, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
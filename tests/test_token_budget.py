@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+
+from src.helpers import token_budget
+from src.helpers.chat_connector import AskResult, ChatConnector, ConnectorException, StructuredPrompt
+from src.helpers.providers import ModelSpec, OPENAI_CHAT
+from src.helpers.token_budget import estimate_tokens, fit_sources, token_family, truncate_to_tokens
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class TestTokenBudget(MockedTestCase):
+    def make_endpoint(self):
+        self.calls = 0
+
+        def answer(request):
+            self.calls += 1
+            return chat_completion('ok')
+
+        return answer
+
+    def connector(self, model):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model(model)
+        return chat
+
+    def test_families(self):
+        self.assertEqual(token_family('https://api.openai.com/v1/responses'), 'openai')
+        self.assertEqual(token_family('https://api.anthropic.com/v1/messages'), 'anthropic')
+        self.assertEqual(token_family('https://generativelanguage.googleapis.com/v1beta/models/m'), 'gemini')
+        self.assertEqual(token_family('https://api.together.xyz/v1/chat/completions'), 'other')
+
+    def test_estimate_grows_with_text(self):
+        self.assertEqual(estimate_tokens(''), 0)
+        short = estimate_tokens('Faktura VAT nr 12/2024', 'anthropic')
+        self.assertGreater(short, 4)
+        self.assertGreater(estimate_tokens('Faktura VAT nr 12/2024 ' * 10, 'anthropic'), short * 9)
+        # Polish words split finer than English ones
+        self.assertGreaterEqual(estimate_tokens('wynagrodzenie', 'other'), 4)
+
+    def test_truncate_prefers_paragraph_boundary(self):
+        text = 'first paragraph ' * 20 + '\n\n' + 'second paragraph ' * 20
+        cut = truncate_to_tokens(text, estimate_tokens(text, 'gemini') - 10, 'gemini')
+        self.assertEqual(cut, text.split('\n\n')[0].rstrip())
+        self.assertEqual(truncate_to_tokens(text, 10**6), text)
+        self.assertEqual(truncate_to_tokens(text, 0), '')
+
+    def test_fit_sources_keeps_order_and_truncates_the_last(self):
+        sources = ['alpha ' * 100, 'beta ' * 100, 'gamma ' * 400, 'delta ' * 10]
+        sizes = [estimate_tokens(source, 'gemini') for source in sources]
+        fitted = fit_sources(sources, sizes[0] + sizes[1] + 250, 'gemini', min_tokens=200)
+        self.assertEqual(fitted[:2], sources[:2])
+        self.assertEqual(len(fitted), 3)
+        self.assertTrue(sources[2].startswith(fitted[2]))
+        self.assertLess(len(fitted[2]), len(sources[2]))
+        # below `min_tokens` of room the source is dropped instead of truncated
+        self.assertEqual(fit_sources(sources, sizes[0] + 100, 'gemini', min_tokens=200), sources[:1])
+
+    def test_limits_of_registered_models(self):
+        self.assertEqual(self.connector('openai41').context_window, 1047576)
+        self.assertEqual(self.connector('claude').max_output_tokens, 8192)
+        together = self.connector('together')
+        self.assertEqual(together.max_output_tokens, 16380)
+        self.assertEqual(together.spec.template['max_tokens'], 16380)
+
+    def test_unknown_model_keeps_template_limits(self):
+        spec = ModelSpec('custom', 'custom-model', 'https://api.together.xyz/v1/chat/completions', {}, OPENAI_CHAT)
+        self.assertEqual(spec.max_output_tokens, token_budget.DEFAULT_LIMITS[1])
+        self.assertEqual(spec.template['max_tokens'], 16380)
+        chat = self.connector('4o-mini')
+        chat.spec = spec
+        self.assertGreater(chat.prompt_budget(), 0)
+
+    def test_fit_sources_to_the_prompt_budget(self):
+        chat = self.connector('phi4')
+        sources = ['paragraph ' * 2000] * 4
+        fitted = chat.fit_sources(sources, template='instructions ' * 50)
+        total = sum(chat.estimate_tokens(source) for source in fitted) + chat.estimate_tokens('instructions ' * 50)
+        self.assertLessEqual(total, chat.prompt_budget())
+        self.assertLessEqual(sum(chat.estimate_tokens(s) for s in chat.fit_sources(sources, limit=500)), 500)
+
+    async def test_oversized_prompt_fails_before_sending(self):
+        chat = self.connector('phi4')
+        prompt = StructuredPrompt('rules ' * 20000, 'question')
+        with self.assertRaises(ConnectorException) as raised:
+            await chat.ask(prompt)
+        self.assertEqual(raised.exception.code, 413)
+        with self.assertRaises(ConnectorException):
+            async for _ in chat.ask_stream(prompt, result=AskResult(None)):
+                pass
+        self.assertEqual(self.calls, 0)
+        self.assertEqual((await chat.ask('question')).text, 'ok')
+
+    async def test_oversized_prompt_uploads_no_context_cache(self):
+        chat = self.connector('gemini')
+        with mock.patch.dict(token_budget.MODEL_LIMITS, {'gemini': (20000, 8192)}):
+            with self.assertRaises(ConnectorException) as raised:
+                await chat.ask(StructuredPrompt('rule ' * 16000, 'question'))
+        self.assertEqual(raised.exception.code, 413)
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(chat.context_caches, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
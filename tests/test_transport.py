@@ -0,0 +1,65 @@
+import unittest
+
+import httpx
+
+from src.helpers.background_loop import run_sync
+from src.helpers.chat_connector import ChatConnector
+from src.helpers.embedding_connector import EmbeddingConnector
+from src.helpers.transport import TransportRegistry, close_transport, get_transport, install_transport
+from tests.helpers import MockedTestCase, chat_completion
+
+
+class TestTransport(MockedTestCase):
+    def make_endpoint(self):
+        return lambda request: chat_completion('ok')
+
+    async def test_one_client_per_host(self):
+        registry = get_transport()
+        openai = registry.client('https://api.openai.com/v1/chat/completions')
+        self.assertIs(registry.client('https://api.openai.com/v1/embeddings'), openai)
+        self.assertIsNot(registry.client('https://api.anthropic.com/v1/messages'), openai)
+
+    async def test_connectors_share_the_pool(self):
+        chat = ChatConnector(self.logger, cache=False)
+        chat.init_model('4o-mini')
+        other = ChatConnector(self.logger, cache=False)
+        other.init_model('openai41')
+        embedder = EmbeddingConnector(self.logger)
+        embedder.init_model('openai')
+        self.assertIs(chat.client, other.client)
+        self.assertIs(chat.client, embedder.client)
+        self.assertEqual((await chat.ask('question')).text, 'ok')
+
+    async def test_close_transport_closes_clients(self):
+        client = get_transport().client('https://api.openai.com/v1')
+        await close_transport()
+        self.assertTrue(client.is_closed)
+        # the next use starts a fresh registry with its own client
+        self.assertIsNot(get_transport().client('https://api.openai.com/v1'), client)
+
+    async def test_closed_client_is_replaced(self):
+        registry = TransportRegistry(transport=httpx.MockTransport(self.endpoint))
+        client = registry.client('https://api.openai.com/v1')
+        await client.aclose()
+        self.assertIsNot(registry.client('https://api.openai.com/v1'), client)
+        await registry.aclose()
+
+    async def test_connection_limits_per_host(self):
+        registry = TransportRegistry(connections={'example.com': 3}, http2=False)
+        self.assertEqual(registry.connections['example.com'], 3)
+        self.assertEqual(registry.connections['api.openai.com'], 64)
+        self.assertFalse(registry.http2)
+        await registry.aclose()
+
+    async def test_each_loop_has_its_own_registry(self):
+        async def registry_of_loop():
+            return get_transport()
+
+        installed = install_transport(TransportRegistry(transport=httpx.MockTransport(self.endpoint)))
+        self.assertIs(get_transport(), installed)
+        other = run_sync(registry_of_loop())
+        self.assertIsNot(other, installed)
+
+
+if __name__ == '__main__':
+    unittest.main()